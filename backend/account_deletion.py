@@ -0,0 +1,215 @@
+"""
+Background account deletion.
+
+DELETE /me only marks the user as deleted (which revokes their tokens and
+frees their email and username for a new signup) and records an
+AccountDeletion job. The purge below then removes every row that belongs to
+the user in bounded chunks, committing between chunks so no single statement
+holds locks for long.
+
+A purger claims the job with a conditional UPDATE and a lease, as the receipt
+job workers do, and renews the lease with every chunk; a job whose purger
+died is reclaimed once the lease expires. Progress is stored on the job row,
+failed runs are retried with backoff, and unfinished jobs are resumed on
+startup and every ACCOUNT_DELETION_RESUME_INTERVAL_SECONDS.
+"""
+import os
+import socket
+import threading
+import time
+import uuid
+from datetime import datetime, timedelta
+from typing import Optional
+
+from sqlalchemy import and_, or_, select
+from sqlalchemy.orm import Session
+
+from database import Base, SessionLocal, User, AccountDeletion, AccountDeletionStatus
+import metrics
+
+DELETION_CHUNK_SIZE = int(os.getenv("ACCOUNT_DELETION_CHUNK_SIZE", "5000"))
+DELETION_MAX_ATTEMPTS = int(os.getenv("ACCOUNT_DELETION_MAX_ATTEMPTS", "5"))
+DELETION_RETRY_BACKOFF_SECONDS = float(os.getenv("ACCOUNT_DELETION_RETRY_BACKOFF_SECONDS", "2"))
+DELETION_LEASE_SECONDS = int(os.getenv("ACCOUNT_DELETION_LEASE_SECONDS", "300"))  # Jobs of a dead purger are reclaimed after this
+DELETION_RESUME_INTERVAL_SECONDS = int(os.getenv("ACCOUNT_DELETION_RESUME_INTERVAL_SECONDS", "300"))
+
+# Tables that must never be purged by user_id
+EXCLUDED_TABLES = {AccountDeletion.__tablename__, User.__tablename__}
+
+
+class LeaseLost(Exception):
+    """Another purger reclaimed the job (our lease expired)"""
+
+
+def user_owned_tables() -> list:
+    """Tables with a user_id column, children before parents"""
+    return [
+        table for table in reversed(Base.metadata.sorted_tables)
+        if "user_id" in table.c and table.name not in EXCLUDED_TABLES
+    ]
+
+
+def release_identifiers(user: User):
+    """Free the unique email and username right away; the user row itself goes last"""
+    user.email = f"deleted-{user.id}@deleted.invalid"
+    user.username = None
+
+
+def mark_user_deleted(db: Session, user: User) -> AccountDeletion:
+    """Mark the user deleted and record a pending purge job"""
+    user.deleted_at = datetime.utcnow()
+    user.reset_token = None
+    user.reset_token_expires = None
+    release_identifiers(user)
+
+    deletion = AccountDeletion(
+        user_id=user.id,
+        status=AccountDeletionStatus.PENDING.value
+    )
+    db.add(deletion)
+    db.commit()
+    db.refresh(deletion)
+    metrics.increment("account_deletion.requested")
+    return deletion
+
+
+def _claimable(now: datetime, worker_id: Optional[str] = None):
+    """Unfinished jobs with attempts left that nobody holds (or we hold, or whose lease expired)"""
+    holders = [
+        AccountDeletion.locked_at.is_(None),
+        AccountDeletion.locked_at < now - timedelta(seconds=DELETION_LEASE_SECONDS)
+    ]
+    if worker_id:
+        holders.append(AccountDeletion.locked_by == worker_id)
+    return and_(
+        AccountDeletion.status != AccountDeletionStatus.COMPLETED.value,
+        AccountDeletion.attempts < DELETION_MAX_ATTEMPTS,
+        or_(*holders)
+    )
+
+
+def _claim(db: Session, deletion_id: int, worker_id: str) -> bool:
+    """Conditional update: only one purger can win the same job"""
+    now = datetime.utcnow()
+    claimed = db.query(AccountDeletion).filter(
+        AccountDeletion.id == deletion_id,
+        _claimable(now, worker_id)
+    ).update({
+        "status": AccountDeletionStatus.RUNNING.value,
+        "locked_by": worker_id,
+        "locked_at": now,
+        "attempts": AccountDeletion.attempts + 1
+    }, synchronize_session=False)
+    db.commit()
+    return bool(claimed)
+
+
+def _renew_lease(db: Session, deletion: AccountDeletion, worker_id: str):
+    renewed = db.query(AccountDeletion).filter(
+        AccountDeletion.id == deletion.id,
+        AccountDeletion.locked_by == worker_id
+    ).update({"locked_at": datetime.utcnow()}, synchronize_session=False)
+    if not renewed:
+        raise LeaseLost()
+
+
+def _delete_chunk(db: Session, table, user_id: int) -> int:
+    """Delete up to DELETION_CHUNK_SIZE rows of one user from one table"""
+    pk = list(table.primary_key.columns)[0]
+    chunk_ids = select(pk).where(table.c.user_id == user_id).limit(DELETION_CHUNK_SIZE)
+    # Wrap in a derived table so the LIMIT subquery is accepted by every backend
+    chunk_ids = select(chunk_ids.subquery().c[pk.name])
+    result = db.execute(table.delete().where(pk.in_(chunk_ids)))
+    return result.rowcount or 0
+
+
+def _purge(db: Session, deletion: AccountDeletion, worker_id: str):
+    """Delete all rows of the user, table by table, then the user itself"""
+    for table in user_owned_tables():
+        deletion.current_table = table.name
+        db.commit()
+        while True:
+            # Renewed in the chunk's transaction: a purger that lost the job deletes nothing more
+            _renew_lease(db, deletion, worker_id)
+            deleted = _delete_chunk(db, table, deletion.user_id)
+            deletion.rows_deleted += deleted
+            db.commit()
+            metrics.increment("account_deletion.rows_deleted", deleted)
+            if deleted < DELETION_CHUNK_SIZE:
+                break
+
+    _renew_lease(db, deletion, worker_id)
+    deletion.current_table = User.__tablename__
+    db.query(User).filter(User.id == deletion.user_id).delete(synchronize_session=False)
+    deletion.status = AccountDeletionStatus.COMPLETED.value
+    deletion.current_table = None
+    deletion.locked_by = None
+    deletion.completed_at = datetime.utcnow()
+    db.commit()
+
+
+def purge_user_data(deletion_id: int):
+    """Claim a deletion job and run it to completion, retrying failed attempts with backoff"""
+    worker_id = f"{socket.gethostname()}-{os.getpid()}-{uuid.uuid4().hex[:6]}"
+    db = SessionLocal()
+    try:
+        # Each attempt re-claims; we keep the lease during backoff so others don't take over
+        while _claim(db, deletion_id, worker_id):
+            deletion = db.get(AccountDeletion, deletion_id)
+            try:
+                start = time.perf_counter()
+                _purge(db, deletion, worker_id)
+                print(f"Account deletion {deletion.id}: purged user {deletion.user_id}, "
+                      f"{deletion.rows_deleted} rows in {time.perf_counter() - start:.1f}s")
+                metrics.increment("account_deletion.completed")
+                return
+            except LeaseLost:
+                db.rollback()
+                print(f"Account deletion {deletion.id}: lease lost to another purger, stopping")
+                metrics.increment("account_deletion.leases_lost")
+                return
+            except Exception as e:
+                db.rollback()
+                print(f"Account deletion {deletion.id} attempt {deletion.attempts} failed: {e}")
+                deletion.last_error = str(e)[:500]
+                deletion.status = AccountDeletionStatus.FAILED.value
+                deletion.locked_at = datetime.utcnow()
+                if deletion.attempts >= DELETION_MAX_ATTEMPTS:
+                    deletion.locked_by = None
+                db.commit()
+                metrics.increment("account_deletion.failed_attempts")
+                if deletion.attempts >= DELETION_MAX_ATTEMPTS:
+                    print(f"Account deletion {deletion.id}: giving up after {deletion.attempts} attempts")
+                    metrics.increment("account_deletion.gave_up")
+                    return
+                time.sleep(DELETION_RETRY_BACKOFF_SECONDS * 2 ** (deletion.attempts - 1))
+    finally:
+        db.close()
+
+
+def resume_pending_deletions() -> dict:
+    """Restart deletion jobs that were interrupted (e.g. by a redeploy) or whose purger died.
+
+    Safe on every worker at once: each job is started here by everyone who
+    sees it, but only one purger wins the claim.
+    """
+    db = SessionLocal()
+    try:
+        deletion_ids = [
+            deletion_id for (deletion_id,) in db.query(AccountDeletion.id).filter(
+                _claimable(datetime.utcnow())
+            ).order_by(AccountDeletion.id)
+        ]
+        # Jobs that ran out of attempts stay visible as failed (the user's email and username
+        # are already free); resetting attempts to 0 re-queues one
+        gave_up = db.query(AccountDeletion).filter(
+            AccountDeletion.status == AccountDeletionStatus.FAILED.value,
+            AccountDeletion.attempts >= DELETION_MAX_ATTEMPTS
+        ).count()
+    finally:
+        db.close()
+
+    metrics.set_gauge("account_deletion.gave_up_jobs", gave_up)
+    for deletion_id in deletion_ids:
+        threading.Thread(target=purge_user_data, args=(deletion_id,), daemon=True).start()
+    return {"resumed": len(deletion_ids), "gave_up": gave_up}
@@ -0,0 +1,256 @@
+#!/usr/bin/env python3
+"""
+Delete a large account and check every row of it is gone.
+
+Runs on a scratch SQLite database in a temp directory (or DATABASE_URL with
+--database-url). Seeds a user with about --rows rows spread over every
+user-owned table (the same tables the purge walks, so new ones are covered
+without touching this script) and a bystander with a hundredth of that, then:
+
+- marks the user deleted and signs up a new account with the same email and
+  username at once (they must be free before the purge finishes),
+- starts --purgers purges of the same job together; only one may claim it,
+- checks the user has no rows left in any table, the user row is gone, the
+  job is completed after a single attempt with rows_deleted matching the
+  seed, and the bystander's rows are untouched,
+- leaves a job as a dead purger would (running, lease expired) and one held
+  by a live purger, runs resume_pending_deletions(), and checks only the
+  first is taken over and finished.
+
+    python account_deletion_harness.py                     # ~100k rows
+    python account_deletion_harness.py --rows 20000 --chunk-size 1000 --purgers 8
+"""
+import argparse
+import os
+import sys
+import tempfile
+import threading
+import time
+from collections import Counter
+from datetime import date, datetime, timedelta
+
+BACKEND_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, BACKEND_DIR)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Account deletion check on a large account")
+    parser.add_argument("--rows", type=int, default=100000, help="rows owned by the deleted user, over all tables")
+    parser.add_argument("--chunk-size", type=int, help="ACCOUNT_DELETION_CHUNK_SIZE (default: the app's)")
+    parser.add_argument("--purgers", type=int, default=4, help="purges of the same job started together")
+    parser.add_argument("--database-url", help="run against this database instead of a scratch SQLite file")
+    return parser.parse_args()
+
+
+def _single_row(table) -> bool:
+    """Tables keyed by user_id alone hold one row per user"""
+    keys = [set(c.name for c in table.primary_key.columns)]
+    keys += [set(c.name for c in constraint.columns) for constraint in table.constraints
+             if constraint.__class__.__name__ == "UniqueConstraint"]
+    return {"user_id"} in keys
+
+
+def _value(column, index: int):
+    python_type = column.type.python_type
+    if python_type is bool:
+        return False
+    if python_type is int:
+        return index
+    if python_type is float:
+        return float(index % 500)
+    if python_type is datetime:
+        return datetime.utcnow()
+    if python_type is date:
+        return date.today() - timedelta(days=index % 1000)
+    if python_type is bytes:
+        return b"\x00"
+    return f"{column.table.name}-{column.name}-{index}"
+
+
+def seed_user(db, email: str, rows: int) -> tuple[int, Counter]:
+    """A user with about `rows` rows over every user-owned table; returns (id, rows per table)"""
+    from sqlalchemy import insert, select
+
+    from account_deletion import user_owned_tables
+    from database import User
+
+    user = User(email=email, username=email.split("@")[0], password_hash="!", name="Harness")
+    db.add(user)
+    db.commit()
+
+    tables = list(reversed(user_owned_tables()))  # Parents first
+    many = [table for table in tables if not _single_row(table)]
+    per_table = max(1, rows // max(1, len(many)))
+    seeded: Counter = Counter()
+    for table in tables:
+        count = 1 if _single_row(table) else per_table
+        parents = {}
+        for fk in table.foreign_keys:
+            column = fk.parent
+            if column.name == "user_id" or column.nullable:
+                continue
+            parent = fk.column.table
+            if "user_id" in parent.c:
+                # One of this user's rows, e.g. a scan for each scan result
+                parents[column.name] = [
+                    parent_id for (parent_id,) in db.execute(
+                        select(fk.column).where(parent.c.user_id == user.id).order_by(fk.column).limit(count)
+                    )
+                ]
+            else:
+                # Shared parents (promo codes): make one per row
+                stamp = time.time_ns()
+                db.execute(insert(parent), [
+                    {c.name: _value(c, stamp + i) for c in parent.c
+                     if not c.primary_key and not c.nullable and c.default is None and c.server_default is None}
+                    for i in range(count)
+                ])
+                parents[column.name] = [
+                    parent_id for (parent_id,) in db.execute(select(fk.column).order_by(fk.column.desc()).limit(count))
+                ]
+            count = min(count, len(parents[column.name]))
+
+        batch = []
+        for i in range(count):
+            row = {"user_id": user.id}
+            for column in table.c:
+                if column.name in row or column.primary_key and column.name != "user_id":
+                    continue
+                if column.name in parents:
+                    row[column.name] = parents[column.name][i]
+                elif not column.nullable and column.default is None and column.server_default is None:
+                    row[column.name] = _value(column, i)
+            batch.append(row)
+            if len(batch) == 10000:
+                db.execute(insert(table), batch)
+                batch = []
+        if batch:
+            db.execute(insert(table), batch)
+        db.commit()
+        seeded[table.name] = count
+    return user.id, seeded
+
+
+def remaining(db, user_id: int) -> Counter:
+    from sqlalchemy import func, select
+
+    from account_deletion import user_owned_tables
+    from database import User
+
+    left: Counter = Counter()
+    for table in user_owned_tables():
+        left[table.name] = db.execute(select(func.count()).select_from(table).where(table.c.user_id == user_id)).scalar()
+    left["users"] = db.query(User).filter(User.id == user_id).count()
+    return +left
+
+
+def wait_for(predicate, timeout: float = 120) -> bool:
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if predicate():
+            return True
+        time.sleep(0.1)
+    return False
+
+
+def main():
+    args = parse_args()
+    os.environ.setdefault("PASSWORD_HASH_CALIBRATE", "false")
+    os.environ.setdefault("SCHEDULER_ENABLED", "false")
+    if args.chunk_size:
+        os.environ["ACCOUNT_DELETION_CHUNK_SIZE"] = str(args.chunk_size)
+    if args.database_url:
+        os.environ["DATABASE_URL"] = args.database_url
+    else:
+        os.environ.pop("DATABASE_URL", None)
+        os.chdir(tempfile.mkdtemp(prefix="deletion-harness-"))
+
+    import account_deletion
+    from account_deletion import DELETION_CHUNK_SIZE, mark_user_deleted, purge_user_data, resume_pending_deletions
+    from database import AccountDeletion, AccountDeletionStatus, SessionLocal, User, init_db
+
+    init_db()
+    stamp = int(time.time() * 1000)
+    checks = {}
+    db = SessionLocal()
+    try:
+        start = time.perf_counter()
+        email = f"deleted-{stamp}@example.com"
+        user_id, seeded = seed_user(db, email, args.rows)
+        bystander_id, bystander_seeded = seed_user(db, f"bystander-{stamp}@example.com", args.rows // 100)
+        print(f"Seeded {sum(seeded.values())} rows over {len(seeded)} tables in {time.perf_counter() - start:.1f}s "
+              f"(chunk size {DELETION_CHUNK_SIZE})")
+
+        deletion_id = mark_user_deleted(db, db.get(User, user_id)).id
+        try:
+            db.add(User(email=email, username=email.split("@")[0], password_hash="!", name="Harness"))
+            db.commit()
+            checks["email and username free at once"] = True
+        except Exception as e:
+            db.rollback()
+            print(f"  signup with the deleted email failed: {type(e).__name__}: {e}".splitlines()[0])
+            checks["email and username free at once"] = False
+
+        barrier = threading.Barrier(args.purgers)
+
+        def purge():
+            barrier.wait()
+            purge_user_data(deletion_id)
+
+        start = time.perf_counter()
+        threads = [threading.Thread(target=purge) for _ in range(args.purgers)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        elapsed = time.perf_counter() - start
+
+        db.expire_all()
+        deletion = db.get(AccountDeletion, deletion_id)
+        left = remaining(db, user_id)
+        bystander_left = remaining(db, bystander_id)
+        print(f"Purged in {elapsed:.1f}s by {args.purgers} concurrent purgers: status={deletion.status} "
+              f"attempts={deletion.attempts} rows_deleted={deletion.rows_deleted}")
+        for table, count in sorted(left.items()):
+            print(f"  left behind: {table}: {count}")
+        checks["job completed"] = deletion.status == AccountDeletionStatus.COMPLETED.value
+        checks["claimed once"] = deletion.attempts == 1
+        checks["no rows left"] = not left
+        checks["rows_deleted matches seed"] = deletion.rows_deleted == sum(seeded.values())
+        checks["bystander untouched"] = bystander_left == Counter({**bystander_seeded, "users": 1})
+
+        # A purger that died mid-job and one that is alive and holding its lease
+        stale_id, _ = seed_user(db, f"stale-{stamp}@example.com", 1000)
+        live_id, _ = seed_user(db, f"live-{stamp}@example.com", 1000)
+        jobs = {}
+        for name, owner, locked_at in (
+            ("stale", stale_id, datetime.utcnow() - timedelta(seconds=account_deletion.DELETION_LEASE_SECONDS + 1)),
+            ("live", live_id, datetime.utcnow()),
+        ):
+            job = mark_user_deleted(db, db.get(User, owner))
+            job.status, job.locked_by, job.locked_at, job.attempts = \
+                AccountDeletionStatus.RUNNING.value, f"{name}-purger", locked_at, 1
+            db.commit()
+            jobs[name] = job.id
+        resumed = resume_pending_deletions()
+
+        def finished(job_id):
+            db.expire_all()
+            return db.get(AccountDeletion, job_id).status == AccountDeletionStatus.COMPLETED.value
+
+        checks["expired lease taken over"] = wait_for(lambda: finished(jobs["stale"])) and not remaining(db, stale_id)
+        time.sleep(0.5)
+        db.expire_all()
+        live = db.get(AccountDeletion, jobs["live"])
+        print(f"Resume: {resumed}; live job status={live.status} locked_by={live.locked_by} attempts={live.attempts}")
+        checks["held lease left alone"] = live.locked_by == "live-purger" and live.attempts == 1 and remaining(db, live_id)
+    finally:
+        db.close()
+
+    for name, ok in checks.items():
+        print(f"  {'ok  ' if ok else 'FAIL'} {name}")
+    sys.exit(0 if all(checks.values()) else 1)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,26 +1,154 @@
 from datetime import datetime, timedelta
 from typing import Optional
+import hmac
+import os
+import time
 from jose import JWTError, jwt
 from passlib.context import CryptContext
-from fastapi import Depends, HTTPException, status
+from fastapi import Depends, Header, HTTPException, status
 from fastapi.security import OAuth2PasswordBearer, OAuth2PasswordRequestForm
 from sqlalchemy.orm import Session
 from database import get_db, User
+import metrics
 
 # Secret key for JWT (in production, use environment variable)
 SECRET_KEY = "your-secret-key-change-this-in-production"
 ALGORITHM = "HS256"
 ACCESS_TOKEN_EXPIRE_MINUTES = 30 * 24 * 60  # 30 days
 
-pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto", bcrypt__rounds=12)
+# Password hashing policy
+# The first scheme is used for new hashes; the rest are accepted but deprecated,
+# so matching hashes are upgraded on the next successful login.
+PASSWORD_HASH_SCHEMES = [
+    s.strip() for s in os.getenv("PASSWORD_HASH_SCHEMES", "bcrypt").split(",") if s.strip()
+]
+PASSWORD_HASH_TARGET_MS = float(os.getenv("PASSWORD_HASH_TARGET_MS", "250"))
+PASSWORD_HASH_CALIBRATE = os.getenv("PASSWORD_HASH_CALIBRATE", "true").lower() == "true"
+# Hashes below this work factor are rehashed on login (default: the scheme's floor).
+# Fixed rather than calibrated, so instances on different hardware agree on it.
+PASSWORD_HASH_MIN_COST = os.getenv("PASSWORD_HASH_MIN_COST")
+
+# Work factor bounds per scheme: (setting name, floor, default, ceiling)
+# The floor is never lowered by calibration, even on a slow instance.
+# passlib only takes default_/min_ policies for "rounds" (argon2's time_cost).
+HASH_COST_BOUNDS = {
+    "bcrypt": ("rounds", 10, 12, 15),
+    "argon2": ("rounds", 2, 3, 10),
+}
+
+# Test password used when timing candidate work factors
+CALIBRATION_PASSWORD = "calibration-password-0123456789"
+
+
+def _min_cost(floor: int) -> int:
+    return int(PASSWORD_HASH_MIN_COST) if PASSWORD_HASH_MIN_COST else floor
+
+
+def build_pwd_context(cost: Optional[int] = None) -> CryptContext:
+    """Build the CryptContext for the configured schemes.
+
+    New hashes of the default scheme use `cost`. Hashes below the fixed
+    minimum (PASSWORD_HASH_MIN_COST, else the scheme's floor) are reported as
+    needing an update, as are hashes of any deprecated scheme.
+    """
+    default_scheme = PASSWORD_HASH_SCHEMES[0]
+    settings = {}
+    if default_scheme in HASH_COST_BOUNDS:
+        setting, floor, default_cost, _ceiling = HASH_COST_BOUNDS[default_scheme]
+        min_cost = _min_cost(floor)
+        cost = max(cost or default_cost, min_cost)
+        settings[f"{default_scheme}__default_{setting}"] = cost
+        settings[f"{default_scheme}__min_{setting}"] = min_cost
+    return CryptContext(schemes=PASSWORD_HASH_SCHEMES, deprecated="auto", **settings)
+
+
+pwd_context = build_pwd_context()
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="login")
 
 
+def _time_hash(scheme: str, setting: str, cost: int) -> float:
+    """Time a single hash at the given work factor, in milliseconds"""
+    handler = pwd_context.handler(scheme).using(**{setting: cost})
+    start = time.perf_counter()
+    handler.hash(CALIBRATION_PASSWORD)
+    return (time.perf_counter() - start) * 1000
+
+
+def calibrate_password_hashing() -> dict:
+    """Pick the work factor that keeps one hash under PASSWORD_HASH_TARGET_MS.
+
+    Runs once at startup. The chosen cost is only the default for new hashes;
+    the minimum accepted on login stays fixed, so users aren't rehashed back
+    and forth between instances that calibrate differently.
+    """
+    global pwd_context
+
+    scheme = PASSWORD_HASH_SCHEMES[0]
+    result = {
+        "scheme": scheme,
+        "schemes": PASSWORD_HASH_SCHEMES,
+        "target_ms": PASSWORD_HASH_TARGET_MS,
+        "calibrated": False,
+    }
+
+    if scheme not in HASH_COST_BOUNDS:
+        print(f"Password hashing: no cost calibration for scheme '{scheme}'")
+        metrics.set_gauge("password_hash", result)
+        return result
+
+    setting, floor, default_cost, ceiling = HASH_COST_BOUNDS[scheme]
+    cost = default_cost
+    elapsed_ms = None
+
+    if PASSWORD_HASH_CALIBRATE:
+        try:
+            # Walk up from the minimum; stop at the first cost over the target
+            cost = _min_cost(floor)
+            elapsed_ms = _time_hash(scheme, setting, cost)
+            while cost < ceiling:
+                next_ms = _time_hash(scheme, setting, cost + 1)
+                if next_ms > PASSWORD_HASH_TARGET_MS:
+                    break
+                cost += 1
+                elapsed_ms = next_ms
+            result["calibrated"] = True
+        except Exception as e:
+            print(f"Password hashing calibration failed, using default {setting}={default_cost}: {e}")
+            cost = default_cost
+            elapsed_ms = None
+
+    pwd_context = build_pwd_context(cost)
+    result[setting] = cost
+    result[f"min_{setting}"] = _min_cost(floor)
+    if elapsed_ms is None:
+        # Not calibrated: time the chosen cost once for /debug/metrics, never failing startup over it
+        try:
+            elapsed_ms = _time_hash(scheme, setting, cost)
+        except Exception as e:
+            print(f"Password hashing: could not time {scheme} {setting}={cost}: {e}")
+    result["hash_ms"] = round(elapsed_ms, 1) if elapsed_ms is not None else None
+
+    print(f"Password hashing: {scheme} {setting}={cost} ({result['hash_ms']} ms, target {PASSWORD_HASH_TARGET_MS} ms)")
+    metrics.set_gauge("password_hash", result)
+    return result
+
+
 def verify_password(plain_password: str, hashed_password: str) -> bool:
     """Verify a password against a hash"""
     return pwd_context.verify(plain_password, hashed_password)
 
 
+def verify_and_update_password(plain_password: str, hashed_password: str) -> tuple[bool, Optional[str]]:
+    """Verify a password and return a replacement hash if the stored one is below policy.
+
+    Returns (valid, new_hash); new_hash is None when no rehash is needed.
+    """
+    valid, new_hash = pwd_context.verify_and_update(plain_password, hashed_password)
+    if new_hash:
+        metrics.increment("password_hash.rehashes")
+    return valid, new_hash
+
+
 def get_password_hash(password: str) -> str:
     """Hash a password"""
     return pwd_context.hash(password)
@@ -43,6 +171,16 @@ def get_current_user(
     db: Session = Depends(get_db)
 ) -> User:
     """Get the current authenticated user"""
+    return get_user_for_token(token, db)
+
+
+def get_user_for_token(token: Optional[str], db: Session, scope: Optional[str] = None) -> User:
+    """The user a bearer token belongs to; 401 for bad tokens and accounts pending deletion
+
+    Tokens issued for one purpose (e.g. the event stream's) carry a "scope"
+    claim and are only accepted where that scope is asked for; access
+    tokens have none.
+    """
     credentials_exception = HTTPException(
         status_code=status.HTTP_401_UNAUTHORIZED,
         detail="Could not validate credentials",
@@ -66,6 +204,9 @@ def get_current_user(
         if user_id_str is None:
             print("ERROR: No user_id in token payload")
             raise credentials_exception
+        if payload.get("scope") != scope:
+            print(f"ERROR: token scope {payload.get('scope')!r} is not {scope!r}")
+            raise credentials_exception
         # Check if sub is actually a string
         if not isinstance(user_id_str, str):
             print(f"ERROR: sub is not a string, it's {type(user_id_str)}: {user_id_str}")
@@ -90,6 +231,22 @@ def get_current_user(
     if user is None:
         print(f"ERROR: User with id {user_id} not found in database")
         raise credentials_exception
+    if user.deleted_at is not None:
+        # Account deletion revokes every outstanding token
+        print(f"ERROR: User with id {user_id} is pending deletion")
+        raise credentials_exception
     print(f"User found: {user.email}")
     return user
 
+
+
+# Admin endpoints (/admin/...) authenticate with a shared key instead of a user token
+ADMIN_API_KEY = os.getenv("ADMIN_API_KEY")
+
+
+def require_admin(x_admin_key: Optional[str] = Header(None)):
+    """Allow the request only with an X-Admin-Key header matching ADMIN_API_KEY"""
+    if not ADMIN_API_KEY:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Not Found")
+    if not x_admin_key or not hmac.compare_digest(x_admin_key, ADMIN_API_KEY):
+        raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="Invalid admin key")
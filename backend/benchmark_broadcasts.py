@@ -0,0 +1,181 @@
+#!/usr/bin/env python3
+"""
+Broadcast notification benchmark: one announcement to every user.
+
+Runs on a scratch SQLite database in a temp directory (or DATABASE_URL with
+--database-url), seeds --users users, then sends the same announcement
+three ways and reports time and notifications table growth for each:
+
+- per-user rows: notify_many() with the full text on every row (what a
+  broadcast took before notification_templates),
+- eager template: send_broadcast(), chunked INSERT ... SELECT from users,
+  rows carry only the template id and read state,
+- lazy template: create_broadcast(); nothing is written per user until they
+  read, so it also times GET /notifications/unread-count for --sample users
+  (first read delivers the broadcast, second read is the steady state) and
+  checks their counts and feed text.
+
+    python benchmark_broadcasts.py                     # 100k users
+    python benchmark_broadcasts.py --users 20000 --sample 200
+"""
+import argparse
+import asyncio
+import contextlib
+import os
+import random
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+BACKEND_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, BACKEND_DIR)
+
+from benchmark_receipts import summarize_ms
+
+MESSAGE = ("Scheduled maintenance: receipt scanning and exports will be unavailable on Sunday from 02:00 to "
+           "03:00 UTC while we upgrade our database. Your expenses and income are not affected.")
+
+
+def seed(users: int) -> list[int]:
+    from sqlalchemy import insert
+
+    from database import SessionLocal, User
+
+    stamp = int(time.time() * 1000)
+    signed_up = datetime.utcnow() - timedelta(days=30)
+    db = SessionLocal()
+    try:
+        rows = [{"email": f"broadcast-{stamp}-{i}@example.com", "password_hash": "!", "name": "Benchmark",
+                 "created_at": signed_up} for i in range(users)]
+        for start in range(0, len(rows), 10000):
+            db.execute(insert(User), rows[start:start + 10000])
+        db.commit()
+        return [user_id for (user_id,) in db.query(User.id).filter(User.email.like(f"broadcast-{stamp}-%")).order_by(User.id)]
+    finally:
+        db.close()
+
+
+def notifications_bytes() -> int:
+    """Size of the notifications table and its indexes"""
+    from sqlalchemy import text
+
+    from database import engine
+
+    with engine.connect() as conn:
+        if engine.dialect.name == "postgresql":
+            return conn.execute(text("SELECT pg_total_relation_size('notifications')")).scalar()
+        # Whole file: only the notifications table grows between measurements
+        page_count = conn.execute(text("PRAGMA page_count")).scalar()
+        return page_count * conn.execute(text("PRAGMA page_size")).scalar()
+
+
+def measure(func) -> tuple[float, int]:
+    before = notifications_bytes()
+    start = time.perf_counter()
+    func()
+    return time.perf_counter() - start, notifications_bytes() - before
+
+
+async def run_benchmark(args) -> dict:
+    import httpx
+    from main import app
+
+    from auth import create_access_token
+    from database import SessionLocal
+    from notification_broadcasts import create_broadcast, send_broadcast
+    from notification_service import notify_many
+
+    result: dict = {}
+    async with app.router.lifespan_context(app):
+        start = time.perf_counter()
+        user_ids = seed(args.users)
+        result["seed_seconds"] = time.perf_counter() - start
+
+        def per_user_rows():
+            db = SessionLocal()
+            try:
+                for start in range(0, len(user_ids), args.chunk_size):
+                    notify_many(db, [{"user_id": user_id, "type": "maintenance", "message": MESSAGE}
+                                     for user_id in user_ids[start:start + args.chunk_size]])
+                    db.commit()
+            finally:
+                db.close()
+
+        def eager_template():
+            db = SessionLocal()
+            try:
+                template_id = create_broadcast(db, "maintenance", MESSAGE, eager=True).id
+            finally:
+                db.close()
+            result["eager_written"] = send_broadcast(template_id, chunk_size=args.chunk_size)
+
+        def lazy_template():
+            db = SessionLocal()
+            try:
+                create_broadcast(db, "maintenance", MESSAGE)
+            finally:
+                db.close()
+
+        result["per_user"] = measure(per_user_rows)
+        result["eager"] = measure(eager_template)
+        result["lazy"] = measure(lazy_template)
+
+        sample = random.Random(args.seed).sample(user_ids, min(args.sample, len(user_ids)))
+        transport = httpx.ASGITransport(app=app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://bench", timeout=300) as client:
+            first_ms, steady_ms, wrong_counts, wrong_text = [], [], 0, 0
+            for user_id in sample:
+                headers = {"Authorization": f"Bearer {create_access_token({'sub': str(user_id)})}"}
+                for latencies in (first_ms, steady_ms):
+                    start = time.perf_counter()
+                    response = await client.get("/notifications/unread-count", headers=headers)
+                    latencies.append((time.perf_counter() - start) * 1000)
+                    response.raise_for_status()
+                # One notification from each way of sending
+                wrong_counts += response.json()["unread_count"] != 3
+                feed = (await client.get("/notifications", headers=headers)).json()["items"]
+                wrong_text += [item["message"] for item in feed] != [MESSAGE] * 3
+        result["lazy_first_read"] = first_ms
+        result["lazy_steady_read"] = steady_ms
+        result["wrong_counts"] = wrong_counts
+        result["wrong_text"] = wrong_text
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Broadcast notification benchmark")
+    parser.add_argument("--users", type=int, default=100000)
+    parser.add_argument("--sample", type=int, default=500, help="users whose first and second read are timed")
+    parser.add_argument("--chunk-size", type=int, default=1000)
+    parser.add_argument("--database-url", help="run against this database instead of a scratch SQLite file")
+    parser.add_argument("--seed", type=int)
+    parser.add_argument("--verbose", dest="quiet", action="store_false", help="show the app's log output")
+    args = parser.parse_args()
+
+    os.environ.setdefault("PASSWORD_HASH_CALIBRATE", "false")
+    os.environ.setdefault("SCHEDULER_ENABLED", "false")
+    if args.database_url:
+        os.environ["DATABASE_URL"] = args.database_url
+    else:
+        os.environ.pop("DATABASE_URL", None)
+        os.chdir(tempfile.mkdtemp(prefix="broadcast-bench-"))
+
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull if args.quiet else sys.stdout):
+        result = asyncio.run(run_benchmark(args))
+
+    print(f"Users: {args.users}  chunk size: {args.chunk_size}  (seeded in {result['seed_seconds']:.1f}s)")
+    print()
+    for name, key in (("Per-user rows:", "per_user"), ("Eager template:", "eager"), ("Lazy template:", "lazy")):
+        seconds, growth = result[key]
+        print(f"{name:<16} {seconds:7.2f}s  notifications +{growth / 1024 / 1024:6.1f} MiB")
+    print(f"                 eager rows written: {result['eager_written']}")
+    print(f"Lazy first read: {summarize_ms(result['lazy_first_read'])}  (unread-count, delivers the broadcast)")
+    print(f"Lazy next read:  {summarize_ms(result['lazy_steady_read'])}")
+    print(f"Check:           wrong counts: {result['wrong_counts']}  wrong feed text: {result['wrong_text']}")
+    ok = result["eager_written"] == args.users and not result["wrong_counts"] and not result["wrong_text"]
+    sys.exit(0 if ok else 1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,176 @@
+#!/usr/bin/env python3
+"""
+Checkout / cancel load test against fake_stripe_server.
+
+Runs the app in-process (httpx ASGI transport) on a throwaway SQLite database
+in a temp directory, with STRIPE_API_BASE pointed at the fake Stripe server
+started in a background thread. Each user sends --checkouts-per-user
+checkouts at once, so the first ones race to create the Stripe customer and
+the rest should hit the customer id cache. Reports latency, event-loop lag,
+HTTP statuses, what the gateway did (calls, retries, breaker) and how many
+Stripe customers were created per user.
+
+    python benchmark_checkout.py --users 200 --concurrency 50
+    python benchmark_checkout.py --error-rate 0.2 --rate-limit-rate 0.1
+    python benchmark_checkout.py --hang-rate 0.05 --timeout 2
+    python benchmark_checkout.py --mode cancel --users 100
+
+Gateway settings (STRIPE_MAX_RETRIES, STRIPE_BREAKER_FAILURES, ...) are read
+from the environment as usual.
+"""
+import argparse
+import asyncio
+import contextlib
+import os
+import sys
+import tempfile
+import time
+
+BACKEND_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, BACKEND_DIR)
+
+import fake_stripe_server
+from benchmark_receipts import LoopLagMonitor, summarize_ms
+
+
+def create_users(count: int) -> list[dict]:
+    """Users straight in the database (signup would spend the run hashing passwords); returns auth headers"""
+    from auth import create_access_token
+    from database import SessionLocal, User
+
+    stamp = int(time.time() * 1000)
+    db = SessionLocal()
+    try:
+        users = [User(email=f"checkout-{stamp}-{i}@example.com", password_hash="!", name="Benchmark") for i in range(count)]
+        db.add_all(users)
+        db.commit()
+        return [{"Authorization": f"Bearer {create_access_token({'sub': str(user.id)})}"} for user in users]
+    finally:
+        db.close()
+
+
+def give_unlimited_plans(count: int):
+    """Put every user on the unlimited plan with a Stripe subscription, for --mode cancel"""
+    from database import SessionLocal, Subscription, SubscriptionPlanType, User
+    from entitlements import get_or_create_subscription
+
+    db = SessionLocal()
+    try:
+        for user in db.query(User).order_by(User.id.desc()).limit(count):
+            subscription = get_or_create_subscription(db, user.id, commit=False)
+            subscription.plan_type = SubscriptionPlanType.UNLIMITED.value
+            subscription.stripe_subscription_id = f"sub_bench{user.id}"
+        db.commit()
+        return db.query(Subscription).count()
+    finally:
+        db.close()
+
+
+async def run_benchmark(args) -> dict:
+    import httpx
+    import metrics
+    from main import app
+
+    latencies_ms: list[float] = []
+    statuses: dict[int, int] = {}
+    semaphore = asyncio.Semaphore(args.concurrency)
+
+    async with app.router.lifespan_context(app):
+        users = create_users(args.users)
+        if args.mode == "cancel":
+            give_unlimited_plans(args.users)
+
+        transport = httpx.ASGITransport(app=app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://bench", timeout=300) as client:
+            async with httpx.AsyncClient(base_url=f"http://127.0.0.1:{args.fake_port}") as fake:
+                await fake.delete("/requests")
+
+                async def one(headers: dict):
+                    async with semaphore:
+                        start = time.perf_counter()
+                        if args.mode == "cancel":
+                            response = await client.post("/subscription/cancel", headers=headers)
+                        else:
+                            response = await client.post("/subscription/create-checkout", headers=headers, json={"plan_type": args.plan})
+                        latencies_ms.append((time.perf_counter() - start) * 1000)
+                    statuses[response.status_code] = statuses.get(response.status_code, 0) + 1
+
+                async def user_session(headers: dict):
+                    per_user = 1 if args.mode == "cancel" else args.checkouts_per_user
+                    await asyncio.gather(*(one(headers) for _ in range(per_user)))
+
+                monitor = LoopLagMonitor()
+                monitor.start()
+                started = time.perf_counter()
+                await asyncio.gather(*(user_session(headers) for headers in users))
+                elapsed = time.perf_counter() - started
+                await monitor.stop()
+
+                fake_stats = (await fake.get("/stats")).json()
+
+    counters = metrics.snapshot()["counters"]
+    return {
+        "elapsed": elapsed,
+        "requests": len(latencies_ms),
+        "statuses": statuses,
+        "latencies_ms": latencies_ms,
+        "loop_lag_ms": monitor.lags_ms,
+        "fake_stats": fake_stats,
+        "gateway": {name.split(".", 1)[1]: value for name, value in sorted(counters.items()) if name.startswith("stripe.")},
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Checkout load test against a local fake Stripe API")
+    parser.add_argument("--mode", choices=["checkout", "cancel"], default="checkout")
+    parser.add_argument("--users", type=int, default=100)
+    parser.add_argument("--checkouts-per-user", type=int, default=2, help="concurrent checkouts per user (checkout mode)")
+    parser.add_argument("--plan", choices=["extra_30", "unlimited"], default="unlimited")
+    parser.add_argument("--concurrency", type=int, default=20, help="requests in flight at once")
+    parser.add_argument("--timeout", type=float, help="STRIPE_TIMEOUT_SECONDS for the run")
+    parser.add_argument("--fake-port", type=int, default=12199)
+    parser.add_argument("--verbose", dest="quiet", action="store_false", help="show the app's log output")
+    fake_stripe_server.add_arguments(parser)
+    args = parser.parse_args()
+
+    # The app reads its settings at import time: point it at the fake server and a scratch database first
+    os.environ["STRIPE_API_BASE"] = f"http://127.0.0.1:{args.fake_port}"
+    os.environ["STRIPE_SECRET_KEY"] = "sk_test_fake"
+    os.environ["STRIPE_PRICE_ID_EXTRA_30"] = "price_fake_extra_30"
+    os.environ["STRIPE_PRICE_ID_UNLIMITED"] = "price_fake_unlimited"
+    if args.timeout is not None:
+        os.environ["STRIPE_TIMEOUT_SECONDS"] = str(args.timeout)
+    os.environ.setdefault("PASSWORD_HASH_CALIBRATE", "false")
+    os.environ.setdefault("SCHEDULER_ENABLED", "false")
+    os.environ.pop("DATABASE_URL", None)
+    workdir = tempfile.mkdtemp(prefix="checkout-bench-")
+    os.chdir(workdir)
+
+    fake_stripe_server.configure_from_args(args)
+    fake_stripe_server.start_in_thread(args.fake_port)
+
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull if args.quiet else sys.stdout):
+        if args.quiet:
+            import logging
+            logging.disable(logging.WARNING)
+        result = asyncio.run(run_benchmark(args))
+
+    config = fake_stripe_server.config
+    stats = result["fake_stats"]
+    print(f"Mode: {args.mode}  users: {args.users}  requests: {result['requests']}  concurrency: {args.concurrency}")
+    print(f"Fake Stripe latency: {config.latency_ms:.0f}±{config.latency_jitter_ms:.0f}ms  "
+          f"errors: {config.error_rate:.0%}  429s: {config.rate_limit_rate:.0%}  hangs: {config.hang_rate:.0%}")
+    print(f"Database: {workdir}/expenses.db")
+    print()
+    print(f"Elapsed:     {result['elapsed']:.2f}s ({result['requests'] / result['elapsed']:.1f} req/s)")
+    print(f"Responses:   {result['statuses']}")
+    print(f"Latency:     {summarize_ms(result['latencies_ms'])}")
+    print(f"Loop lag:    {summarize_ms(result['loop_lag_ms'])}")
+    print(f"Gateway:     {result['gateway']}")
+    print(f"Stripe API:  {stats['requests']} requests  by status {stats['by_status']}  by endpoint {stats['by_endpoint']}")
+    if args.mode == "checkout":
+        print(f"Customers:   {stats['customers']} created for {args.users} users")
+
+
+if __name__ == "__main__":
+    main()
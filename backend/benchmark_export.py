@@ -0,0 +1,231 @@
+#!/usr/bin/env python3
+"""
+CSV export benchmark: the streaming /export/csv against the old in-memory build.
+
+Runs the app under uvicorn in a background thread on a scratch SQLite
+database in a temp directory (or DATABASE_URL with --database-url), seeds a
+user with --rows expenses and income (and one with a tenth of that), then
+exports each user's whole range:
+
+- old: every row as an ORM object, one StringIO, then encode('utf-8-sig')
+  (what export_csv did before streaming; run in-process),
+- stream: GET /export/csv read with a streaming client,
+- gzip: the same with Accept-Encoding: gzip.
+
+For each it reports time, time to first byte, bytes sent and the peak Python
+memory allocated while it ran (tracemalloc; includes the server's side of the
+request). It checks the streamed CSV starts with a BOM, has every row, and
+that the gzip body decompresses to exactly the plain one.
+
+    python benchmark_export.py                   # 1M rows
+    python benchmark_export.py --rows 200000
+"""
+import argparse
+import contextlib
+import gzip
+import io
+import os
+import random
+import socket
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+from datetime import date, timedelta
+
+BACKEND_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, BACKEND_DIR)
+
+CATEGORIES = ["Food", "Transport", "Bills", "Shopping", "Health", "Salary", "Freelance"]
+
+
+def seed(rows: int, rng: random.Random) -> dict:
+    """A user with `rows` expenses and income over five years; returns {id, headers}"""
+    from sqlalchemy import insert
+
+    from auth import create_access_token
+    from database import Expense, Income, SessionLocal, User
+
+    db = SessionLocal()
+    try:
+        user = User(email=f"export-{time.time_ns()}@example.com", password_hash="!", name="Benchmark")
+        db.add(user)
+        db.commit()
+        first_day = date.today() - timedelta(days=5 * 365)
+        batch = {Expense: [], Income: []}
+        for i in range(rows):
+            model = Income if i % 5 == 0 else Expense
+            batch[model].append({
+                "user_id": user.id,
+                "amount": round(rng.uniform(1, 500), 2),
+                "date": first_day + timedelta(days=rng.randrange(5 * 365)),
+                "category": rng.choice(CATEGORIES),
+                "description": f"Benchmark entry {i}, \"quoted\" and, with commas",
+            })
+            if len(batch[model]) == 50000:
+                db.execute(insert(model), batch[model])
+                batch[model] = []
+        for model, pending in batch.items():
+            if pending:
+                db.execute(insert(model), pending)
+        db.commit()
+        return {"id": user.id, "headers": {"Authorization": f"Bearer {create_access_token({'sub': str(user.id)})}"}}
+    finally:
+        db.close()
+
+
+def old_export(user_id: int, start: date, end: date) -> bytes:
+    """The pre-streaming export_csv body"""
+    import csv
+
+    from database import Expense, Income, SessionLocal
+
+    db = SessionLocal()
+    try:
+        expenses = db.query(Expense).filter(
+            Expense.user_id == user_id, Expense.date >= start, Expense.date <= end
+        ).order_by(Expense.date.desc()).all()
+        incomes = db.query(Income).filter(
+            Income.user_id == user_id, Income.date >= start, Income.date <= end
+        ).order_by(Income.date.desc()).all()
+        output = io.StringIO()
+        writer = csv.writer(output)
+        writer.writerow(['Type', 'Date', 'Amount', 'Category', 'Description'])
+        for label, rows in (('Expense', expenses), ('Income', incomes)):
+            for row in rows:
+                writer.writerow([label, row.date.isoformat() if row.date else '', row.amount if row.amount else '',
+                                 row.category if row.category else '', row.description if row.description else ''])
+        return output.getvalue().encode('utf-8-sig')
+    finally:
+        db.close()
+
+
+def measured(func) -> dict:
+    tracemalloc.reset_peak()
+    baseline = tracemalloc.get_traced_memory()[0]
+    start = time.perf_counter()
+    result = func()
+    result["seconds"] = time.perf_counter() - start
+    result["peak_mb"] = (tracemalloc.get_traced_memory()[1] - baseline) / 1024 / 1024
+    return result
+
+
+def stream(base_url: str, headers: dict, params: dict, gzip_encoding: bool, keep: bool) -> dict:
+    import httpx
+
+    headers = {**headers, "Accept-Encoding": "gzip" if gzip_encoding else "identity"}
+    body = io.BytesIO() if keep else None
+    sent = 0
+    first_byte = None
+    start = time.perf_counter()
+    with httpx.Client(base_url=base_url, timeout=600) as client:
+        with client.stream("GET", "/export/csv", headers=headers, params=params) as response:
+            response.raise_for_status()
+            encoding = response.headers.get("Content-Encoding", "identity")
+            for chunk in response.iter_raw():
+                if first_byte is None:
+                    first_byte = time.perf_counter() - start
+                sent += len(chunk)
+                if body is not None:
+                    body.write(chunk)
+    return {"bytes": sent, "ttfb_ms": (first_byte or 0) * 1000, "encoding": encoding,
+            "body": body.getvalue() if body is not None else None}
+
+
+def start_server(port: int):
+    import uvicorn
+    from main import app
+
+    server = uvicorn.Server(uvicorn.Config(app, host="127.0.0.1", port=port, log_level="warning"))
+    thread = threading.Thread(target=server.run, daemon=True)
+    thread.start()
+    while not server.started:
+        time.sleep(0.05)
+    return server, thread
+
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def run_benchmark(args) -> dict:
+    rng = random.Random(args.seed)
+    server, thread = start_server(free_port())
+    base_url = f"http://127.0.0.1:{server.config.port}"
+    result: dict = {"sizes": []}
+    try:
+        start = time.perf_counter()
+        users = [(max(1, args.rows // 10), seed(max(1, args.rows // 10), rng)), (args.rows, seed(args.rows, rng))]
+        result["seed_seconds"] = time.perf_counter() - start
+
+        first, last = date.today() - timedelta(days=6 * 365), date.today()
+        params = {"start_date": first.isoformat(), "end_date": last.isoformat()}
+        # Warm up (imports, first connection, statement compilation) outside the measurements
+        stream(base_url, users[0][1]["headers"], {"start_date": last.isoformat(), "end_date": last.isoformat()}, True, keep=False)
+        tracemalloc.start()
+        try:
+            for rows, user in users:
+                size = {"rows": rows}
+                size["old"] = measured(lambda: {"bytes": len(old_export(user["id"], first, last))})
+                size["stream"] = measured(lambda: stream(base_url, user["headers"], params, False, keep=False))
+                size["gzip"] = measured(lambda: stream(base_url, user["headers"], params, True, keep=False))
+                result["sizes"].append(size)
+        finally:
+            tracemalloc.stop()
+
+        # Correctness, untimed (the bodies are kept in memory here)
+        rows, user = users[0]
+        plain = stream(base_url, user["headers"], params, False, keep=True)["body"]
+        compressed = stream(base_url, user["headers"], params, True, keep=True)
+        result["check"] = {
+            "bom": plain.startswith(b"\xef\xbb\xbf"),
+            "rows": plain.count(b"\r\n") - 1 == rows,
+            "gzip": compressed["encoding"] == "gzip" and gzip.decompress(compressed["body"]) == plain,
+            "same_rows_as_old": sorted(plain.splitlines()) == sorted(old_export(user["id"], first, last).splitlines()),
+        }
+    finally:
+        server.should_exit = True
+        thread.join(timeout=30)
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description="CSV export benchmark")
+    parser.add_argument("--rows", type=int, default=1000000, help="expenses + income for the large user")
+    parser.add_argument("--database-url", help="run against this database instead of a scratch SQLite file")
+    parser.add_argument("--seed", type=int)
+    parser.add_argument("--verbose", dest="quiet", action="store_false", help="show the app's log output")
+    args = parser.parse_args()
+
+    os.environ.setdefault("PASSWORD_HASH_CALIBRATE", "false")
+    os.environ.setdefault("SCHEDULER_ENABLED", "false")
+    os.environ.setdefault("STRIPE_EVENTS_IN_PROCESS", "false")  # Its pollers only contend with the seeding here
+    if args.database_url:
+        os.environ["DATABASE_URL"] = args.database_url
+    else:
+        os.environ.pop("DATABASE_URL", None)
+        os.chdir(tempfile.mkdtemp(prefix="export-bench-"))
+
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull if args.quiet else sys.stdout):
+        result = run_benchmark(args)
+
+    print(f"Seeded in {result['seed_seconds']:.1f}s")
+    for size in result["sizes"]:
+        print()
+        print(f"{size['rows']} rows")
+        for name, label in (("old", "Old (in memory):"), ("stream", "Streamed:"), ("gzip", "Streamed, gzip:")):
+            run = size[name]
+            ttfb = f"  first byte {run['ttfb_ms']:.0f}ms" if "ttfb_ms" in run else ""
+            print(f"  {label:<17} {run['seconds']:6.2f}s  {run['bytes'] / 1024 / 1024:7.1f} MiB sent  "
+                  f"peak memory {run['peak_mb']:7.1f} MiB{ttfb}")
+    check = result["check"]
+    print()
+    print("Check:           " + "  ".join(f"{name}={ok}" for name, ok in check.items()))
+    sys.exit(0 if all(check.values()) else 1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,262 @@
+#!/usr/bin/env python3
+"""
+Notification feed benchmark for long-lived accounts.
+
+Runs the app in-process (httpx ASGI transport) on a scratch SQLite database
+in a temp directory (or DATABASE_URL with --database-url), seeds --users
+users with --per-user notifications each (mixed types, a share unread, many
+sharing a timestamp), then measures:
+
+- the first feed page, the unread-only page and a type-filtered page,
+- a full walk of one feed with next_cursor (per-page latency by depth, and a
+  check that every notification comes back exactly once, newest first),
+- the unread-count endpoint (a counter row) against the COUNT(*) it replaced,
+- mark-all-read, then that every counter reads 0, and
+- for comparison, loading a whole feed the way the unpaginated endpoint did.
+
+On SQLite it also prints the query plans, to show which index each query uses.
+
+    python benchmark_notifications.py --users 20 --per-user 10000
+    python benchmark_notifications.py --per-user 50000 --page-size 50
+"""
+import argparse
+import asyncio
+import contextlib
+import os
+import random
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+BACKEND_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, BACKEND_DIR)
+
+from benchmark_receipts import summarize_ms
+
+TYPES = ["payment_failed", "subscription_expired", "extra_scans_ended", "subscription_cancelled", "announcement"]
+
+
+def seed(users: int, per_user: int, unread_rate: float, rng: random.Random) -> list[dict]:
+    """Users with per_user notifications each over the last two years; returns {id, headers, unread}"""
+    from sqlalchemy import insert
+
+    from auth import create_access_token
+    from database import Notification, SessionLocal, User
+
+    stamp = int(time.time() * 1000)
+    db = SessionLocal()
+    try:
+        user_rows = [User(email=f"notify-{stamp}-{i}@example.com", password_hash="!", name="Benchmark") for i in range(users)]
+        db.add_all(user_rows)
+        db.commit()
+        seeded = []
+        now = datetime.utcnow()
+        for user in user_rows:
+            unread = 0
+            rows = []
+            for _ in range(per_user):
+                # Whole minutes, so plenty of notifications share a created_at and the id breaks the tie
+                created_at = now - timedelta(minutes=rng.randrange(2 * 365 * 24 * 60 // 10) * 10)
+                read = rng.random() >= unread_rate
+                unread += not read
+                rows.append({"user_id": user.id, "message": "Benchmark notification", "type": rng.choice(TYPES),
+                             "read": read, "created_at": created_at})
+            for start in range(0, len(rows), 5000):
+                db.execute(insert(Notification), rows[start:start + 5000])
+            db.commit()
+            seeded.append({
+                "id": user.id,
+                "headers": {"Authorization": f"Bearer {create_access_token({'sub': str(user.id)})}"},
+                "unread": unread,
+            })
+        return seeded
+    finally:
+        db.close()
+
+
+def query_plans(user_id: int) -> list[tuple[str, str]]:
+    from sqlalchemy import select, tuple_, update
+
+    from database import Notification, engine
+
+    newest = (Notification.created_at.desc(), Notification.id.desc())
+    cursor = tuple_(Notification.created_at, Notification.id) < tuple_(datetime.utcnow(), 10 ** 9)
+    queries = {
+        "first page": select(Notification).where(Notification.user_id == user_id).order_by(*newest).limit(21),
+        "next page": select(Notification).where(Notification.user_id == user_id, cursor).order_by(*newest).limit(21),
+        "unread page": select(Notification).where(
+            Notification.user_id == user_id, Notification.read == False, cursor
+        ).order_by(*newest).limit(21),
+        "type page": select(Notification).where(
+            Notification.user_id == user_id, Notification.type == TYPES[0], cursor
+        ).order_by(*newest).limit(21),
+        "mark all read": update(Notification).where(
+            Notification.user_id == user_id, Notification.read == False
+        ).values(read=True),
+    }
+    plans = []
+    with engine.connect() as conn:
+        for name, query in queries.items():
+            compiled = query.compile(engine)
+            rows = conn.exec_driver_sql(f"EXPLAIN QUERY PLAN {compiled}", tuple(compiled.construct_params().values())).fetchall()
+            plans.append((name, "; ".join(row[-1] for row in rows)))
+    return plans
+
+
+async def run_benchmark(args) -> dict:
+    import httpx
+    from main import app
+
+    from database import Notification, SessionLocal, analyze_sqlite, engine
+    from notification_service import get_unread_count, reconcile_unread_counters
+    from routes.notifications import notification_summary
+
+    rng = random.Random(args.seed)
+    result: dict = {}
+    async with app.router.lifespan_context(app):
+        started = time.perf_counter()
+        users = seed(args.users, args.per_user, args.unread_rate, rng)
+        analyze_sqlite()  # As init_db does when the app next starts on this data
+        reconcile_unread_counters()  # seed() bypasses notification_service, so count once
+        result["seed_seconds"] = time.perf_counter() - started
+
+        transport = httpx.ASGITransport(app=app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://bench", timeout=300) as client:
+
+            async def timed(method: str, url: str, headers: dict, **params):
+                start = time.perf_counter()
+                response = await client.request(method, url, headers=headers, params=params)
+                response.raise_for_status()
+                return response.json(), (time.perf_counter() - start) * 1000
+
+            for name, params in (
+                ("first_page", {}),
+                ("unread_page", {"unread": "true"}),
+                ("type_page", {"type": TYPES[0]}),
+            ):
+                latencies = []
+                for _ in range(args.repeat):
+                    for user in users:
+                        _, ms = await timed("GET", "/notifications", user["headers"], limit=args.page_size, **params)
+                        latencies.append(ms)
+                result[name] = latencies
+
+            # Walk one whole feed
+            walker = users[0]
+            seen, keys, page_ms = [], [], []
+            cursor = None
+            while True:
+                params = {"limit": args.page_size, **({"cursor": cursor} if cursor else {})}
+                page, ms = await timed("GET", "/notifications", walker["headers"], **params)
+                page_ms.append(ms)
+                seen.extend(item["id"] for item in page["items"])
+                keys.extend((item["created_at"], item["id"]) for item in page["items"])
+                cursor = page["next_cursor"]
+                if not cursor:
+                    break
+            result["walk"] = {
+                "pages": len(page_ms),
+                "page_ms": page_ms,
+                "complete": len(seen) == args.per_user and len(set(seen)) == len(seen),
+                "ordered": keys == sorted(keys, reverse=True),
+            }
+
+            count_ms, count_mismatched = [], 0
+            for _ in range(args.repeat):
+                for user in users:
+                    body, ms = await timed("GET", "/notifications/unread-count", user["headers"])
+                    count_ms.append(ms)
+                    count_mismatched += body["unread_count"] != user["unread"]
+            result["unread_count"] = count_ms
+            result["unread_count_mismatched"] = count_mismatched
+
+            # The old endpoints: every notification serialized in one response, and a COUNT(*) per poll
+            db = SessionLocal()
+            try:
+                start = time.perf_counter()
+                everything = [notification_summary(n) for n in db.query(Notification).filter(
+                    Notification.user_id == walker["id"]
+                ).order_by(Notification.created_at.desc()).all()]
+                result["unpaginated_ms"] = (time.perf_counter() - start) * 1000
+                result["unpaginated_items"] = len(everything)
+
+                count_query_ms, counter_ms = [], []
+                for _ in range(args.repeat):
+                    for user in users:
+                        start = time.perf_counter()
+                        db.query(Notification).filter(Notification.user_id == user["id"], Notification.read == False).count()
+                        count_query_ms.append((time.perf_counter() - start) * 1000)
+                        start = time.perf_counter()
+                        get_unread_count(db, user["id"])
+                        counter_ms.append((time.perf_counter() - start) * 1000)
+                result["count_query"] = count_query_ms
+                result["counter_lookup"] = counter_ms
+            finally:
+                db.close()
+
+            if args.plans and engine.dialect.name == "sqlite":
+                result["plans"] = query_plans(users[-1]["id"])
+
+            mark_ms, mismatched = [], 0
+            for user in users:
+                body, ms = await timed("POST", "/notifications/mark-all-read", user["headers"])
+                mark_ms.append(ms)
+                mismatched += body["updated"] != user["unread"]
+                body, _ = await timed("GET", "/notifications/unread-count", user["headers"])
+                mismatched += body["unread_count"] != 0
+            result["mark_all_read"] = mark_ms
+            result["mark_all_read_mismatched"] = mismatched
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Notification feed benchmark")
+    parser.add_argument("--users", type=int, default=20)
+    parser.add_argument("--per-user", type=int, default=10000, help="notifications per user")
+    parser.add_argument("--unread-rate", type=float, default=0.2)
+    parser.add_argument("--page-size", type=int, default=20)
+    parser.add_argument("--repeat", type=int, default=5, help="page requests per user and scenario")
+    parser.add_argument("--no-plans", dest="plans", action="store_false", help="skip the SQLite query plans")
+    parser.add_argument("--database-url", help="run against this database instead of a scratch SQLite file")
+    parser.add_argument("--seed", type=int)
+    parser.add_argument("--verbose", dest="quiet", action="store_false", help="show the app's log output")
+    args = parser.parse_args()
+
+    os.environ.setdefault("PASSWORD_HASH_CALIBRATE", "false")
+    os.environ.setdefault("SCHEDULER_ENABLED", "false")
+    if args.database_url:
+        os.environ["DATABASE_URL"] = args.database_url
+    else:
+        os.environ.pop("DATABASE_URL", None)
+        os.chdir(tempfile.mkdtemp(prefix="notifications-bench-"))
+
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull if args.quiet else sys.stdout):
+        result = asyncio.run(run_benchmark(args))
+
+    walk = result["walk"]
+    page_ms = walk["page_ms"]
+    tenth = max(1, len(page_ms) // 10)
+    print(f"Users: {args.users}  notifications per user: {args.per_user}  page size: {args.page_size}  "
+          f"(seeded in {result['seed_seconds']:.1f}s)")
+    print()
+    print(f"First page:      {summarize_ms(result['first_page'])}")
+    print(f"Unread page:     {summarize_ms(result['unread_page'])}")
+    print(f"Type page:       {summarize_ms(result['type_page'])}")
+    print(f"Full walk:       {walk['pages']} pages  first 10%: {summarize_ms(page_ms[:tenth])}  "
+          f"last 10%: {summarize_ms(page_ms[-tenth:])}")
+    print(f"                 complete={walk['complete']} ordered={walk['ordered']}")
+    print(f"Unpaginated:     {result['unpaginated_items']} items in {result['unpaginated_ms']:.1f}ms (the old endpoint's query + serialization)")
+    print(f"Unread count:    {summarize_ms(result['unread_count'])}  wrong counts: {result['unread_count_mismatched']}")
+    print(f"                 query alone: counter {summarize_ms(result['counter_lookup'])}  "
+          f"old COUNT(*) {summarize_ms(result['count_query'])}")
+    print(f"Mark all read:   {summarize_ms(result['mark_all_read'])}  wrong counts: {result['mark_all_read_mismatched']}")
+    for name, plan in result.get("plans", []):
+        print(f"Plan {name + ':':<15} {plan}")
+    ok = (walk["complete"] and walk["ordered"]
+          and not result["unread_count_mismatched"] and not result["mark_all_read_mismatched"])
+    sys.exit(0 if ok else 1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,282 @@
+#!/usr/bin/env python3
+"""
+End-to-end receipt pipeline benchmark against fake_openai_server.
+
+Runs the app in-process (httpx ASGI transport) on a throwaway SQLite database
+in a temp directory, with OPENAI_BASE_URL pointed at the fake server started
+in a background thread. Nothing leaves the machine and no OpenAI credits are
+spent. Reports throughput, request latency, event-loop lag during the run and
+the per-call cost of validate_extraction (tax reconciliation and category
+validation).
+
+    python benchmark_receipts.py --mode scan --requests 200 --concurrency 20
+    python benchmark_receipts.py --mode batch --batch-size 10 --latency-ms 1500
+    python benchmark_receipts.py --mode jobs --error-rate 0.05
+
+Modes: scan (/receipts/scan), upload (/receipts/scan/upload), batch
+(/receipts/scan/batch) and jobs (/receipts/jobs, polled until done).
+"""
+import argparse
+import asyncio
+import base64
+import contextlib
+import io
+import json
+import os
+import statistics
+import sys
+import tempfile
+import time
+
+BACKEND_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, BACKEND_DIR)
+
+import fake_openai_server
+
+
+def percentile(sorted_values: list, p: float):
+    if not sorted_values:
+        return None
+    rank = max(1, round(p / 100 * len(sorted_values)))
+    return sorted_values[min(rank, len(sorted_values)) - 1]
+
+
+def summarize_ms(values: list) -> str:
+    values = sorted(values)
+    if not values:
+        return "n/a"
+    return (
+        f"p50={percentile(values, 50):.1f}ms p90={percentile(values, 90):.1f}ms "
+        f"p99={percentile(values, 99):.1f}ms max={values[-1]:.1f}ms"
+    )
+
+
+def make_receipt_image(seed: int) -> bytes:
+    """A distinct receipt-like JPEG per seed, so the extraction cache never hits"""
+    from PIL import Image, ImageDraw
+
+    image = Image.new("RGB", (1200, 1800), "white")
+    draw = ImageDraw.Draw(image)
+    for line in range(40):
+        width = 200 + (seed * 37 + line * 91) % 800
+        draw.rectangle([100, 80 + line * 40, 100 + width, 100 + line * 40], fill="black")
+    draw.text((100, 1700), f"receipt {seed}", fill="black")
+    buffer = io.BytesIO()
+    image.save(buffer, format="JPEG", quality=85)
+    return buffer.getvalue()
+
+
+class LoopLagMonitor:
+    """Measures how late a 10 ms sleep wakes up while the benchmark runs"""
+
+    def __init__(self, interval: float = 0.01):
+        self.interval = interval
+        self.lags_ms: list[float] = []
+        self._task = None
+
+    async def _run(self):
+        while True:
+            start = time.perf_counter()
+            await asyncio.sleep(self.interval)
+            self.lags_ms.append(max(0.0, (time.perf_counter() - start - self.interval) * 1000))
+
+    def start(self):
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        self._task.cancel()
+        await asyncio.gather(self._task, return_exceptions=True)
+
+
+async def create_user(client, db_session_factory) -> dict:
+    """Sign up a benchmark user on an unlimited plan; returns auth headers"""
+    from database import Subscription, SubscriptionPlanType, SubscriptionStatus, User
+    from datetime import datetime, timedelta
+
+    email = f"bench-{int(time.time() * 1000)}@example.com"
+    response = await client.post("/signup", json={"email": email, "password": "Benchmark-password-1", "name": "Benchmark"})
+    response.raise_for_status()
+    headers = {"Authorization": f"Bearer {response.json()['access_token']}"}
+
+    db = db_session_factory()
+    try:
+        user = db.query(User).filter(User.email == email).first()
+        db.add(Subscription(
+            user_id=user.id,
+            plan_type=SubscriptionPlanType.UNLIMITED.value,
+            status=SubscriptionStatus.ACTIVE.value,
+            current_period_start=datetime.utcnow(),
+            current_period_end=datetime.utcnow() + timedelta(days=30)
+        ))
+        db.commit()
+    finally:
+        db.close()
+    return headers
+
+
+async def run_scan(client, headers, images: list[bytes]) -> int:
+    image = images[0]
+    response = await client.post("/receipts/scan", headers=headers, json={
+        "image_base64": base64.b64encode(image).decode(),
+        "language": "en"
+    })
+    return int(response.status_code == 200)
+
+
+async def run_upload(client, headers, images: list[bytes]) -> int:
+    response = await client.post(
+        "/receipts/scan/upload",
+        headers={**headers, "Content-Type": "image/jpeg"},
+        content=images[0]
+    )
+    return int(response.status_code == 200)
+
+
+async def run_job(client, headers, images: list[bytes]) -> int:
+    image = images[0]
+    response = await client.post("/receipts/jobs", headers=headers, json={
+        "image_base64": base64.b64encode(image).decode(),
+        "language": "en"
+    })
+    if response.status_code != 202:
+        return 0
+    job = response.json()
+    while job["status"] not in ("succeeded", "failed", "dead"):
+        response = await client.get(f"/receipts/jobs/{job['job_id']}?wait=10", headers=headers)
+        job = response.json()
+    return int(job["status"] == "succeeded")
+
+
+async def run_batch(client, headers, images: list[bytes]) -> int:
+    response = await client.post("/receipts/scan/batch", headers=headers, json={
+        "images_base64": [base64.b64encode(image).decode() for image in images],
+        "language": "en"
+    })
+    lines = [json.loads(line) for line in response.text.splitlines() if line]
+    return sum(1 for line in lines if line.get("success"))
+
+
+def benchmark_validation(iterations: int) -> dict:
+    """Microseconds per validate_extraction call on the fake server's canned payloads"""
+    from receipt_extraction import validate_extraction
+
+    results = {}
+    for name, payload in (("store", fake_openai_server.STORE_RESULT), ("utility", fake_openai_server.UTILITY_RESULT)):
+        with contextlib.redirect_stdout(io.StringIO()):
+            start = time.perf_counter()
+            for _ in range(iterations):
+                validate_extraction(payload)
+            elapsed = time.perf_counter() - start
+        results[name] = elapsed / iterations * 1_000_000
+    return results
+
+
+async def run_benchmark(args) -> dict:
+    import httpx
+    from main import app
+    from database import SessionLocal
+
+    runners = {
+        "scan": run_scan,
+        "upload": run_upload,
+        "jobs": run_job,
+        "batch": run_batch,
+    }
+    runner = runners[args.mode]
+
+    per_request = args.batch_size if args.mode == "batch" else 1
+    image_groups = [
+        [make_receipt_image(request * per_request + i) for i in range(per_request)]
+        for request in range(args.requests)
+    ]
+    latencies_ms: list[float] = []
+    succeeded = 0
+    receipts = 0
+    semaphore = asyncio.Semaphore(args.concurrency)
+
+    async with app.router.lifespan_context(app):
+        transport = httpx.ASGITransport(app=app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://bench", timeout=300) as client:
+            headers = await create_user(client, SessionLocal)
+            async with httpx.AsyncClient(base_url=f"http://127.0.0.1:{args.fake_port}") as fake:
+                await fake.delete("/requests")
+
+                async def one(images: list[bytes]):
+                    nonlocal succeeded, receipts
+                    async with semaphore:
+                        start = time.perf_counter()
+                        outcome = await runner(client, headers, images)
+                        latencies_ms.append((time.perf_counter() - start) * 1000)
+                    succeeded += outcome
+                    receipts += len(images)
+
+                monitor = LoopLagMonitor()
+                monitor.start()
+                started = time.perf_counter()
+                await asyncio.gather(*(one(images) for images in image_groups))
+                elapsed = time.perf_counter() - started
+                await monitor.stop()
+
+                fake_stats = (await fake.get("/stats")).json()
+
+    return {
+        "elapsed": elapsed,
+        "requests": len(image_groups),
+        "receipts": receipts,
+        "succeeded": succeeded,
+        "latencies_ms": latencies_ms,
+        "loop_lag_ms": monitor.lags_ms,
+        "fake_stats": fake_stats,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Receipt pipeline benchmark against a local fake OpenAI server")
+    parser.add_argument("--mode", choices=["scan", "upload", "batch", "jobs"], default="scan")
+    parser.add_argument("--requests", type=int, default=100, help="HTTP requests to send (batches count once)")
+    parser.add_argument("--concurrency", type=int, default=10, help="requests in flight at once")
+    parser.add_argument("--batch-size", type=int, default=5, help="receipts per request in batch mode")
+    parser.add_argument("--fake-port", type=int, default=8799)
+    parser.add_argument("--validation-iterations", type=int, default=20000)
+    parser.add_argument("--verbose", dest="quiet", action="store_false", help="show the app's log output")
+    fake_openai_server.add_arguments(parser)
+    args = parser.parse_args()
+
+    # The app reads its settings at import time: point it at the fake server and a scratch database first
+    os.environ["OPENAI_BASE_URL"] = f"http://127.0.0.1:{args.fake_port}/v1"
+    os.environ["OPENAI_API_KEY"] = "sk-fake"
+    os.environ.setdefault("PASSWORD_HASH_CALIBRATE", "false")
+    os.environ.setdefault("SCHEDULER_ENABLED", "false")
+    os.environ.pop("DATABASE_URL", None)
+    workdir = tempfile.mkdtemp(prefix="receipt-bench-")
+    os.chdir(workdir)
+
+    fake_openai_server.configure_from_args(args)
+    fake_openai_server.start_in_thread(args.fake_port)
+
+    # The pipeline logs every extraction with print: keep it off the terminal unless asked
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull if args.quiet else sys.stdout):
+        validation_us = benchmark_validation(args.validation_iterations)
+        result = asyncio.run(run_benchmark(args))
+
+    config = fake_openai_server.config
+    print(f"Mode: {args.mode}  requests: {result['requests']}  concurrency: {args.concurrency}")
+    print(f"Fake OpenAI latency: {config.latency_ms:.0f}±{config.latency_jitter_ms:.0f}ms  "
+          f"errors: {config.error_rate:.0%}  429s: {config.rate_limit_rate:.0%}  bad JSON: {config.bad_json_rate:.0%}")
+    print(f"Database: {workdir}/expenses.db")
+    print()
+    print(f"Elapsed:     {result['elapsed']:.2f}s")
+    print(f"Throughput:  {result['requests'] / result['elapsed']:.1f} req/s, "
+          f"{result['receipts'] / result['elapsed']:.1f} receipts/s")
+    print(f"Succeeded:   {result['succeeded']}/{result['receipts']} receipts")
+    print(f"Latency:     {summarize_ms(result['latencies_ms'])}")
+    print(f"Loop lag:    {summarize_ms(result['loop_lag_ms'])} "
+          f"(mean {statistics.fmean(result['loop_lag_ms'] or [0]):.2f}ms)")
+    print(f"Validation:  store {validation_us['store']:.1f}us/call, utility {validation_us['utility']:.1f}us/call")
+    stats = result["fake_stats"]
+    print(f"Model calls: {stats['requests']}  by status {stats['by_status']}  by model {stats['by_model']}  by detail {stats['by_detail']}  "
+          f"avg image {stats['image_bytes'] // max(stats['requests'], 1)} bytes")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,4 +1,4 @@
-from sqlalchemy import create_engine, Column, Integer, String, Float, Date, DateTime, ForeignKey, Boolean, Enum as SQLEnum
+from sqlalchemy import create_engine, cast, func, inspect, literal, select, text, Column, Integer, String, Text, Float, Date, DateTime, ForeignKey, Boolean, LargeBinary, Index, UniqueConstraint, Enum as SQLEnum
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker, relationship
 from datetime import datetime
@@ -55,6 +55,7 @@ class User(Base):
     created_at = Column(DateTime, default=datetime.utcnow)
     reset_token = Column(String, nullable=True)
     reset_token_expires = Column(DateTime, nullable=True)
+    deleted_at = Column(DateTime, nullable=True)  # Set when account deletion is requested
 
     expenses = relationship("Expense", back_populates="owner")
     incomes = relationship("Income", back_populates="owner")
@@ -65,6 +66,8 @@ class User(Base):
 
 class Expense(Base):
     __tablename__ = "expenses"
+    # Per-user date ranges, newest first (export streams in this order without a sort)
+    __table_args__ = (Index("ix_expenses_user_date_id", "user_id", "date", "id"),)
 
     id = Column(Integer, primary_key=True, index=True)
     user_id = Column(Integer, ForeignKey("users.id"), nullable=False)
@@ -79,6 +82,8 @@ class Expense(Base):
 
 class Income(Base):
     __tablename__ = "incomes"
+    # Per-user date ranges, newest first (export streams in this order without a sort)
+    __table_args__ = (Index("ix_incomes_user_date_id", "user_id", "date", "id"),)
 
     id = Column(Integer, primary_key=True, index=True)
     user_id = Column(Integer, ForeignKey("users.id"), nullable=False)
@@ -93,6 +98,8 @@ class Income(Base):
 
 class Subscription(Base):
     __tablename__ = "subscriptions"
+    # subscription_lifecycle finds ended plans by type and period end
+    __table_args__ = (Index("ix_subscriptions_plan_period_end", "plan_type", "current_period_end"),)
 
     id = Column(Integer, primary_key=True, index=True)
     user_id = Column(Integer, ForeignKey("users.id"), nullable=False, unique=True)
@@ -103,6 +110,7 @@ class Subscription(Base):
     promo_code_id = Column(Integer, ForeignKey("promo_codes.id"), nullable=True)
     current_period_start = Column(DateTime, nullable=True)
     current_period_end = Column(DateTime, nullable=True)
+    period_synced_at = Column(DateTime, nullable=True)  # When the period was last taken from Stripe; only then does the sweeper expire it
     created_at = Column(DateTime, default=datetime.utcnow)
     updated_at = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
 
@@ -112,6 +120,7 @@ class Subscription(Base):
 
 class ReceiptScan(Base):
     __tablename__ = "receipt_scans"
+    __table_args__ = (Index("ix_receipt_scans_user_id_id", "user_id", "id"),)
 
     id = Column(Integer, primary_key=True, index=True)
     user_id = Column(Integer, ForeignKey("users.id"), nullable=False)
@@ -120,19 +129,191 @@ class ReceiptScan(Base):
     created_at = Column(DateTime, default=datetime.utcnow)
 
     user = relationship("User", back_populates="receipt_scans")
+    result = relationship("ReceiptScanResult", back_populates="scan", uselist=False)
+
+
+class ReceiptScanResult(Base):
+    __tablename__ = "receipt_scan_results"
+
+    id = Column(Integer, primary_key=True, index=True)
+    scan_id = Column(Integer, ForeignKey("receipt_scans.id"), nullable=False, unique=True)
+    user_id = Column(Integer, ForeignKey("users.id"), nullable=False, index=True)
+    receipt_type = Column(String, nullable=True)
+    merchant = Column(String, nullable=True)
+    data = Column(Text, nullable=False)  # Extracted JSON, same shape as /receipts/scan "data"
+    created_at = Column(DateTime, default=datetime.utcnow, index=True)
+
+    scan = relationship("ReceiptScan", back_populates="result")
+
+
+class ScanUsage(Base):
+    __tablename__ = "scan_usage"
+    __table_args__ = (UniqueConstraint("user_id", "month", name="uq_scan_usage_user_month"),)
+
+    id = Column(Integer, primary_key=True, index=True)
+    user_id = Column(Integer, ForeignKey("users.id"), nullable=False, index=True)
+    month = Column(String, nullable=False)  # Format: 'YYYY-MM'
+    used = Column(Integer, nullable=False, default=0)  # Scans reserved this month (refunded on failure)
+    updated_at = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+
+
+class ReceiptCacheEntry(Base):
+    __tablename__ = "receipt_cache"
+    __table_args__ = (UniqueConstraint("user_id", "cache_key", name="uq_receipt_cache_user_key"),)
+
+    id = Column(Integer, primary_key=True, index=True)
+    user_id = Column(Integer, ForeignKey("users.id"), nullable=False, index=True)
+    cache_key = Column(String, nullable=False)  # sha256 of the prepared image + language
+    language = Column(String, nullable=False)
+    data = Column(Text, nullable=False)  # Extracted JSON returned by /receipts/scan
+    hits = Column(Integer, nullable=False, default=0)
+    created_at = Column(DateTime, default=datetime.utcnow, index=True)
+
+
+class MerchantCategory(Base):
+    __tablename__ = "merchant_categories"
+    __table_args__ = (UniqueConstraint("user_id", "merchant", "pattern", name="uq_merchant_category_user_pattern"),)
+
+    id = Column(Integer, primary_key=True, index=True)
+    user_id = Column(Integer, ForeignKey("users.id"), nullable=False, index=True)
+    merchant = Column(String, nullable=False)  # Normalized merchant name
+    pattern = Column(String, nullable=False, default="")  # Normalized item description; "" = whole bill
+    category = Column(String, nullable=False)
+    merchant_name = Column(String, nullable=True)  # Merchant as last shown to the user
+    confirmations = Column(Integer, nullable=False, default=0)  # Times confirmed via /expenses/batch
+    layout_hash = Column(String, nullable=True)  # layout_fingerprint of the last bill (whole-bill rows)
+    updated_at = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+
+
+class ModelCall(Base):
+    __tablename__ = "model_calls"
+
+    id = Column(Integer, primary_key=True, index=True)
+    user_id = Column(Integer, nullable=True, index=True)  # No FK: rows are written in batches, possibly after the user is gone
+    created_at = Column(DateTime, default=datetime.utcnow, index=True)
+    model = Column(String, nullable=False)
+    prompt = Column(String, nullable=False, default="full")  # 'full', 'biller' (short known-biller prompt), or routed: 'classify', 'store', 'utility'
+    language = Column(String, nullable=True)
+    receipt_type = Column(String, nullable=True)  # 'utility' / 'store'; null when the call failed
+    image_bytes = Column(Integer, nullable=True)  # Size of the image sent to the model
+    latency_ms = Column(Float, nullable=False)
+    prompt_tokens = Column(Integer, nullable=False, default=0)
+    completion_tokens = Column(Integer, nullable=False, default=0)
+    cost_usd = Column(Float, nullable=False, default=0)
+    outcome = Column(String, nullable=False)  # 'ok', 'api_error', 'parse_error'
+
+
+class ReceiptJobStatus(str, enum.Enum):
+    QUEUED = "queued"
+    RUNNING = "running"
+    SUCCEEDED = "succeeded"
+    FAILED = "failed"  # Non-retryable error (e.g. invalid image)
+    DEAD = "dead"  # Retries exhausted
+
+
+class ReceiptJob(Base):
+    __tablename__ = "receipt_jobs"
+    __table_args__ = (Index("ix_receipt_jobs_status_next_attempt", "status", "next_attempt_at"),)
+
+    id = Column(Integer, primary_key=True, index=True)
+    user_id = Column(Integer, ForeignKey("users.id"), nullable=False, index=True)
+    status = Column(String, nullable=False, default="queued")  # 'queued', 'running', 'succeeded', 'failed', 'dead'
+    language = Column(String, nullable=False, default="en")
+    image = Column(LargeBinary, nullable=True)  # Preprocessed JPEG, cleared once the job finishes
+    cache_key = Column(String, nullable=True)
+    quota_month = Column(String, nullable=True)  # scan_usage month reserved at enqueue; refunded if the job fails
+    scan_id = Column(Integer, nullable=True)  # receipt_scans row saved when the job succeeded
+    result = Column(Text, nullable=True)  # Extracted JSON, same shape as /receipts/scan "data"
+    error = Column(String, nullable=True)
+    error_status = Column(Integer, nullable=True)
+    attempts = Column(Integer, nullable=False, default=0)
+    next_attempt_at = Column(DateTime, default=datetime.utcnow)
+    locked_by = Column(String, nullable=True)
+    locked_at = Column(DateTime, nullable=True)
+    created_at = Column(DateTime, default=datetime.utcnow)
+    completed_at = Column(DateTime, nullable=True)
+
+
+class StripeEventStatus(str, enum.Enum):
+    QUEUED = "queued"
+    RUNNING = "running"
+    PROCESSED = "processed"
+    FAILED = "failed"  # Non-retryable error (e.g. unknown user)
+    DEAD = "dead"  # Retries exhausted
+
+
+class StripeEvent(Base):
+    __tablename__ = "stripe_events"
+    __table_args__ = (Index("ix_stripe_events_status_next_attempt", "status", "next_attempt_at"),)
+
+    id = Column(Integer, primary_key=True, index=True)
+    event_id = Column(String, nullable=False, unique=True)  # Stripe's evt_... id: redeliveries are dropped
+    type = Column(String, nullable=False)
+    customer_key = Column(String, nullable=False, index=True)  # Events with the same key are processed in order
+    stripe_created = Column(Integer, nullable=False)  # Stripe's event.created (unix seconds), the processing order
+    payload = Column(Text, nullable=False)  # Verified event JSON as received
+    status = Column(String, nullable=False, default="queued")  # 'queued', 'running', 'processed', 'failed', 'dead'
+    attempts = Column(Integer, nullable=False, default=0)
+    next_attempt_at = Column(DateTime, default=datetime.utcnow)
+    locked_by = Column(String, nullable=True)
+    locked_at = Column(DateTime, nullable=True)
+    error = Column(String, nullable=True)
+    received_at = Column(DateTime, default=datetime.utcnow)
+    processed_at = Column(DateTime, nullable=True)
 
 
 class Notification(Base):
     __tablename__ = "notifications"
+    __table_args__ = (
+        # Feed pages: newest first, keyset on (created_at, id)
+        Index("ix_notifications_user_created_id", "user_id", "created_at", "id"),
+        # Unread only: the unread feed, unread count and mark-all-read never touch read rows
+        Index(
+            "ix_notifications_user_unread", "user_id", "created_at", "id",
+            postgresql_where=text("read = false"), sqlite_where=text("read = 0")
+        ),
+        # Broadcast deliveries by template (ordinary notifications aren't indexed here)
+        Index(
+            "ix_notifications_template_id", "template_id",
+            postgresql_where=text("template_id IS NOT NULL"), sqlite_where=text("template_id IS NOT NULL")
+        ),
+    )
 
     id = Column(Integer, primary_key=True, index=True)
     user_id = Column(Integer, ForeignKey("users.id"), nullable=False, index=True)
-    message = Column(String, nullable=False)
+    message = Column(String, nullable=False)  # '' for broadcast deliveries: the text is on the template
     type = Column(String, nullable=False)  # 'payment_failed', 'subscription_cancelled', etc.
     read = Column(Boolean, default=False, nullable=False)
     created_at = Column(DateTime, default=datetime.utcnow, nullable=False)
+    template_id = Column(Integer, ForeignKey("notification_templates.id"), nullable=True)
 
     user = relationship("User", back_populates="notifications")
+    template = relationship("NotificationTemplate")
+
+
+class NotificationTemplate(Base):
+    """One broadcast's text; users receive it as notifications rows pointing here"""
+    __tablename__ = "notification_templates"
+
+    id = Column(Integer, primary_key=True, index=True)
+    type = Column(String, nullable=False)  # 'announcement', 'maintenance', etc.
+    message = Column(String, nullable=False)
+    audience = Column(String, nullable=False)  # 'all' or 'plan:<plan_type>'
+    all_users = Column(Boolean, default=False, nullable=False)  # Delivered lazily, when each user next reads
+    recipients = Column(Integer, nullable=False, default=0)  # Delivery rows written when sending
+    sent_through_user_id = Column(Integer, nullable=True)  # Sending progress (users are sent in id order)
+    completed_at = Column(DateTime, nullable=True)
+    expires_at = Column(DateTime, nullable=True)  # Lazy broadcasts aren't delivered after this
+    created_at = Column(DateTime, default=datetime.utcnow, nullable=False)
+
+
+class NotificationCounter(Base):
+    __tablename__ = "notification_counters"
+
+    user_id = Column(Integer, ForeignKey("users.id"), primary_key=True)
+    unread = Column(Integer, nullable=False, default=0)  # Kept in step by notification_service, repaired by its reconcile job
+    broadcast_seen_id = Column(Integer, nullable=True)  # Last all-user broadcast delivered to this user
+    updated_at = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
 
 
 class PromoCode(Base):
@@ -150,15 +331,152 @@ class PromoCode(Base):
     subscriptions = relationship("Subscription", back_populates="promo_code")
 
 
+class PromoRedemption(Base):
+    __tablename__ = "promo_redemptions"
+    __table_args__ = (UniqueConstraint("user_id", "promo_code_id", name="uq_promo_redemptions_user_code"),)
+
+    id = Column(Integer, primary_key=True, index=True)
+    user_id = Column(Integer, ForeignKey("users.id"), nullable=False)
+    promo_code_id = Column(Integer, ForeignKey("promo_codes.id"), nullable=False, index=True)
+    redeemed_at = Column(DateTime, default=datetime.utcnow, nullable=False)
+
+
+class AccountDeletionStatus(str, enum.Enum):
+    PENDING = "pending"
+    RUNNING = "running"
+    COMPLETED = "completed"
+    FAILED = "failed"
+
+
+class AccountDeletion(Base):
+    __tablename__ = "account_deletions"
+
+    id = Column(Integer, primary_key=True, index=True)
+    user_id = Column(Integer, nullable=False, index=True)  # No FK: the user row is purged last
+    status = Column(String, nullable=False, default="pending")  # 'pending', 'running', 'completed', 'failed'
+    current_table = Column(String, nullable=True)
+    rows_deleted = Column(Integer, nullable=False, default=0)
+    attempts = Column(Integer, nullable=False, default=0)
+    last_error = Column(String, nullable=True)
+    locked_by = Column(String, nullable=True)  # Purger holding the lease
+    locked_at = Column(DateTime, nullable=True)  # Renewed after every chunk
+    created_at = Column(DateTime, default=datetime.utcnow)
+    updated_at = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+    completed_at = Column(DateTime, nullable=True)
+
+
+def add_missing_columns():
+    """Add nullable columns introduced after a table was first created.
+
+    create_all() only creates missing tables, so new columns on existing
+    tables are added here with a plain ALTER TABLE.
+    """
+    inspector = inspect(engine)
+    existing_tables = inspector.get_table_names()
+    with engine.begin() as conn:
+        for table in Base.metadata.sorted_tables:
+            if table.name not in existing_tables:
+                continue
+            existing_columns = {c["name"] for c in inspector.get_columns(table.name)}
+            for column in table.columns:
+                if column.name in existing_columns or not column.nullable:
+                    continue
+                column_type = column.type.compile(dialect=engine.dialect)
+                conn.execute(text(f'ALTER TABLE {table.name} ADD COLUMN {column.name} {column_type}'))
+                print(f"Added column {table.name}.{column.name}")
+
+
+def add_missing_indexes():
+    """Create indexes added to tables that already existed (create_all() skips those tables)"""
+    inspector = inspect(engine)
+    existing_tables = inspector.get_table_names()
+    with engine.begin() as conn:
+        for table in Base.metadata.sorted_tables:
+            if table.name not in existing_tables:
+                continue
+            existing_indexes = {index["name"] for index in inspector.get_indexes(table.name)}
+            for index in table.indexes:
+                if index.name not in existing_indexes:
+                    index.create(conn)
+                    print(f"Added index {index.name}")
+
+
+def analyze_sqlite():
+    """Refresh SQLite's planner statistics (Postgres's autovacuum keeps its own).
+
+    Without them SQLite can't tell that a partial index such as
+    ix_notifications_user_unread is much smaller than ix_notifications_user_id.
+    A full ANALYZE takes tens of milliseconds per 100k rows; sampled
+    statistics (analysis_limit) are too coarse to tell those two apart.
+    """
+    if DATABASE_URL:
+        return
+    with engine.begin() as conn:
+        conn.execute(text("ANALYZE"))
+
+
+def backfill_promo_redemptions():
+    """Record redemptions made before promo_redemptions existed (the subscription's promo_code_id)"""
+    with engine.begin() as conn:
+        result = conn.execute(
+            PromoRedemption.__table__.insert().from_select(
+                ["user_id", "promo_code_id", "redeemed_at"],
+                select(
+                    Subscription.user_id,
+                    Subscription.promo_code_id,
+                    func.coalesce(Subscription.updated_at, Subscription.created_at, func.current_timestamp())
+                ).where(Subscription.promo_code_id.isnot(None))
+            )
+        )
+        if result.rowcount:
+            print(f"Backfilled {result.rowcount} promo redemptions")
+
+
+def backfill_notification_counters():
+    """Count unread notifications per user for the counters table when it is first created"""
+    with engine.begin() as conn:
+        result = conn.execute(
+            NotificationCounter.__table__.insert().from_select(
+                ["user_id", "unread", "updated_at"],
+                select(Notification.user_id, func.count(Notification.id), func.current_timestamp())
+                .where(Notification.read == False)
+                .group_by(Notification.user_id)
+            )
+        )
+        if result.rowcount:
+            print(f"Backfilled unread counters for {result.rowcount} users")
+
+
+def release_deleted_identifiers():
+    """Free the email and username of users deleted before mark_user_deleted started doing it"""
+    with engine.begin() as conn:
+        result = conn.execute(
+            User.__table__.update()
+            .where(User.deleted_at.isnot(None), ~User.email.like("deleted-%@deleted.invalid"))
+            .values(email=literal("deleted-") + cast(User.id, String) + literal("@deleted.invalid"), username=None)
+        )
+        if result.rowcount:
+            print(f"Released the email and username of {result.rowcount} deleted users")
+
+
 # Create tables
 def init_db():
+    new_tables = set(Base.metadata.tables) - set(inspect(engine).get_table_names())
     Base.metadata.create_all(bind=engine)
+    add_missing_columns()
+    add_missing_indexes()
+    analyze_sqlite()
+    if "promo_redemptions" in new_tables:
+        backfill_promo_redemptions()
+    if "notification_counters" in new_tables:
+        backfill_notification_counters()
+    release_deleted_identifiers()
     
     # Create subscriptions for existing users who don't have one
     db = SessionLocal()
     try:
-        # Get all users
-        all_users = db.query(User).all()
+        # Get all users (not those pending deletion: their subscription is being purged)
+        all_users = db.query(User).filter(User.deleted_at.is_(None)).all()
         
         # For each user, check if they have a subscription
         for user in all_users:
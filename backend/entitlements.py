@@ -0,0 +1,210 @@
+"""
+What a user's plan entitles them to: plan type, monthly scan limit and the
+scans left this month.
+
+/subscription/status, /subscription/usage and every receipt scan need the
+same answer, so it is resolved once and cached twice:
+
+- per request: in the SQLAlchemy session's info dict (get_db hands every
+  request its own session), and
+- per process: an LRU of plain Entitlement values refreshed after
+  ENTITLEMENT_CACHE_TTL_SECONDS.
+
+Anything that changes a subscription (Stripe events, promo codes) calls
+invalidate_entitlement(db, user_id); the cached value is dropped right away
+and again once the session commits, so a reader can't re-cache the row as it
+was before the commit. Other worker processes (and a standalone
+stripe_worker) rely on the TTL. Used scans are never cached: they come from
+the scan_usage counter on every call.
+"""
+import os
+import threading
+import time
+from collections import OrderedDict
+from dataclasses import dataclass
+from datetime import datetime, timedelta
+from typing import Optional
+
+from sqlalchemy import event
+from sqlalchemy.dialects.postgresql import insert as postgresql_insert
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlalchemy.orm import Session
+
+from database import SessionLocal, Subscription, SubscriptionPlanType, SubscriptionStatus
+from scan_quota import get_scans_used
+import metrics
+
+ENTITLEMENT_CACHE_TTL_SECONDS = float(os.getenv("ENTITLEMENT_CACHE_TTL_SECONDS", "30"))
+ENTITLEMENT_CACHE_MAX_USERS = int(os.getenv("ENTITLEMENT_CACHE_MAX_USERS", "10000"))
+
+BASE_SCAN_LIMIT = 10
+EXTRA_SCANS = 30
+
+# Monthly scans per plan; None = unlimited
+PLAN_SCAN_LIMITS = {
+    SubscriptionPlanType.LIMITED.value: BASE_SCAN_LIMIT,
+    SubscriptionPlanType.EXTRA_30.value: BASE_SCAN_LIMIT + EXTRA_SCANS,
+    SubscriptionPlanType.UNLIMITED.value: None,
+    SubscriptionPlanType.FREE.value: None,  # Free promo code = unlimited
+}
+
+PLAN_DISPLAY_NAMES = {
+    SubscriptionPlanType.LIMITED.value: "Free Plan",
+    SubscriptionPlanType.FREE.value: "Free Plan",
+    SubscriptionPlanType.EXTRA_30.value: "Extra 30 Scans",
+    SubscriptionPlanType.UNLIMITED.value: "Unlimited Monthly"
+}
+
+_MEMO_KEY = "entitlements"
+_PENDING_KEY = "entitlements_invalidated"
+
+_cache: "OrderedDict[int, tuple[float, Entitlement]]" = OrderedDict()
+_cache_lock = threading.Lock()
+_invalidations = 0  # Bumped on every invalidation; a load that raced one isn't cached
+
+
+@dataclass(frozen=True)
+class Entitlement:
+    user_id: int
+    plan_type: str
+    status: str
+    scan_limit: Optional[int]
+    current_period_start: Optional[datetime]
+    current_period_end: Optional[datetime]
+
+    @property
+    def plan_display_name(self) -> str:
+        return get_plan_display_name(self.plan_type)
+
+
+def get_plan_scan_limit(plan_type: str) -> Optional[int]:
+    """Monthly scan limit for a plan type; None for unlimited plans"""
+    return PLAN_SCAN_LIMITS.get(plan_type, BASE_SCAN_LIMIT)
+
+
+def get_plan_display_name(plan_type: str) -> str:
+    return PLAN_DISPLAY_NAMES.get(plan_type, "Unknown Plan")
+
+
+def get_or_create_subscription(db: Session, user_id: int, commit: bool = True) -> Subscription:
+    """The user's subscription row, created on the free plan if missing
+
+    commit=False leaves the insert in the caller's transaction (Stripe event
+    handlers commit together with the event's status).
+    """
+    subscription = db.query(Subscription).filter(Subscription.user_id == user_id).first()
+    if subscription:
+        return subscription
+
+    # Two first requests at once: the unique user_id lets only one insert through
+    now = datetime.utcnow()
+    insert = postgresql_insert if db.bind.dialect.name == "postgresql" else sqlite_insert
+    db.execute(
+        insert(Subscription)
+        .values(
+            user_id=user_id,
+            plan_type=SubscriptionPlanType.LIMITED.value,
+            status=SubscriptionStatus.ACTIVE.value,
+            current_period_start=now,
+            current_period_end=now + timedelta(days=30),
+            created_at=now,
+            updated_at=now
+        )
+        .on_conflict_do_nothing(index_elements=["user_id"])
+    )
+    if commit:
+        db.commit()
+    return db.query(Subscription).filter(Subscription.user_id == user_id).one()
+
+
+def _from_subscription(subscription: Subscription) -> Entitlement:
+    return Entitlement(
+        user_id=subscription.user_id,
+        plan_type=subscription.plan_type,
+        status=subscription.status,
+        scan_limit=get_plan_scan_limit(subscription.plan_type),
+        current_period_start=subscription.current_period_start,
+        current_period_end=subscription.current_period_end
+    )
+
+
+def get_entitlement(db: Session, user_id: int) -> Entitlement:
+    """The user's entitlement from the request memo, the process cache or the database"""
+    memo = db.info.setdefault(_MEMO_KEY, {})
+    if user_id in memo:
+        return memo[user_id]
+
+    now = time.monotonic()
+    with _cache_lock:
+        generation = _invalidations
+        cached = _cache.get(user_id)
+        if cached and now - cached[0] < ENTITLEMENT_CACHE_TTL_SECONDS:
+            _cache.move_to_end(user_id)
+            metrics.increment("entitlements.cache_hits")
+            memo[user_id] = cached[1]
+            return cached[1]
+
+    metrics.increment("entitlements.cache_misses")
+    entitlement = _from_subscription(get_or_create_subscription(db, user_id))
+    memo[user_id] = entitlement
+    with _cache_lock:
+        if generation == _invalidations:
+            _cache[user_id] = (now, entitlement)
+            _cache.move_to_end(user_id)
+            while len(_cache) > ENTITLEMENT_CACHE_MAX_USERS:
+                _cache.popitem(last=False)
+    return entitlement
+
+
+def get_scan_limit(db: Session, user_id: int) -> Optional[int]:
+    """Monthly scan limit for the user's plan; None for unlimited plans"""
+    return get_entitlement(db, user_id).scan_limit
+
+
+def get_usage(db: Session, user_id: int) -> dict:
+    """Plan, limit and this month's used / remaining scans"""
+    entitlement = get_entitlement(db, user_id)
+    scans_used = get_scans_used(db, user_id)
+    scan_limit = entitlement.scan_limit
+    return {
+        "plan_type": entitlement.plan_type,
+        "scans_used": scans_used,
+        "scan_limit": scan_limit,
+        "scans_remaining": None if scan_limit is None else max(0, scan_limit - scans_used),
+    }
+
+
+def _forget(user_ids):
+    global _invalidations
+    with _cache_lock:
+        _invalidations += 1
+        for user_id in user_ids:
+            _cache.pop(user_id, None)
+
+
+def invalidate_entitlement(db: Session, user_id: int):
+    """Drop cached entitlements for a user whose subscription `db` is changing
+
+    Call it before committing the change: the entry is dropped now and again
+    after the commit.
+    """
+    db.info.get(_MEMO_KEY, {}).pop(user_id, None)
+    db.info.setdefault(_PENDING_KEY, set()).add(user_id)
+    _forget([user_id])
+    metrics.increment("entitlements.invalidations")
+
+
+@event.listens_for(SessionLocal, "after_commit")
+def _after_commit(session: Session):
+    pending = session.info.pop(_PENDING_KEY, None)
+    if pending:
+        _forget(pending)
+        memo = session.info.get(_MEMO_KEY, {})
+        for user_id in pending:
+            memo.pop(user_id, None)
+
+
+@event.listens_for(SessionLocal, "after_rollback")
+def _after_rollback(session: Session):
+    # The change never landed; the cache was already dropped, nothing to redo
+    session.info.pop(_PENDING_KEY, None)
@@ -0,0 +1,307 @@
+"""
+Per-user event bus for the live event stream (GET /events/stream).
+
+Code that changes something a user's open app should show publishes an
+event for that user: a new notification, a new unread count, or "data
+changed" after expense/income writes. Each open stream subscribes with a
+bounded asyncio queue on the web process's event loop.
+
+publish() sends at once; publish_after_commit() holds events on the session
+until it commits (and drops them on rollback), so a stream never announces a
+row the client can't read yet. Both can be called from any thread, including
+the event loop: a backend that needs I/O to send hands the messages to its
+own thread instead of blocking the caller.
+
+The backend decides which processes see an event (EVENT_BUS_BACKEND):
+
+- "memory": this process only; fine for a single web worker.
+- "postgres" (the default when DATABASE_URL is set): NOTIFY on
+  EVENT_BUS_CHANNEL from a publisher thread, with a LISTEN thread in each
+  web process, so events published by any worker or by stripe_worker /
+  receipt_worker running as separate processes reach every stream.
+
+Other transports (e.g. Redis pub/sub) plug in through BACKENDS. A stream
+that stops reading has its backlog replaced by one "resync" event (refetch
+everything); the same is sent to all streams after the listener reconnects,
+since events may have been missed meanwhile.
+"""
+import asyncio
+import contextlib
+import json
+import logging
+import os
+import select
+import threading
+from datetime import date, datetime
+from queue import Empty, Full, Queue
+from typing import Optional
+
+from sqlalchemy import event, text
+from sqlalchemy.orm import Session
+
+from database import DATABASE_URL, SessionLocal, engine
+import metrics
+
+logger = logging.getLogger(__name__)
+
+EVENT_BUS_BACKEND = os.getenv("EVENT_BUS_BACKEND", "postgres" if DATABASE_URL else "memory")
+EVENT_BUS_CHANNEL = os.getenv("EVENT_BUS_CHANNEL", "app_events")
+EVENT_STREAM_QUEUE_SIZE = int(os.getenv("EVENT_STREAM_QUEUE_SIZE", "100"))
+EVENT_BUS_PUBLISH_QUEUE_SIZE = int(os.getenv("EVENT_BUS_PUBLISH_QUEUE_SIZE", "10000"))  # Batches waiting for NOTIFY
+
+_PENDING_KEY = "pending_events"
+_NOTIFY_MAX_BYTES = 7900  # Postgres rejects NOTIFY payloads of 8000 bytes or more
+
+# Sentinel pushed to every queue on shutdown so open streams end
+CLOSE = ("close", None)
+
+
+class MemoryBackend:
+    """Delivers to subscribers in this process only"""
+
+    def __init__(self):
+        self._deliver = None
+
+    def start(self, deliver):
+        self._deliver = deliver
+
+    def publish(self, messages: list[dict]):
+        if self._deliver is not None:  # Not started: this process serves no streams
+            self._deliver(messages)
+
+    def stop(self):
+        pass
+
+
+class PostgresBackend:
+    """NOTIFY to publish, one LISTEN connection per web process to receive"""
+
+    def __init__(self):
+        self._thread: Optional[threading.Thread] = None
+        self._stopping = threading.Event()
+        self._outbox: Queue = Queue(EVENT_BUS_PUBLISH_QUEUE_SIZE)
+        self._publisher: Optional[threading.Thread] = None
+        self._publisher_lock = threading.Lock()
+
+    def start(self, deliver):
+        self._deliver = deliver
+        self._stopping.clear()
+        self._thread = threading.Thread(target=self._listen, name="event-bus-listener", daemon=True)
+        self._thread.start()
+
+    def publish(self, messages: list[dict]):
+        """Queue for the publisher thread; callers include after_commit hooks on the event loop"""
+        payloads = []
+        for message in messages:
+            payload = json.dumps(message, default=_json_default)
+            if len(payload.encode()) > _NOTIFY_MAX_BYTES:
+                payload = json.dumps({"user_id": message["user_id"], "event": "resync", "data": {}})
+            payloads.append(payload)
+        # Works from any process: publishing doesn't need the listener
+        with self._publisher_lock:
+            if self._publisher is None or not self._publisher.is_alive():
+                self._publisher = threading.Thread(target=self._publish_loop, name="event-bus-publisher", daemon=True)
+                self._publisher.start()
+        try:
+            self._outbox.put_nowait(payloads)
+        except Full:
+            raise RuntimeError("publish queue is full (database unreachable?)")
+
+    def _publish_loop(self):
+        while True:
+            payloads = self._outbox.get()
+            if payloads is None:
+                return
+            # Everything queued meanwhile goes out in the same NOTIFY round trip
+            while True:
+                try:
+                    more = self._outbox.get_nowait()
+                except Empty:
+                    break
+                if more is None:
+                    self._outbox.put(None)
+                    break
+                payloads += more
+            try:
+                with engine.begin() as conn:
+                    conn.execute(
+                        text("SELECT pg_notify(:channel, payload) FROM unnest(CAST(:payloads AS text[])) AS payload"),
+                        {"channel": EVENT_BUS_CHANNEL, "payloads": payloads}
+                    )
+            except Exception as e:
+                # Live updates are best effort; the data itself is already committed
+                metrics.increment("event_bus.publish_errors")
+                logger.warning(f"Publishing {len(payloads)} events failed: {e}")
+
+    def _listen(self):
+        import psycopg2
+
+        reconnecting = False
+        while not self._stopping.is_set():
+            conn = None
+            try:
+                conn = psycopg2.connect(DATABASE_URL)
+                conn.autocommit = True
+                conn.cursor().execute(f'LISTEN "{EVENT_BUS_CHANNEL}"')
+                if reconnecting:
+                    logger.info("Event bus listener reconnected")
+                    self._deliver([{"user_id": None, "event": "resync", "data": {}}])
+                reconnecting = True
+                while not self._stopping.is_set():
+                    if not select.select([conn], [], [], 5)[0]:
+                        continue
+                    conn.poll()
+                    messages = [json.loads(notify.payload) for notify in conn.notifies]
+                    conn.notifies.clear()
+                    if messages:
+                        self._deliver(messages)
+            except Exception as e:
+                metrics.increment("event_bus.listener_errors")
+                logger.warning(f"Event bus listener failed, reconnecting: {e}")
+                self._stopping.wait(5)
+            finally:
+                if conn is not None:
+                    conn.close()
+
+    def stop(self):
+        self._stopping.set()
+        if self._thread is not None:
+            self._thread.join(timeout=10)
+            self._thread = None
+        with self._publisher_lock:
+            publisher, self._publisher = self._publisher, None
+        if publisher is not None and publisher.is_alive():
+            # Send what is queued before shutting down
+            self._outbox.put(None)
+            publisher.join(timeout=10)
+
+
+BACKENDS = {
+    "memory": MemoryBackend,
+    "postgres": PostgresBackend,
+}
+
+_backend = BACKENDS[EVENT_BUS_BACKEND]()
+_loop: Optional[asyncio.AbstractEventLoop] = None
+_subscribers: dict[int, set] = {}
+
+
+def _json_default(value):
+    if isinstance(value, (datetime, date)):
+        return value.isoformat()
+    raise TypeError(f"{type(value).__name__} is not JSON serializable")
+
+
+def _offer(queue: asyncio.Queue, item: tuple):
+    try:
+        queue.put_nowait(item)
+    except asyncio.QueueFull:
+        # The client stopped reading: drop its backlog and tell it to refetch
+        while not queue.empty():
+            queue.get_nowait()
+        queue.put_nowait(("resync", {}))
+        metrics.increment("event_bus.overflows")
+
+
+def _fan_out(messages: list[dict]):
+    """Hand messages to this process's subscribers (event loop thread only)"""
+    for message in messages:
+        if message["user_id"] is None:
+            queues = [queue for user_queues in _subscribers.values() for queue in user_queues]
+        else:
+            queues = _subscribers.get(message["user_id"], ())
+        for queue in list(queues):
+            _offer(queue, (message["event"], message["data"]))
+    metrics.increment("event_bus.delivered", len(messages))
+
+
+def _deliver(messages: list[dict]):
+    """Backend callback, from any thread"""
+    loop = _loop
+    if loop is None or loop.is_closed():
+        return  # No streams are served by this process
+    try:
+        running = asyncio.get_running_loop()
+    except RuntimeError:
+        running = None
+    if running is loop:
+        _fan_out(messages)
+    else:
+        loop.call_soon_threadsafe(_fan_out, messages)
+
+
+def _send(messages: list[dict]):
+    try:
+        _backend.publish(messages)
+        metrics.increment("event_bus.published", len(messages))
+    except Exception as e:
+        # Live updates are best effort; the data itself is already committed
+        metrics.increment("event_bus.publish_errors")
+        logger.warning(f"Publishing {len(messages)} events failed: {e}")
+
+
+def publish(user_id: Optional[int], event_name: str, data: Optional[dict] = None):
+    """Send an event to the user's open streams now (user_id None: every stream)"""
+    _send([{"user_id": user_id, "event": event_name, "data": data or {}}])
+
+
+def publish_after_commit(db: Session, user_id: Optional[int], event_name: str, data: Optional[dict] = None):
+    """Send the event once `db` commits; nothing is sent if it rolls back"""
+    db.info.setdefault(_PENDING_KEY, []).append({"user_id": user_id, "event": event_name, "data": data or {}})
+
+
+@event.listens_for(SessionLocal, "after_commit")
+def _after_commit(session: Session):
+    pending = session.info.pop(_PENDING_KEY, None)
+    if pending:
+        _send(pending)
+
+
+@event.listens_for(SessionLocal, "after_rollback")
+def _after_rollback(session: Session):
+    session.info.pop(_PENDING_KEY, None)
+
+
+def subscriber_count(user_id: int) -> int:
+    return len(_subscribers.get(user_id, ()))
+
+
+@contextlib.contextmanager
+def subscribe(user_id: int):
+    """Queue of (event, data) for one stream of the user, until the block exits"""
+    queue: asyncio.Queue = asyncio.Queue(EVENT_STREAM_QUEUE_SIZE)
+    _subscribers.setdefault(user_id, set()).add(queue)
+    metrics.set_gauge("event_bus.streams", sum(len(queues) for queues in _subscribers.values()))
+    try:
+        yield queue
+    finally:
+        queues = _subscribers.get(user_id)
+        if queues is not None:
+            queues.discard(queue)
+            if not queues:
+                del _subscribers[user_id]
+        metrics.set_gauge("event_bus.streams", sum(len(queues) for queues in _subscribers.values()))
+
+
+def start_event_bus():
+    """Start delivering to streams served by this process (web process, on its event loop)"""
+    global _loop
+    if _loop is not None:
+        return
+    _loop = asyncio.get_running_loop()
+    _backend.start(_deliver)
+    print(f"Event bus started ({EVENT_BUS_BACKEND})")
+
+
+async def stop_event_bus():
+    """Stop receiving and end open streams, so shutdown doesn't wait on them"""
+    global _loop
+    if _loop is None:
+        return
+    await asyncio.to_thread(_backend.stop)
+    for queues in _subscribers.values():
+        for queue in queues:
+            while not queue.empty():
+                queue.get_nowait()
+            queue.put_nowait(CLOSE)
+    _loop = None
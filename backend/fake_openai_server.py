@@ -0,0 +1,271 @@
+#!/usr/bin/env python3
+"""
+Local stand-in for the OpenAI chat-completions API, for load tests.
+
+Returns canned utility or store receipt JSON with configurable latency and
+error rates, and records every request it receives. Point the backend at it
+with OPENAI_BASE_URL:
+
+    python fake_openai_server.py --port 8765 --latency-ms 800 --error-rate 0.02
+    OPENAI_BASE_URL=http://127.0.0.1:8765/v1 OPENAI_API_KEY=sk-fake uvicorn main:app
+
+GET /requests lists recorded requests, GET /stats summarizes them and
+DELETE /requests clears both. benchmark_receipts.py starts this server in a
+thread by itself.
+"""
+import argparse
+import asyncio
+import base64
+import io
+import json
+import random
+import threading
+import time
+from typing import Optional
+
+import uvicorn
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse
+from PIL import Image
+
+from receipt_image import estimate_image_tokens
+
+UTILITY_RESULT = {
+    "receipt_type": "utility",
+    "amount": 84.37,
+    "date": "2024-01-15",
+    "merchant": "City Electric",
+    "category": "Utilities",
+    "description": "Electric bill"
+}
+
+STORE_RESULT = {
+    "receipt_type": "store",
+    "date": "2024-01-15",
+    "merchant": "Corner Market",
+    "items": [
+        {"amount": 3.49, "category": "Groceries", "description": "Milk 1L"},
+        {"amount": 2.99, "category": "Groceries", "description": "Bread"},
+        {"amount": 7.50, "category": "Household Supplies", "description": "Dish soap"},
+        {"amount": 12.00, "category": "Pet Care", "description": "Dog food"},
+        {"amount": 4.25, "category": "Snacks", "description": "Crackers"}  # Not a valid category: exercises validation
+    ],
+    "tax": 2.40,
+    "subtotal": 30.23,
+    "total": 32.63
+}
+
+
+class FakeConfig:
+    latency_ms = 800.0
+    latency_jitter_ms = 200.0
+    mini_latency_ms = None  # Mean latency for *-mini models; None = same as latency_ms
+    error_rate = 0.0  # HTTP 500
+    rate_limit_rate = 0.0  # HTTP 429
+    bad_json_rate = 0.0  # 200 with unparseable content
+    store_ratio = 0.5  # Share of receipts answered as itemized store receipts
+    max_recorded = 10000
+
+
+config = FakeConfig()
+recorded: list[dict] = []
+_recorded_lock = threading.Lock()
+_rng = random.Random()
+
+app = FastAPI()
+
+
+def _image_info(content: list) -> tuple[Optional[str], int, int]:
+    """(detail, image bytes, estimated image tokens) of the first image part"""
+    for part in content:
+        if part.get("type") != "image_url":
+            continue
+        image_url = part["image_url"]
+        detail = image_url.get("detail", "auto")
+        data = base64.b64decode(image_url["url"].split(",", 1)[-1])
+        if detail == "low":
+            return detail, len(data), 85
+        try:
+            width, height = Image.open(io.BytesIO(data)).size
+            return detail, len(data), estimate_image_tokens(width, height)
+        except Exception:
+            return detail, len(data), 85
+    return None, 0, 0
+
+
+def _prompt_text(messages: list) -> str:
+    texts = []
+    for message in messages:
+        content = message.get("content")
+        if isinstance(content, str):
+            texts.append(content)
+        else:
+            texts.extend(part.get("text", "") for part in content if part.get("type") == "text")
+    return "\n".join(texts)
+
+
+def _canned_result(body: dict) -> dict:
+    """Answer in the shape the request's strict JSON schema asks for, if any"""
+    schema_name = ((body.get("response_format") or {}).get("json_schema") or {}).get("name")
+    if schema_name == "store_receipt":
+        return STORE_RESULT
+    if schema_name == "utility_receipt":
+        return UTILITY_RESULT
+    is_store = _rng.random() < config.store_ratio
+    if schema_name == "receipt_classification":
+        if is_store:
+            return {"receipt_type": "store", "amount": None, "date": None, "merchant": None, "category": None, "description": None}
+        return UTILITY_RESULT
+    return STORE_RESULT if is_store else UTILITY_RESULT
+
+
+def _record(entry: dict):
+    with _recorded_lock:
+        recorded.append(entry)
+        if len(recorded) > config.max_recorded:
+            del recorded[0]
+
+
+@app.post("/v1/chat/completions")
+async def chat_completions(request: Request):
+    received_at = time.time()
+    body = await request.json()
+    messages = body.get("messages", [])
+    prompt = _prompt_text(messages)
+    content_parts = [part for message in messages if isinstance(message.get("content"), list) for part in message["content"]]
+    detail, image_bytes, image_tokens = _image_info(content_parts)
+
+    mean_latency = config.latency_ms
+    if config.mini_latency_ms is not None and "mini" in str(body.get("model")):
+        mean_latency = config.mini_latency_ms
+    latency = max(0.0, _rng.gauss(mean_latency, config.latency_jitter_ms)) / 1000
+    await asyncio.sleep(latency)
+
+    entry = {
+        "received_at": received_at,
+        "model": body.get("model"),
+        "detail": detail,
+        "image_bytes": image_bytes,
+        "prompt_chars": len(prompt),
+        "max_tokens": body.get("max_tokens"),
+        "response_format": (body.get("response_format") or {}).get("type"),
+        "latency_ms": round(latency * 1000, 1),
+    }
+
+    roll = _rng.random()
+    if roll < config.error_rate:
+        entry["status"] = 500
+        _record(entry)
+        return JSONResponse(status_code=500, content={"error": {"message": "Fake server error", "type": "server_error"}})
+    if roll < config.error_rate + config.rate_limit_rate:
+        entry["status"] = 429
+        _record(entry)
+        return JSONResponse(status_code=429, content={"error": {"message": "Rate limit reached", "type": "rate_limit_exceeded"}})
+
+    if roll < config.error_rate + config.rate_limit_rate + config.bad_json_rate:
+        content = "Sorry, I can't read this receipt."
+        entry["status"] = "bad_json"
+    else:
+        result = _canned_result(body)
+        content = json.dumps(result)
+        entry["status"] = 200
+        entry["receipt_type"] = result.get("receipt_type")
+    _record(entry)
+
+    prompt_tokens = len(prompt) // 4 + image_tokens
+    completion_tokens = len(content) // 4
+    return {
+        "id": f"chatcmpl-fake-{int(received_at * 1000)}",
+        "object": "chat.completion",
+        "created": int(received_at),
+        "model": body.get("model"),
+        "choices": [{
+            "index": 0,
+            "finish_reason": "stop",
+            "message": {"role": "assistant", "content": content}
+        }],
+        "usage": {
+            "prompt_tokens": prompt_tokens,
+            "completion_tokens": completion_tokens,
+            "total_tokens": prompt_tokens + completion_tokens
+        }
+    }
+
+
+@app.get("/requests")
+async def get_requests():
+    with _recorded_lock:
+        return list(recorded)
+
+
+@app.delete("/requests")
+async def clear_requests():
+    with _recorded_lock:
+        recorded.clear()
+    return {"cleared": True}
+
+
+@app.get("/stats")
+async def get_stats():
+    with _recorded_lock:
+        entries = list(recorded)
+    summary = {"requests": len(entries), "by_status": {}, "by_model": {}, "by_detail": {}, "image_bytes": 0}
+    for entry in entries:
+        for key, field in (("by_status", "status"), ("by_model", "model"), ("by_detail", "detail")):
+            value = str(entry.get(field))
+            summary[key][value] = summary[key].get(value, 0) + 1
+        summary["image_bytes"] += entry["image_bytes"]
+    return summary
+
+
+def configure(**settings):
+    """Override FakeConfig fields (None values are ignored)"""
+    for name, value in settings.items():
+        if value is not None:
+            setattr(config, name, value)
+
+
+def start_in_thread(port: int, host: str = "127.0.0.1") -> uvicorn.Server:
+    """Run the server on its own event loop in a daemon thread; returns once it accepts requests"""
+    server = uvicorn.Server(uvicorn.Config(app, host=host, port=port, log_level="warning"))
+    thread = threading.Thread(target=server.run, daemon=True)
+    thread.start()
+    while not server.started:
+        time.sleep(0.05)
+    return server
+
+
+def add_arguments(parser: argparse.ArgumentParser):
+    parser.add_argument("--latency-ms", type=float, help="mean response latency (default 800)")
+    parser.add_argument("--latency-jitter-ms", type=float, help="standard deviation of the latency (default 200)")
+    parser.add_argument("--mini-latency-ms", type=float, help="mean latency for *-mini models (default: same as --latency-ms)")
+    parser.add_argument("--error-rate", type=float, help="share of requests answered with HTTP 500")
+    parser.add_argument("--rate-limit-rate", type=float, help="share of requests answered with HTTP 429")
+    parser.add_argument("--bad-json-rate", type=float, help="share of answers that are not JSON")
+    parser.add_argument("--store-ratio", type=float, help="share of receipts answered as store receipts (default 0.5)")
+    parser.add_argument("--seed", type=int, help="random seed for repeatable runs")
+
+
+def configure_from_args(args: argparse.Namespace):
+    configure(
+        latency_ms=args.latency_ms,
+        latency_jitter_ms=args.latency_jitter_ms,
+        mini_latency_ms=args.mini_latency_ms,
+        error_rate=args.error_rate,
+        rate_limit_rate=args.rate_limit_rate,
+        bad_json_rate=args.bad_json_rate,
+        store_ratio=args.store_ratio,
+    )
+    if args.seed is not None:
+        _rng.seed(args.seed)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Fake OpenAI chat-completions server")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    add_arguments(parser)
+    args = parser.parse_args()
+    configure_from_args(args)
+    print(f"Fake OpenAI server on http://{args.host}:{args.port}/v1")
+    uvicorn.run(app, host=args.host, port=args.port, log_level="warning")
@@ -0,0 +1,271 @@
+#!/usr/bin/env python3
+"""
+Local stand-in for the parts of the Stripe API the backend calls, for load
+tests.
+
+Creates customers and checkout sessions, retrieves and updates subscriptions,
+with configurable latency, 5xx / 429 rates and requests that hang past the
+client timeout. Idempotency keys behave like Stripe's: a repeated key gets
+the first response back (with Idempotent-Replayed: true), so a retried create
+can be told apart from a duplicate one. Point the backend at it with
+STRIPE_API_BASE:
+
+    python fake_stripe_server.py --port 12111 --latency-ms 300 --error-rate 0.05
+    STRIPE_API_BASE=http://127.0.0.1:12111 STRIPE_SECRET_KEY=sk_test_fake uvicorn main:app
+
+GET /requests lists recorded requests, GET /stats summarizes them and
+DELETE /requests clears both. benchmark_checkout.py starts this server in a
+thread by itself.
+"""
+import argparse
+import asyncio
+import random
+import threading
+import time
+import uuid
+
+import uvicorn
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse
+
+
+class FakeConfig:
+    latency_ms = 300.0
+    latency_jitter_ms = 100.0
+    error_rate = 0.0  # HTTP 500
+    rate_limit_rate = 0.0  # HTTP 429
+    hang_rate = 0.0  # No answer for hang_seconds (longer than the client timeout)
+    hang_seconds = 30.0
+    max_recorded = 10000
+
+
+config = FakeConfig()
+recorded: list[dict] = []
+customers: dict[str, dict] = {}
+subscriptions: dict[str, dict] = {}
+_idempotent_responses: dict[str, dict] = {}
+_idempotency_in_flight: set[str] = set()
+_lock = threading.Lock()
+_rng = random.Random()
+
+app = FastAPI()
+
+
+def _new_id(prefix: str) -> str:
+    return f"{prefix}_fake{uuid.uuid4().hex[:16]}"
+
+
+def _nested_form(form) -> dict:
+    """Stripe's form encoding (metadata[user_id]=1, line_items[0][price]=...) back into dicts"""
+    result: dict = {}
+    for key, value in form.multi_items():
+        parts = key.replace("]", "").split("[")
+        target = result
+        for part in parts[:-1]:
+            target = target.setdefault(part, {})
+        target[parts[-1]] = value
+    return result
+
+
+def _record(entry: dict):
+    with _lock:
+        recorded.append(entry)
+        if len(recorded) > config.max_recorded:
+            del recorded[0]
+
+
+def _subscription(subscription_id: str) -> dict:
+    with _lock:
+        if subscription_id not in subscriptions:
+            now = int(time.time())
+            subscriptions[subscription_id] = {
+                "id": subscription_id,
+                "object": "subscription",
+                "status": "active",
+                "cancel_at_period_end": False,
+                # API version 2025-03-31.basil: the period is on the items, not the subscription
+                "items": {
+                    "object": "list",
+                    "data": [{
+                        "id": f"si_{subscription_id}",
+                        "object": "subscription_item",
+                        "current_period_start": now,
+                        "current_period_end": now + 30 * 86400,
+                    }],
+                },
+            }
+        return subscriptions[subscription_id]
+
+
+async def _handle(request: Request, endpoint: str, build):
+    """Latency, injected faults and idempotency around one API call"""
+    entry = {"received_at": time.time(), "endpoint": endpoint}
+    idempotency_key = request.headers.get("idempotency-key")
+    await asyncio.sleep(max(0.0, _rng.gauss(config.latency_ms, config.latency_jitter_ms)) / 1000)
+
+    roll = _rng.random()
+    if roll < config.hang_rate:
+        entry["status"] = "hang"
+        _record(entry)
+        await asyncio.sleep(config.hang_seconds)
+        return JSONResponse(status_code=504, content={"error": {"type": "api_error", "message": "Fake timeout"}})
+    roll -= config.hang_rate
+    if roll < config.error_rate:
+        entry["status"] = 500
+        _record(entry)
+        return JSONResponse(status_code=500, content={"error": {"type": "api_error", "message": "Fake server error"}})
+    if roll < config.error_rate + config.rate_limit_rate:
+        entry["status"] = 429
+        _record(entry)
+        return JSONResponse(status_code=429, content={"error": {"type": "invalid_request_error", "code": "rate_limit", "message": "Too many requests"}})
+
+    body = _nested_form(await request.form()) if request.method == "POST" else {}
+    with _lock:
+        replay = _idempotent_responses.get(idempotency_key) if idempotency_key else None
+        in_use = replay is None and idempotency_key in _idempotency_in_flight
+        if idempotency_key and replay is None and not in_use:
+            _idempotency_in_flight.add(idempotency_key)
+    if replay is not None:
+        entry["status"] = "replayed"
+        _record(entry)
+        return JSONResponse(content=replay, headers={"Idempotent-Replayed": "true"})
+    if in_use:
+        entry["status"] = 409
+        _record(entry)
+        return JSONResponse(status_code=409, content={"error": {
+            "type": "invalid_request_error", "code": "idempotency_key_in_use",
+            "message": "There is currently another in-progress request using this Idempotent Key"
+        }})
+
+    try:
+        # Stripe does the work while the key is held; give concurrent duplicates time to collide
+        await asyncio.sleep(config.latency_ms / 4000)
+        result = build(body)
+        if idempotency_key:
+            with _lock:
+                _idempotent_responses[idempotency_key] = result
+    finally:
+        with _lock:
+            _idempotency_in_flight.discard(idempotency_key)
+    entry["status"] = 200
+    _record(entry)
+    return result
+
+
+@app.post("/v1/customers")
+async def create_customer(request: Request):
+    def build(body):
+        customer = {"id": _new_id("cus"), "object": "customer", "email": body.get("email"), "metadata": body.get("metadata", {})}
+        with _lock:
+            customers[customer["id"]] = customer
+        return customer
+    return await _handle(request, "customers.create", build)
+
+
+@app.post("/v1/checkout/sessions")
+async def create_checkout_session(request: Request):
+    def build(body):
+        session_id = _new_id("cs")
+        return {
+            "id": session_id,
+            "object": "checkout.session",
+            "customer": body.get("customer"),
+            "mode": body.get("mode"),
+            "metadata": body.get("metadata", {}),
+            "url": f"https://checkout.stripe.test/pay/{session_id}",
+        }
+    return await _handle(request, "checkout.sessions.create", build)
+
+
+@app.get("/v1/subscriptions/{subscription_id}")
+async def retrieve_subscription(subscription_id: str, request: Request):
+    return await _handle(request, "subscriptions.retrieve", lambda body: _subscription(subscription_id))
+
+
+@app.post("/v1/subscriptions/{subscription_id}")
+async def update_subscription(subscription_id: str, request: Request):
+    def build(body):
+        subscription = _subscription(subscription_id)
+        if "cancel_at_period_end" in body:
+            subscription["cancel_at_period_end"] = body["cancel_at_period_end"] == "true"
+        return subscription
+    return await _handle(request, "subscriptions.update", build)
+
+
+@app.get("/requests")
+async def get_requests():
+    with _lock:
+        return list(recorded)
+
+
+@app.delete("/requests")
+async def clear_requests():
+    with _lock:
+        recorded.clear()
+        customers.clear()
+        subscriptions.clear()
+        _idempotent_responses.clear()
+    return {"cleared": True}
+
+
+@app.get("/stats")
+async def get_stats():
+    with _lock:
+        entries = list(recorded)
+        summary = {"requests": len(entries), "customers": len(customers), "by_status": {}, "by_endpoint": {}}
+    for entry in entries:
+        for key, field in (("by_status", "status"), ("by_endpoint", "endpoint")):
+            value = str(entry.get(field))
+            summary[key][value] = summary[key].get(value, 0) + 1
+    return summary
+
+
+def configure(**settings):
+    """Override FakeConfig fields (None values are ignored)"""
+    for name, value in settings.items():
+        if value is not None:
+            setattr(config, name, value)
+
+
+def start_in_thread(port: int, host: str = "127.0.0.1") -> uvicorn.Server:
+    """Run the server on its own event loop in a daemon thread; returns once it accepts requests"""
+    server = uvicorn.Server(uvicorn.Config(app, host=host, port=port, log_level="warning"))
+    thread = threading.Thread(target=server.run, daemon=True)
+    thread.start()
+    while not server.started:
+        time.sleep(0.05)
+    return server
+
+
+def add_arguments(parser: argparse.ArgumentParser):
+    parser.add_argument("--latency-ms", type=float, help="mean response latency (default 300)")
+    parser.add_argument("--latency-jitter-ms", type=float, help="standard deviation of the latency (default 100)")
+    parser.add_argument("--error-rate", type=float, help="share of requests answered with HTTP 500")
+    parser.add_argument("--rate-limit-rate", type=float, help="share of requests answered with HTTP 429")
+    parser.add_argument("--hang-rate", type=float, help="share of requests that never answer in time")
+    parser.add_argument("--hang-seconds", type=float, help="how long a hanging request takes (default 30)")
+    parser.add_argument("--seed", type=int, help="random seed for repeatable runs")
+
+
+def configure_from_args(args: argparse.Namespace):
+    configure(
+        latency_ms=args.latency_ms,
+        latency_jitter_ms=args.latency_jitter_ms,
+        error_rate=args.error_rate,
+        rate_limit_rate=args.rate_limit_rate,
+        hang_rate=args.hang_rate,
+        hang_seconds=args.hang_seconds,
+    )
+    if args.seed is not None:
+        _rng.seed(args.seed)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Fake Stripe API server")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=12111)
+    add_arguments(parser)
+    args = parser.parse_args()
+    configure_from_args(args)
+    print(f"Fake Stripe API on http://{args.host}:{args.port}")
+    uvicorn.run(app, host=args.host, port=args.port, log_level="warning")
@@ -9,14 +9,55 @@ from dotenv import load_dotenv
 load_dotenv()
 
 from database import init_db
-from routes import auth, expenses, income, stats, receipts, export, debug, subscription, notifications
+from auth import calibrate_password_hashing
+from account_deletion import DELETION_RESUME_INTERVAL_SECONDS, resume_pending_deletions
+from receipt_worker import start_in_process_workers, stop_in_process_workers
+from stripe_worker import start_stripe_workers, stop_stripe_workers
+from model_telemetry import start_telemetry_flusher, stop_telemetry_flusher
+from scheduler import register_job, start_scheduler, stop_scheduler
+from event_bus import start_event_bus, stop_event_bus
+from scan_history import RECEIPT_HISTORY_PRUNE_INTERVAL_SECONDS, prune_receipt_history
+from subscription_lifecycle import SUBSCRIPTION_SWEEP_INTERVAL_SECONDS, sweep_subscriptions
+from notification_service import (
+    NOTIFICATION_COUNTER_RECONCILE_INTERVAL_SECONDS, NOTIFICATION_RETENTION_INTERVAL_SECONDS,
+    prune_notifications, reconcile_unread_counters
+)
+from routes import auth, expenses, income, stats, receipts, receipt_jobs, export, debug, subscription, notifications, events, admin
 
 app = FastAPI()
 
+# Periodic maintenance jobs (see scheduler.py)
+register_job("prune_receipt_history", RECEIPT_HISTORY_PRUNE_INTERVAL_SECONDS, prune_receipt_history)
+register_job("sweep_subscriptions", SUBSCRIPTION_SWEEP_INTERVAL_SECONDS, sweep_subscriptions)
+register_job("reconcile_unread_counters", NOTIFICATION_COUNTER_RECONCILE_INTERVAL_SECONDS, reconcile_unread_counters)
+register_job("prune_notifications", NOTIFICATION_RETENTION_INTERVAL_SECONDS, prune_notifications)
+register_job("resume_account_deletions", DELETION_RESUME_INTERVAL_SECONDS, resume_pending_deletions)
+
 # Initialize database on startup
 @app.on_event("startup")
 def on_startup():
     init_db()
+    calibrate_password_hashing()
+    resume_pending_deletions()
+
+
+# Background receipt job and Stripe event workers (when not run as separate processes)
+@app.on_event("startup")
+async def start_background_workers():
+    start_in_process_workers()
+    start_stripe_workers()
+    start_telemetry_flusher()
+    start_scheduler()
+    start_event_bus()
+
+
+@app.on_event("shutdown")
+async def stop_background_workers():
+    await stop_event_bus()
+    await stop_scheduler()
+    await stop_in_process_workers()
+    await stop_stripe_workers()
+    await stop_telemetry_flusher()
 
 # Add CORS middleware
 # When allow_credentials=True, you cannot use allow_origins=["*"]
@@ -79,7 +120,10 @@ app.include_router(expenses.router)
 app.include_router(income.router)
 app.include_router(stats.router)
 app.include_router(receipts.router)
+app.include_router(receipt_jobs.router)
 app.include_router(export.router)
 app.include_router(debug.router)
 app.include_router(subscription.router)
 app.include_router(notifications.router)
+app.include_router(events.router)
+app.include_router(admin.router)
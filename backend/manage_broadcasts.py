@@ -0,0 +1,111 @@
+#!/usr/bin/env python3
+"""
+Send broadcast notifications (announcements, maintenance windows) and see
+how far they got. Works for both local (SQLite) and production
+(PostgreSQL: set DATABASE_URL).
+
+    python manage_broadcasts.py send --message "Receipt scanning is down Sunday 02:00-03:00 UTC" --type maintenance --expires 2025-06-02
+    python manage_broadcasts.py send --message "Unlimited plans now include CSV export" --plan unlimited
+    python manage_broadcasts.py send --message "..." --eager        # write every user's row now
+    python manage_broadcasts.py resume 12                           # finish an interrupted send
+    python manage_broadcasts.py list
+    python manage_broadcasts.py show 12
+
+All-user broadcasts are delivered to each user when they next open their
+notifications (see notification_broadcasts.py); --plan and --eager
+broadcasts write one row per recipient now, in chunks.
+"""
+import argparse
+import sys
+from datetime import datetime
+
+from dotenv import load_dotenv
+
+load_dotenv()
+
+from sqlalchemy import func
+
+from database import Notification, NotificationTemplate, SessionLocal, SubscriptionPlanType, init_db
+from notification_broadcasts import NOTIFICATION_BROADCAST_CHUNK_SIZE, create_broadcast, send_broadcast
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Manage broadcast notifications")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    send = commands.add_parser("send", help="send a broadcast")
+    send.add_argument("--message", required=True)
+    send.add_argument("--type", default="announcement", help="notification type (default announcement)")
+    send.add_argument("--plan", choices=[p.value for p in SubscriptionPlanType], help="only users on this plan")
+    send.add_argument("--eager", action="store_true", help="write all users' rows now instead of on their next read")
+    send.add_argument("--expires", type=datetime.fromisoformat,
+                      help="all-user broadcasts: not delivered after this, UTC (YYYY-MM-DD or ISO datetime)")
+    send.add_argument("--chunk-size", type=int, default=NOTIFICATION_BROADCAST_CHUNK_SIZE)
+
+    resume = commands.add_parser("resume", help="finish sending an interrupted broadcast")
+    resume.add_argument("id", type=int)
+    resume.add_argument("--chunk-size", type=int, default=NOTIFICATION_BROADCAST_CHUNK_SIZE)
+
+    commands.add_parser("list", help="list broadcasts")
+
+    show = commands.add_parser("show", help="show one broadcast with delivery and read counts")
+    show.add_argument("id", type=int)
+    return parser.parse_args()
+
+
+def describe(template: NotificationTemplate) -> str:
+    if template.all_users:
+        delivery = "on next read"
+    elif template.completed_at:
+        delivery = f"sent to {template.recipients}"
+    else:
+        delivery = f"sending ({template.recipients} so far)"
+    expires = template.expires_at.isoformat(sep=" ") if template.expires_at else "never"
+    return (f"#{template.id:<5} {template.created_at:%Y-%m-%d %H:%M}  {template.audience:<16} {template.type:<14} "
+            f"{delivery:<24} expires {expires:<20} {template.message[:60]}")
+
+
+def main():
+    args = parse_args()
+    init_db()
+    db = SessionLocal()
+    try:
+        if args.command == "send":
+            template = create_broadcast(
+                db, args.type, args.message,
+                audience=f"plan:{args.plan}" if args.plan else "all",
+                eager=args.eager,
+                expires_at=args.expires
+            )
+            if template.all_users:
+                print(f"Broadcast #{template.id} is live; users receive it when they next open their notifications")
+            else:
+                written = send_broadcast(template.id, chunk_size=args.chunk_size)
+                print(f"Broadcast #{template.id} sent to {written} users")
+
+        elif args.command == "resume":
+            template = db.get(NotificationTemplate, args.id)
+            if not template:
+                sys.exit(f"No broadcast #{args.id}")
+            written = send_broadcast(template.id, chunk_size=args.chunk_size)
+            print(f"Broadcast #{template.id}: sent to {written} more users")
+
+        elif args.command == "list":
+            for template in db.query(NotificationTemplate).order_by(NotificationTemplate.id):
+                print(describe(template))
+
+        elif args.command == "show":
+            template = db.get(NotificationTemplate, args.id)
+            if not template:
+                sys.exit(f"No broadcast #{args.id}")
+            delivered, read = db.query(
+                func.count(Notification.id), func.count(Notification.id).filter(Notification.read == True)
+            ).filter(Notification.template_id == template.id).one()
+            print(describe(template))
+            print(f"Delivered to {delivered} users, read by {read}")
+    finally:
+        db.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,127 @@
+#!/usr/bin/env python3
+"""
+Create, generate and inspect promo codes. Works for both local (SQLite) and
+production (PostgreSQL: set DATABASE_URL).
+
+    python manage_promo_codes.py create GOLDENKEY2025            # unlimited uses, never expires
+    python manage_promo_codes.py create LAUNCH50 --max-uses 50 --expires 2025-12-31
+    python manage_promo_codes.py generate --count 1000 --prefix BETA- --max-uses 1 --output beta_codes.csv
+    python manage_promo_codes.py list
+    python manage_promo_codes.py show LAUNCH50
+    python manage_promo_codes.py deactivate LAUNCH50
+
+generate draws random codes (no look-alike characters) and inserts them in
+bulk; codes that collide with existing ones are drawn again, so --count new
+codes are always created. Codes are single-use per user: redemptions are
+recorded in promo_redemptions.
+"""
+import argparse
+import csv
+import sys
+from datetime import datetime
+
+from dotenv import load_dotenv
+
+load_dotenv()
+
+from sqlalchemy import func
+
+from database import PromoCode, PromoCodeType, PromoRedemption, SessionLocal, init_db
+from promo_codes import create_promo_codes, generate_promo_codes, normalize_code
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Manage promo codes")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    def add_settings(command):
+        command.add_argument("--type", default=PromoCodeType.UNLIMITED.value, choices=[t.value for t in PromoCodeType])
+        command.add_argument("--max-uses", type=int, help="total redemptions allowed (default unlimited)")
+        command.add_argument("--expires", type=datetime.fromisoformat, help="expiry, UTC (YYYY-MM-DD or ISO datetime)")
+
+    create = commands.add_parser("create", help="create codes with the given names")
+    create.add_argument("codes", nargs="+")
+    add_settings(create)
+
+    generate = commands.add_parser("generate", help="create random codes in bulk")
+    generate.add_argument("--count", type=int, required=True)
+    generate.add_argument("--prefix", default="")
+    generate.add_argument("--length", type=int, default=8, help="random characters after the prefix (default 8)")
+    generate.add_argument("--output", help="write the codes to this CSV file instead of stdout")
+    add_settings(generate)
+
+    commands.add_parser("list", help="list codes with their usage")
+
+    show = commands.add_parser("show", help="show one code")
+    show.add_argument("code")
+
+    deactivate = commands.add_parser("deactivate", help="stop codes from being redeemed")
+    deactivate.add_argument("codes", nargs="+")
+    return parser.parse_args()
+
+
+def settings(args) -> dict:
+    return {"type": args.type, "max_uses": args.max_uses, "expires_at": args.expires}
+
+
+def describe(promo: PromoCode) -> str:
+    uses = f"{promo.used_count}/{promo.max_uses}" if promo.max_uses is not None else f"{promo.used_count}/unlimited"
+    expires = promo.expires_at.isoformat(sep=" ") if promo.expires_at else "never"
+    return f"{promo.code:<24} {promo.type:<18} uses {uses:<16} expires {expires:<20} {'active' if promo.is_active else 'inactive'}"
+
+
+def write_codes(codes: list, args):
+    if args.output:
+        with open(args.output, "w", newline="") as f:
+            writer = csv.writer(f)
+            writer.writerow(["code", "type", "max_uses", "expires_at"])
+            for code in codes:
+                writer.writerow([code, args.type, args.max_uses or "", args.expires.isoformat() if args.expires else ""])
+        print(f"Wrote {len(codes)} codes to {args.output}")
+    else:
+        for code in codes:
+            print(code)
+
+
+def main():
+    args = parse_args()
+    init_db()
+    db = SessionLocal()
+    try:
+        if args.command == "create":
+            created = create_promo_codes(db, args.codes, **settings(args))
+            for code in dict.fromkeys(normalize_code(code) for code in args.codes):
+                print(f"{code}: {'created' if code in created else 'already exists, left unchanged'}")
+
+        elif args.command == "generate":
+            codes = generate_promo_codes(db, args.count, prefix=args.prefix, length=args.length, **settings(args))
+            write_codes(codes, args)
+            print(f"Created {len(codes)} promo codes", file=sys.stderr)
+
+        elif args.command == "list":
+            for promo in db.query(PromoCode).order_by(PromoCode.created_at, PromoCode.id):
+                print(describe(promo))
+
+        elif args.command == "show":
+            promo = db.query(PromoCode).filter(PromoCode.code == normalize_code(args.code)).first()
+            if not promo:
+                sys.exit(f"No promo code {normalize_code(args.code)}")
+            redemptions, last_redeemed = db.query(
+                func.count(PromoRedemption.id), func.max(PromoRedemption.redeemed_at)
+            ).filter(PromoRedemption.promo_code_id == promo.id).one()
+            print(describe(promo))
+            print(f"Redeemed by {redemptions} users, last on {last_redeemed or 'never'}")
+
+        elif args.command == "deactivate":
+            codes = [normalize_code(code) for code in args.codes]
+            updated = db.query(PromoCode).filter(PromoCode.code.in_(codes)).update(
+                {PromoCode.is_active: False}, synchronize_session=False
+            )
+            db.commit()
+            print(f"Deactivated {updated} of {len(codes)} codes")
+    finally:
+        db.close()
+
+
+if __name__ == "__main__":
+    main()
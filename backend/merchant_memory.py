@@ -0,0 +1,309 @@
+"""
+Per-user merchant -> category memory learned from confirmed receipts.
+
+When a user saves a reviewed receipt through /expenses/batch with its
+merchant, each item description (and, for single-expense receipts, the whole
+bill) is stored in merchant_categories with the category the user chose.
+Later scans use it to:
+
+- re-categorize the model's items with the user's own choices, and
+- recognize a recurring biller by the layout of its bill and send the much
+  shorter bill prompt instead of the full one. Similar layouts are common
+  (many billers print the same kind of page), so the layout only decides
+  whether to try the short prompt: its result is used only when the merchant
+  the model reads off the bill is the expected biller.
+
+Lookups go through an in-memory per-user index loaded from the table on
+first use and refreshed after MERCHANT_MEMORY_TTL_SECONDS, so other worker
+processes pick up new confirmations.
+"""
+import asyncio
+import os
+import re
+import threading
+import time
+from collections import OrderedDict
+from typing import Optional
+
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import Session
+
+from database import MerchantCategory
+from receipt_extraction import CATEGORIES, build_biller_prompt, build_prompt, extract_receipt, prepare_image
+from receipt_image import layout_distance, layout_fingerprint
+import metrics
+
+MERCHANT_MEMORY_TTL_SECONDS = int(os.getenv("MERCHANT_MEMORY_TTL_SECONDS", "300"))
+MERCHANT_MEMORY_MAX_USERS = int(os.getenv("MERCHANT_MEMORY_MAX_USERS", "10000"))  # Users kept in the in-memory index
+MERCHANT_MEMORY_MAX_PATTERNS = int(os.getenv("MERCHANT_MEMORY_MAX_PATTERNS", "200"))  # Per user and merchant
+MERCHANT_MEMORY_BILLER_PROMPT = os.getenv("MERCHANT_MEMORY_BILLER_PROMPT", "true").lower() == "true"
+# layout_distance limits: ink density difference and relative aspect ratio difference
+MERCHANT_MEMORY_LAYOUT_MAX_DISTANCE = float(os.getenv("MERCHANT_MEMORY_LAYOUT_MAX_DISTANCE", "0.08"))
+MERCHANT_MEMORY_LAYOUT_MAX_ASPECT_DIFF = float(os.getenv("MERCHANT_MEMORY_LAYOUT_MAX_ASPECT_DIFF", "0.03"))
+
+# Rough prompt size in tokens for the tokens-saved metric
+CHARS_PER_TOKEN = 4
+
+_index: "OrderedDict[int, tuple[float, dict]]" = OrderedDict()
+_index_lock = threading.Lock()
+
+
+def normalize_merchant(merchant: Optional[str]) -> str:
+    """Lowercase, punctuation-free merchant name used as the lookup key"""
+    if not merchant:
+        return ""
+    return " ".join(re.sub(r"[^\w\s]", " ", merchant.lower()).split())[:255]
+
+
+def normalize_pattern(description: Optional[str]) -> str:
+    """Item description without case, quantities ("2kg", "500 ml") or punctuation"""
+    if not description:
+        return ""
+    text = re.sub(r"\b\d+(?:[.,]\d+)?\s*[a-z]{0,3}\b", " ", description.lower())
+    return " ".join(re.sub(r"[\d\W_]+", " ", text).split())[:100]
+
+
+def description_patterns(description: Optional[str]) -> list[str]:
+    """Patterns for a description; saved store expenses join item descriptions with ', '"""
+    patterns = []
+    for part in (description or "").split(","):
+        pattern = normalize_pattern(part)
+        if pattern and pattern not in patterns:
+            patterns.append(pattern)
+    return patterns
+
+
+def _load_user_memory(db: Session, user_id: int) -> dict:
+    """{merchant: {"name", "category", "confirmations", "layout_hash", "patterns": {pattern: category}}}"""
+    memory = {}
+    rows = db.query(MerchantCategory).filter(MerchantCategory.user_id == user_id).all()
+    for row in rows:
+        entry = memory.setdefault(row.merchant, {
+            "name": row.merchant_name or row.merchant,
+            "category": None,
+            "confirmations": 0,
+            "layout_hash": None,
+            "patterns": {}
+        })
+        if row.pattern:
+            entry["patterns"][row.pattern] = row.category
+        else:
+            entry["name"] = row.merchant_name or row.merchant
+            entry["category"] = row.category
+            entry["confirmations"] = row.confirmations
+            entry["layout_hash"] = row.layout_hash
+    return memory
+
+
+def get_user_memory(db: Session, user_id: int) -> dict:
+    """The user's merchant memory from the in-memory index, loading it on a miss"""
+    now = time.monotonic()
+    with _index_lock:
+        cached = _index.get(user_id)
+        if cached and now - cached[0] < MERCHANT_MEMORY_TTL_SECONDS:
+            _index.move_to_end(user_id)
+            return cached[1]
+
+    memory = _load_user_memory(db, user_id)
+    with _index_lock:
+        _index[user_id] = (now, memory)
+        _index.move_to_end(user_id)
+        while len(_index) > MERCHANT_MEMORY_MAX_USERS:
+            _index.popitem(last=False)
+    return memory
+
+
+def forget_user(user_id: int):
+    """Drop a user's entry from the in-memory index"""
+    with _index_lock:
+        _index.pop(user_id, None)
+
+
+def find_known_biller(memory: dict, layout_hash: Optional[str]) -> Optional[str]:
+    """Merchant key of a confirmed biller whose last bill looks like this one
+
+    Only a candidate: the caller confirms it against the merchant on the bill.
+    """
+    if not layout_hash:
+        return None
+    best, best_distance = None, None
+    for merchant, entry in memory.items():
+        if entry["confirmations"] <= 0 or not entry["layout_hash"] or not entry["category"]:
+            continue
+        distance = layout_distance(layout_hash, entry["layout_hash"])
+        if distance is None:
+            continue  # Stored before the current fingerprint; replaced on the next full scan
+        density, aspect = distance
+        if density > MERCHANT_MEMORY_LAYOUT_MAX_DISTANCE or aspect > MERCHANT_MEMORY_LAYOUT_MAX_ASPECT_DIFF:
+            continue
+        if best_distance is None or density < best_distance:
+            best, best_distance = merchant, density
+    return best
+
+
+def _has_billers(memory: dict) -> bool:
+    """True once the user confirmed a whole-bill category for any merchant"""
+    return any(entry["confirmations"] > 0 and entry["category"] for entry in memory.values())
+
+
+def _record_lookup(hit: bool):
+    metrics.increment("merchant_memory.lookups")
+    if hit:
+        metrics.increment("merchant_memory.hits")
+    lookups = metrics.get_counter("merchant_memory.lookups")
+    metrics.set_gauge("merchant_memory.hit_rate", round(metrics.get_counter("merchant_memory.hits") / lookups, 4))
+
+
+def apply_learned_categories(memory: dict, data: dict) -> dict:
+    """Replace the model's categories with the ones this user confirmed for the merchant"""
+    entry = memory.get(normalize_merchant(data.get("merchant")))
+
+    if data.get("receipt_type") == "store":
+        patterns = entry["patterns"] if entry else {}
+        for item in data.get("items", []):
+            category = None
+            for pattern in [normalize_pattern(item.get("description"))] + description_patterns(item.get("description")):
+                if pattern in patterns:
+                    category = patterns[pattern]
+                    break
+            _record_lookup(category is not None)
+            if category and category != item.get("category"):
+                item["category"] = category
+                metrics.increment("merchant_memory.recategorized")
+    else:
+        category = entry["category"] if entry else None
+        _record_lookup(category is not None)
+        if category and category != data.get("category"):
+            data["category"] = category
+            metrics.increment("merchant_memory.recategorized")
+
+    return data
+
+
+async def extract_with_memory(
+    memory: dict,
+    image_bytes: bytes,
+    user_language: str,
+    preprocess: bool = True,
+    user_id: Optional[int] = None
+) -> tuple[dict, Optional[str]]:
+    """extract_receipt plus merchant memory; returns (data, layout_hash for remember_layout)
+
+    A bill that matches a confirmed biller's layout goes through the short
+    bill prompt. Its result is kept only if the model read that biller's name
+    off the bill and an amount; then the stored name and category are filled
+    in. Anything else runs the full prompt as usual. The layout hash is taken
+    from the preprocessed image, so scans and queued jobs (which store
+    preprocessed bytes) hash the same way.
+    """
+    if preprocess:
+        image_bytes, _ = await asyncio.to_thread(prepare_image, image_bytes)
+
+    layout_hash = None
+    data = None
+    if MERCHANT_MEMORY_BILLER_PROMPT and _has_billers(memory):
+        # Only hash when there is a biller to match against
+        layout_hash = await asyncio.to_thread(layout_fingerprint, image_bytes)
+        biller = find_known_biller(memory, layout_hash)
+        if biller:
+            entry = memory[biller]
+            data = await extract_receipt(image_bytes, user_language, preprocess=False, known_biller=True, user_id=user_id)
+            if normalize_merchant(data.get("merchant")) != biller:
+                # Looks like the biller's bill but is someone else's (or the name is unreadable)
+                print(f"Layout matched biller '{entry['name']}' but the bill reads '{data.get('merchant')}': using the full prompt")
+                metrics.increment("merchant_memory.biller_mismatches")
+                data = None
+            elif data.get("amount") is None:
+                metrics.increment("merchant_memory.biller_fallbacks")
+                data = None
+            else:
+                data["merchant"] = entry["name"]
+                data["category"] = entry["category"]
+                metrics.increment("merchant_memory.biller_hits")
+                tokens_saved = (len(build_prompt(user_language)) - len(build_biller_prompt(user_language))) // CHARS_PER_TOKEN
+                metrics.increment("merchant_memory.prompt_tokens_saved", max(0, tokens_saved))
+                print(f"Known biller '{entry['name']}': used short prompt (~{tokens_saved} prompt tokens saved)")
+
+    if data is None:
+        data = await extract_receipt(image_bytes, user_language, preprocess=False, user_id=user_id)
+
+    return apply_learned_categories(memory, data), layout_hash
+
+
+def remember_layout(db: Session, user_id: int, memory: dict, data: dict, layout_hash: Optional[str]):
+    """Store the layout of a scanned bill so the next one from the same biller is recognized
+
+    Only kept for billers whose category the user has confirmed.
+    """
+    merchant = normalize_merchant(data.get("merchant"))
+    entry = memory.get(merchant)
+    if data.get("receipt_type") != "utility" or not entry or entry["confirmations"] <= 0:
+        return
+    if not layout_hash or layout_hash == entry["layout_hash"]:
+        return
+
+    db.query(MerchantCategory).filter(
+        MerchantCategory.user_id == user_id,
+        MerchantCategory.merchant == merchant,
+        MerchantCategory.pattern == ""
+    ).update({"layout_hash": layout_hash}, synchronize_session=False)
+    db.commit()
+    entry["layout_hash"] = layout_hash
+
+
+def learn_categories(db: Session, user_id: int, merchant_name: Optional[str], expenses: list):
+    """Remember the categories the user confirmed for a merchant's receipt
+
+    Every description part becomes a pattern; a receipt saved as a single
+    expense also sets the merchant's whole-bill category.
+    """
+    merchant = normalize_merchant(merchant_name)
+    if not merchant:
+        return
+
+    learned = {}  # pattern -> category
+    for expense in expenses:
+        if not expense.category or expense.category not in CATEGORIES:
+            continue
+        for pattern in description_patterns(expense.description):
+            learned[pattern] = expense.category
+    if len(expenses) == 1 and expenses[0].category in CATEGORIES:
+        learned[""] = expenses[0].category
+    if not learned:
+        return
+
+    rows = {
+        row.pattern: row
+        for row in db.query(MerchantCategory).filter(
+            MerchantCategory.user_id == user_id,
+            MerchantCategory.merchant == merchant
+        ).all()
+    }
+    pattern_count = sum(1 for pattern in rows if pattern)
+    for pattern, category in learned.items():
+        row = rows.get(pattern)
+        if row:
+            row.category = category
+            row.confirmations += 1
+            if not pattern:
+                row.merchant_name = merchant_name.strip()
+        elif pattern and pattern_count >= MERCHANT_MEMORY_MAX_PATTERNS:
+            continue
+        else:
+            db.add(MerchantCategory(
+                user_id=user_id,
+                merchant=merchant,
+                pattern=pattern,
+                category=category,
+                merchant_name=merchant_name.strip(),
+                confirmations=1
+            ))
+            if pattern:
+                pattern_count += 1
+    try:
+        db.commit()
+    except IntegrityError:
+        # The same receipt was confirmed twice at once; one write is enough
+        db.rollback()
+    forget_user(user_id)
+    metrics.increment("merchant_memory.patterns_learned", len(learned))
@@ -0,0 +1,36 @@
+"""
+In-process metrics registry.
+
+Counters and gauges are kept per worker process and exposed through
+GET /debug/metrics. Values are plain JSON types so they can be returned as-is.
+"""
+import threading
+from typing import Any
+
+_lock = threading.Lock()
+_counters: dict[str, float] = {}
+_gauges: dict[str, Any] = {}
+
+
+def increment(name: str, value: float = 1) -> None:
+    """Add value to a counter (created at 0 on first use)"""
+    with _lock:
+        _counters[name] = _counters.get(name, 0) + value
+
+
+def set_gauge(name: str, value: Any) -> None:
+    """Set a gauge to the latest observed value"""
+    with _lock:
+        _gauges[name] = value
+
+
+def get_counter(name: str) -> float:
+    """Get the current value of a counter"""
+    with _lock:
+        return _counters.get(name, 0)
+
+
+def snapshot() -> dict:
+    """Return a copy of all counters and gauges"""
+    with _lock:
+        return {"counters": dict(_counters), "gauges": dict(_gauges)}
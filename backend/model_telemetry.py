@@ -0,0 +1,129 @@
+"""
+Telemetry for OpenAI model calls.
+
+receipt_extraction reports every call (latency, tokens, cost, outcome) with
+record_model_call, which only appends to an in-memory buffer. A flusher task
+writes the buffer to model_calls in one multi-row INSERT every
+MODEL_TELEMETRY_FLUSH_SECONDS, or sooner once MODEL_TELEMETRY_BATCH_SIZE
+calls are waiting, so requests never wait on the telemetry write.
+"""
+import asyncio
+import os
+import threading
+from datetime import datetime
+from typing import Optional
+
+from sqlalchemy import insert
+
+from database import SessionLocal, ModelCall
+import metrics
+
+MODEL_TELEMETRY_ENABLED = os.getenv("MODEL_TELEMETRY_ENABLED", "true").lower() == "true"
+MODEL_TELEMETRY_BATCH_SIZE = int(os.getenv("MODEL_TELEMETRY_BATCH_SIZE", "50"))
+MODEL_TELEMETRY_FLUSH_SECONDS = float(os.getenv("MODEL_TELEMETRY_FLUSH_SECONDS", "5"))
+MODEL_TELEMETRY_MAX_BUFFER = int(os.getenv("MODEL_TELEMETRY_MAX_BUFFER", "10000"))  # Oldest rows are dropped beyond this
+
+_buffer: list[dict] = []
+_buffer_lock = threading.Lock()
+_flush_wakeup: Optional[asyncio.Event] = None
+_flusher_task: Optional[asyncio.Task] = None
+
+
+def record_model_call(
+    *,
+    user_id: Optional[int],
+    model: str,
+    prompt: str,
+    language: Optional[str],
+    receipt_type: Optional[str],
+    image_bytes: Optional[int],
+    latency_ms: float,
+    prompt_tokens: int,
+    completion_tokens: int,
+    cost_usd: float,
+    outcome: str
+):
+    """Queue one model call for the next batched write"""
+    if not MODEL_TELEMETRY_ENABLED:
+        return
+    row = {
+        "user_id": user_id,
+        "created_at": datetime.utcnow(),
+        "model": model,
+        "prompt": prompt,
+        "language": language,
+        "receipt_type": receipt_type,
+        "image_bytes": image_bytes,
+        "latency_ms": latency_ms,
+        "prompt_tokens": prompt_tokens,
+        "completion_tokens": completion_tokens,
+        "cost_usd": cost_usd,
+        "outcome": outcome,
+    }
+    with _buffer_lock:
+        _buffer.append(row)
+        if len(_buffer) > MODEL_TELEMETRY_MAX_BUFFER:
+            del _buffer[0]
+            metrics.increment("model_telemetry.dropped")
+        full = len(_buffer) >= MODEL_TELEMETRY_BATCH_SIZE
+    if full and _flush_wakeup is not None:
+        _flush_wakeup.set()
+
+
+def flush_model_calls() -> int:
+    """Write buffered calls to model_calls; returns the number of rows written"""
+    with _buffer_lock:
+        rows = _buffer[:]
+        _buffer.clear()
+    if not rows:
+        return 0
+
+    db = SessionLocal()
+    try:
+        db.execute(insert(ModelCall), rows)
+        db.commit()
+    except Exception as e:
+        db.rollback()
+        # Put the rows back for the next attempt (still bounded by the buffer limit)
+        with _buffer_lock:
+            room = MODEL_TELEMETRY_MAX_BUFFER - len(_buffer)
+            if room > 0:
+                _buffer[:0] = rows[-room:]
+        print(f"Model telemetry flush failed ({len(rows)} rows kept): {e}")
+        return 0
+    finally:
+        db.close()
+
+    metrics.increment("model_telemetry.rows_written", len(rows))
+    metrics.increment("model_telemetry.flushes")
+    return len(rows)
+
+
+async def _flusher_loop():
+    while True:
+        _flush_wakeup.clear()
+        try:
+            await asyncio.wait_for(_flush_wakeup.wait(), MODEL_TELEMETRY_FLUSH_SECONDS)
+        except asyncio.TimeoutError:
+            pass
+        await asyncio.to_thread(flush_model_calls)
+
+
+def start_telemetry_flusher():
+    """Start the periodic flusher on the running event loop"""
+    global _flush_wakeup, _flusher_task
+    if not MODEL_TELEMETRY_ENABLED or _flusher_task is not None:
+        return
+    _flush_wakeup = asyncio.Event()
+    _flusher_task = asyncio.create_task(_flusher_loop())
+
+
+async def stop_telemetry_flusher():
+    """Stop the flusher and write whatever is still buffered"""
+    global _flush_wakeup, _flusher_task
+    if _flusher_task is not None:
+        _flusher_task.cancel()
+        await asyncio.gather(_flusher_task, return_exceptions=True)
+    _flusher_task = None
+    _flush_wakeup = None
+    await asyncio.to_thread(flush_model_calls)
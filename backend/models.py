@@ -110,6 +110,7 @@ class PasswordReset(BaseModel):
 
 class ExpenseBatchIn(BaseModel):
     expenses: list[ExpenseIn]
+    merchant: Optional[str] = None  # Set when saving a reviewed receipt; teaches merchant categories
 
 
 class ReceiptScanRequest(BaseModel):
@@ -117,6 +118,11 @@ class ReceiptScanRequest(BaseModel):
     language: Optional[str] = 'en'  # User's language preference
 
 
+class ReceiptBatchScanRequest(BaseModel):
+    images_base64: list[str]
+    language: Optional[str] = 'en'
+
+
 class CheckoutRequest(BaseModel):
     plan_type: str  # 'extra_30' or 'unlimited'
 
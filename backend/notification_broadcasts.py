@@ -0,0 +1,203 @@
+"""
+Broadcast notifications: one message sent to many users.
+
+The text is stored once, in notification_templates. Each recipient gets an
+ordinary notifications row with template_id set and an empty message, so
+the feed, read state, unread counters and retention treat broadcasts like
+any other notification while the table doesn't carry 100k copies of the
+text.
+
+There are two ways to deliver:
+
+- Targeted (a plan's users) or --eager all-user broadcasts are written when
+  sent, in chunks of NOTIFICATION_BROADCAST_CHUNK_SIZE users: one INSERT ...
+  SELECT from users for the counters and one for the notifications per
+  chunk. The template records how far sending got, so an interrupted send
+  resumes where it stopped.
+- All-user broadcasts (the default) write nothing per user when sent. Each
+  user's counter row remembers the last all-user broadcast they received
+  (broadcast_seen_id); sync_broadcasts(), called before the feed and the
+  unread count are read, delivers newer ones to that user. Users who never
+  come back cost nothing, and users who sign up later don't get old ones.
+"""
+import os
+from datetime import datetime
+from typing import Optional
+
+from sqlalchemy import and_, func, insert, literal, or_, select, update
+from sqlalchemy.dialects.postgresql import insert as postgresql_insert
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlalchemy.orm import Session
+
+from database import Notification, NotificationCounter, NotificationTemplate, SessionLocal, Subscription, User
+from event_bus import publish, publish_after_commit
+import metrics
+
+NOTIFICATION_BROADCAST_CHUNK_SIZE = int(os.getenv("NOTIFICATION_BROADCAST_CHUNK_SIZE", "1000"))
+
+
+def audience_filter(audience: str):
+    """WHERE clause on users for a template's audience"""
+    if audience == "all":
+        return User.deleted_at.is_(None)
+    if audience.startswith("plan:"):
+        return and_(
+            User.deleted_at.is_(None),
+            User.id.in_(select(Subscription.user_id).where(
+                Subscription.plan_type == audience[len("plan:"):],
+                Subscription.status == "active"
+            ))
+        )
+    raise ValueError(f"Unknown audience: {audience}")
+
+
+def _event(template: NotificationTemplate, unread: Optional[int] = None) -> dict:
+    event = {"type": template.type, "message": template.message, "created_at": template.created_at.isoformat()}
+    if unread is not None:
+        event["unread_count"] = unread
+    return event
+
+
+def create_broadcast(
+    db: Session,
+    type: str,
+    message: str,
+    audience: str = "all",
+    eager: bool = False,
+    expires_at: Optional[datetime] = None
+) -> NotificationTemplate:
+    """Store a broadcast; all-user ones are live at once, others need send_broadcast()"""
+    audience_filter(audience)  # Reject unknown audiences before storing anything
+    now = datetime.utcnow()
+    all_users = audience == "all" and not eager
+    template = NotificationTemplate(
+        type=type,
+        message=message,
+        audience=audience,
+        all_users=all_users,
+        expires_at=expires_at,
+        completed_at=now if all_users else None,  # Nothing to send up front
+        created_at=now
+    )
+    db.add(template)
+    db.commit()
+    if all_users:
+        # Open streams hear about it now; their counters catch up on the next read
+        publish(None, "notification", _event(template))
+        metrics.increment("notifications.broadcasts_sent")
+    return template
+
+
+def send_broadcast(template_id: int, chunk_size: int = NOTIFICATION_BROADCAST_CHUNK_SIZE) -> int:
+    """Write delivery rows for a targeted/eager broadcast, resuming if interrupted; returns rows written"""
+    db = SessionLocal()
+    written = 0
+    try:
+        template = db.get(NotificationTemplate, template_id)
+        if template is None:
+            raise ValueError(f"No broadcast {template_id}")
+        if template.all_users or template.completed_at is not None:
+            return 0
+        dialect_insert = postgresql_insert if db.bind.dialect.name == "postgresql" else sqlite_insert
+        recipients = audience_filter(template.audience)
+
+        while True:
+            now = datetime.utcnow()
+            # Counters first, in user id order, as notification_service does
+            chunk = (
+                select(User.id, literal(1), literal(now))
+                .where(User.id > (template.sent_through_user_id or 0), recipients)
+                .order_by(User.id)
+                .limit(chunk_size)
+            )
+            stmt = dialect_insert(NotificationCounter).from_select(["user_id", "unread", "updated_at"], chunk)
+            counted = db.execute(
+                stmt.on_conflict_do_update(
+                    index_elements=["user_id"],
+                    set_={"unread": NotificationCounter.unread + 1, "updated_at": now}
+                ).returning(NotificationCounter.user_id, NotificationCounter.unread)
+            ).all()
+            if not counted:
+                template.completed_at = now
+                db.commit()
+                break
+
+            user_ids = [row.user_id for row in counted]
+            db.execute(
+                insert(Notification).from_select(
+                    ["user_id", "template_id", "message", "type", "read", "created_at"],
+                    select(
+                        User.id, literal(template.id), literal(""), literal(template.type),
+                        literal(False), literal(template.created_at)
+                    ).where(User.id.in_(user_ids))
+                )
+            )
+            template.sent_through_user_id = max(user_ids)
+            template.recipients += len(user_ids)
+            event = _event(template)
+            for row in counted:
+                publish_after_commit(db, row.user_id, "notification", {**event, "unread_count": row.unread})
+            db.commit()
+            written += len(user_ids)
+            metrics.increment("notifications.created", len(user_ids))
+    finally:
+        db.close()
+
+    metrics.increment("notifications.broadcasts_sent")
+    return written
+
+
+def sync_broadcasts(db: Session, user_id: int) -> int:
+    """Deliver all-user broadcasts this user hasn't received yet; returns how many (commits if any)"""
+    seen_id, latest_id = db.execute(select(
+        select(NotificationCounter.broadcast_seen_id)
+        .where(NotificationCounter.user_id == user_id).scalar_subquery(),
+        select(func.max(NotificationTemplate.id))
+        .where(NotificationTemplate.all_users == True).scalar_subquery()
+    )).one()
+    if latest_id is None or (seen_id or 0) >= latest_id:
+        return 0  # The usual case: one cheap read
+
+    now = datetime.utcnow()
+    pending = select(
+        literal(user_id), NotificationTemplate.id, literal(""), NotificationTemplate.type,
+        literal(False), NotificationTemplate.created_at
+    ).join(User, User.id == user_id).where(
+        NotificationTemplate.all_users == True,
+        NotificationTemplate.id > (seen_id or 0),
+        NotificationTemplate.id <= latest_id,
+        NotificationTemplate.created_at >= User.created_at,  # Nothing from before they signed up
+        or_(NotificationTemplate.expires_at.is_(None), NotificationTemplate.expires_at > now)
+    )
+    count = db.execute(select(func.count()).select_from(pending.subquery())).scalar()
+
+    dialect_insert = postgresql_insert if db.bind.dialect.name == "postgresql" else sqlite_insert
+    db.execute(
+        dialect_insert(NotificationCounter)
+        .values(user_id=user_id, unread=0, updated_at=now)
+        .on_conflict_do_nothing(index_elements=["user_id"])
+    )
+    # Claim (seen_id, latest_id]: a concurrent sync for the same user matches no row and stops here
+    unread = db.execute(
+        update(NotificationCounter)
+        .where(
+            NotificationCounter.user_id == user_id,
+            func.coalesce(NotificationCounter.broadcast_seen_id, 0) == (seen_id or 0)
+        )
+        .values(broadcast_seen_id=latest_id, unread=NotificationCounter.unread + count, updated_at=now)
+        .returning(NotificationCounter.unread)
+        .execution_options(synchronize_session=False)
+    ).scalar()
+    if unread is None:
+        db.rollback()
+        return 0
+    if count:
+        db.execute(
+            insert(Notification).from_select(
+                ["user_id", "template_id", "message", "type", "read", "created_at"], pending
+            )
+        )
+        publish_after_commit(db, user_id, "unread_count", {"unread_count": unread})
+    db.commit()
+    metrics.increment("notifications.broadcasts_delivered", count)
+    return count
@@ -0,0 +1,353 @@
+"""
+Creating in-app notifications, marking them read and counting unread ones.
+
+Everything that notifies a user goes through here. notify() adds one row to
+the caller's session, committed together with the caller's other changes;
+notify_many() writes a batch as a single executemany INSERT, for jobs that
+notify many users at once. mark_all_read() is one UPDATE over the user's
+unread rows, found through the partial unread index. Each change is also
+published to the user's open event streams once the caller commits.
+
+Unread counts live in notification_counters, one row per user, so reading
+one is a primary-key lookup. Every write here adjusts the counter in the
+same transaction: an upsert (+n) when notifications are created, a
+decrement by the number of rows actually marked read. Creating takes the
+counter row first and marking read takes it last; reconcile_unread_counters
+relies on that order when it recounts with the counter rows locked, so it
+repairs drift without introducing any.
+
+prune_notifications is the retention job: it deletes read notifications
+past NOTIFICATION_RETENTION_READ_DAYS (optionally unread ones too, and only
+some types), trims each user to their NOTIFICATION_RETENTION_KEEP_PER_USER
+newest, and drops broadcast templates nothing refers to any more. Deletes
+run in short transactions over small primary-key ranges or id chunks, and
+unread rows it removes come off the user's counter like marking them read.
+"""
+import os
+from collections import Counter
+from datetime import datetime, timedelta
+from typing import Optional
+
+from sqlalchemy import and_, case, delete, exists, func, insert, literal, or_, select, text, tuple_, update
+from sqlalchemy.exc import IntegrityError, OperationalError
+from sqlalchemy.dialects.postgresql import insert as postgresql_insert
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlalchemy.orm import Session
+
+from database import Notification, NotificationCounter, NotificationTemplate, SessionLocal
+from event_bus import publish_after_commit
+import metrics
+
+NOTIFICATION_COUNTER_RECONCILE_INTERVAL_SECONDS = float(os.getenv("NOTIFICATION_COUNTER_RECONCILE_INTERVAL_SECONDS", "3600"))
+NOTIFICATION_COUNTER_RECONCILE_BATCH_SIZE = int(os.getenv("NOTIFICATION_COUNTER_RECONCILE_BATCH_SIZE", "1000"))
+
+# Retention: 0 disables a rule
+NOTIFICATION_RETENTION_READ_DAYS = int(os.getenv("NOTIFICATION_RETENTION_READ_DAYS", "90"))
+NOTIFICATION_RETENTION_UNREAD_DAYS = int(os.getenv("NOTIFICATION_RETENTION_UNREAD_DAYS", "0"))
+NOTIFICATION_RETENTION_KEEP_PER_USER = int(os.getenv("NOTIFICATION_RETENTION_KEEP_PER_USER", "500"))
+# Limit the age rules to these types (comma-separated); empty means every type
+NOTIFICATION_RETENTION_TYPES = [t.strip() for t in os.getenv("NOTIFICATION_RETENTION_TYPES", "").split(",") if t.strip()]
+NOTIFICATION_RETENTION_INTERVAL_SECONDS = int(os.getenv("NOTIFICATION_RETENTION_INTERVAL_SECONDS", str(6 * 3600)))
+NOTIFICATION_RETENTION_CHUNK_SIZE = int(os.getenv("NOTIFICATION_RETENTION_CHUNK_SIZE", "1000"))
+
+
+def _dialect_insert(db: Session):
+    return postgresql_insert if db.bind.dialect.name == "postgresql" else sqlite_insert
+
+
+def _event(notification: dict, unread: int) -> dict:
+    return {
+        "type": notification["type"],
+        "message": notification["message"],
+        "created_at": notification["created_at"].isoformat(),
+        "unread_count": unread,
+    }
+
+
+def _add_unread(db: Session, counts: dict) -> dict:
+    """Add counts[user_id] to each user's counter (creating it); returns the new values"""
+    now = datetime.utcnow()
+    insert_stmt = _dialect_insert(db)(NotificationCounter)
+    unread = {}
+    users = sorted(counts)  # Same lock order in every transaction
+    for start in range(0, len(users), 1000):
+        stmt = insert_stmt.values([
+            {"user_id": user_id, "unread": counts[user_id], "updated_at": now}
+            for user_id in users[start:start + 1000]
+        ])
+        stmt = stmt.on_conflict_do_update(
+            index_elements=["user_id"],
+            set_={"unread": NotificationCounter.unread + stmt.excluded.unread, "updated_at": now}
+        ).returning(NotificationCounter.user_id, NotificationCounter.unread)
+        unread.update(db.execute(stmt).tuples().all())
+    return unread
+
+
+def _subtract_unread(db: Session, user_id: int, count: int) -> int:
+    unread = db.execute(
+        update(NotificationCounter)
+        .where(NotificationCounter.user_id == user_id)
+        .values(
+            unread=case((NotificationCounter.unread > count, NotificationCounter.unread - count), else_=0),
+            updated_at=datetime.utcnow()
+        )
+        .returning(NotificationCounter.unread)
+        .execution_options(synchronize_session=False)
+    ).scalar()
+    return unread or 0
+
+
+def get_unread_count(db: Session, user_id: int) -> int:
+    return db.query(NotificationCounter.unread).filter(NotificationCounter.user_id == user_id).scalar() or 0
+
+
+def notify(db: Session, user_id: int, type: str, message: str, created_at: Optional[datetime] = None):
+    """Queue one notification on the caller's session (the caller commits)"""
+    notification = {"message": message, "type": type, "created_at": created_at or datetime.utcnow()}
+    unread = _add_unread(db, {user_id: 1})[user_id]
+    db.add(Notification(user_id=user_id, read=False, **notification))
+    publish_after_commit(db, user_id, "notification", _event(notification, unread))
+    metrics.increment("notifications.created")
+
+
+def notify_many(db: Session, notifications: list[dict]) -> int:
+    """Insert {"user_id", "type", "message"[, "created_at"]} rows in one statement (the caller commits)"""
+    if not notifications:
+        return 0
+    now = datetime.utcnow()
+    rows = [
+        {
+            "user_id": notification["user_id"],
+            "message": notification["message"],
+            "type": notification["type"],
+            "read": False,
+            "created_at": notification.get("created_at") or now,
+        }
+        for notification in notifications
+    ]
+    unread = _add_unread(db, Counter(row["user_id"] for row in rows))
+    db.execute(insert(Notification), rows)
+    for row in rows:
+        publish_after_commit(db, row["user_id"], "notification", _event(row, unread[row["user_id"]]))
+    metrics.increment("notifications.created", len(notifications))
+    return len(notifications)
+
+
+def mark_read(db: Session, user_id: int, notification_id: int) -> bool:
+    """Mark one of the user's notifications read; False if it isn't theirs (the caller commits)"""
+    changed = db.execute(
+        update(Notification)
+        .where(Notification.id == notification_id, Notification.user_id == user_id, Notification.read == False)
+        .values(read=True)
+        .returning(Notification.id)
+        .execution_options(synchronize_session=False)
+    ).scalar()
+    if changed is None:
+        # Already read, or not this user's
+        return db.query(Notification.id).filter(
+            Notification.id == notification_id,
+            Notification.user_id == user_id
+        ).first() is not None
+    unread = _subtract_unread(db, user_id, 1)
+    publish_after_commit(db, user_id, "unread_count", {"unread_count": unread})
+    metrics.increment("notifications.marked_read")
+    return True
+
+
+def mark_all_read(db: Session, user_id: int) -> int:
+    """Mark the user's unread notifications read; returns how many changed (the caller commits)"""
+    updated = db.execute(
+        update(Notification)
+        .where(Notification.user_id == user_id, Notification.read == False)
+        .values(read=True)
+        .execution_options(synchronize_session=False)
+    ).rowcount
+    if updated:
+        # Subtract what this UPDATE changed: notifications created meanwhile stay counted
+        unread = _subtract_unread(db, user_id, updated)
+        publish_after_commit(db, user_id, "unread_count", {"unread_count": unread})
+    metrics.increment("notifications.marked_read", updated)
+    return updated
+
+
+def reconcile_unread_counters() -> int:
+    """Recount unread notifications and fix counters that drifted; returns how many were fixed"""
+    db = SessionLocal()
+    repaired = 0
+    try:
+        # Users with unread notifications but no counter yet; the recount below sets the value
+        now = datetime.utcnow()
+        db.execute(
+            _dialect_insert(db)(NotificationCounter).from_select(
+                ["user_id", "unread", "updated_at"],
+                select(Notification.user_id, literal(0), literal(now))
+                .where(
+                    Notification.read == False,
+                    ~exists().where(NotificationCounter.user_id == Notification.user_id)
+                )
+                .group_by(Notification.user_id)
+            ).on_conflict_do_nothing(index_elements=["user_id"])
+        )
+        db.commit()
+
+        last_user_id = 0
+        while True:
+            # Lock the batch's counters first: a notify() in flight already holds its
+            # counter, so the recount below starts after it commits and includes its row
+            user_ids = db.execute(
+                select(NotificationCounter.user_id)
+                .where(NotificationCounter.user_id > last_user_id)
+                .order_by(NotificationCounter.user_id)
+                .limit(NOTIFICATION_COUNTER_RECONCILE_BATCH_SIZE)
+                .with_for_update()
+            ).scalars().all()
+            if not user_ids:
+                db.commit()
+                break
+
+            actual = select(func.count(Notification.id)).where(
+                Notification.user_id == NotificationCounter.user_id,
+                Notification.read == False
+            ).scalar_subquery()
+            fixed = db.execute(
+                update(NotificationCounter)
+                .where(NotificationCounter.user_id.in_(user_ids), NotificationCounter.unread != actual)
+                .values(unread=actual, updated_at=datetime.utcnow())
+                .returning(NotificationCounter.user_id, NotificationCounter.unread)
+                .execution_options(synchronize_session=False)
+            ).all()
+            for row in fixed:
+                publish_after_commit(db, row.user_id, "unread_count", {"unread_count": row.unread})
+            db.commit()
+
+            repaired += len(fixed)
+            last_user_id = user_ids[-1]
+            if len(user_ids) < NOTIFICATION_COUNTER_RECONCILE_BATCH_SIZE:
+                break
+    finally:
+        db.close()
+
+    metrics.increment("notifications.counters_repaired", repaired)
+    if repaired:
+        print(f"Unread counter reconcile: repaired {repaired} counters")
+    return repaired
+
+
+def _delete_notifications(db: Session, where) -> int:
+    """Delete one chunk of notifications, taking unread ones off their counters; commits"""
+    deleted = db.execute(
+        delete(Notification)
+        .where(where)
+        .returning(Notification.user_id, Notification.read)
+        .execution_options(synchronize_session=False)
+    ).all()
+    unread = Counter(row.user_id for row in deleted if not row.read)
+    for user_id in sorted(unread):
+        remaining = _subtract_unread(db, user_id, unread[user_id])
+        publish_after_commit(db, user_id, "unread_count", {"unread_count": remaining})
+    db.commit()
+    return len(deleted)
+
+
+def _notifications_table_bytes(db: Session) -> Optional[int]:
+    """On-disk size of notifications and its indexes (None where the database can't tell)"""
+    try:
+        if db.bind.dialect.name == "postgresql":
+            return db.execute(text("SELECT pg_total_relation_size('notifications')")).scalar()
+        return db.execute(text(
+            "SELECT SUM(pgsize) FROM dbstat WHERE name IN "
+            "(SELECT name FROM sqlite_master WHERE tbl_name = 'notifications')"
+        )).scalar()
+    except OperationalError:
+        db.rollback()  # SQLite built without the dbstat table
+        return None
+
+
+def prune_notifications() -> int:
+    """Apply the retention rules in small batches; returns how many notifications were deleted"""
+    now = datetime.utcnow()
+    db = SessionLocal()
+    aged = capped = templates = 0
+    try:
+        expired = []
+        if NOTIFICATION_RETENTION_READ_DAYS:
+            expired.append(and_(
+                Notification.read == True,
+                Notification.created_at < now - timedelta(days=NOTIFICATION_RETENTION_READ_DAYS)
+            ))
+        if NOTIFICATION_RETENTION_UNREAD_DAYS:
+            expired.append(and_(
+                Notification.read == False,
+                Notification.created_at < now - timedelta(days=NOTIFICATION_RETENTION_UNREAD_DAYS)
+            ))
+        if expired:
+            condition = or_(*expired)
+            if NOTIFICATION_RETENTION_TYPES:
+                condition = and_(condition, Notification.type.in_(NOTIFICATION_RETENTION_TYPES))
+            # Walk the primary key in fixed ranges: each DELETE touches at most one chunk of rows,
+            # however the expired ones are spread (lazy broadcast rows are new ids with old dates)
+            last_id = db.query(func.max(Notification.id)).scalar() or 0
+            db.commit()
+            for start in range(0, last_id, NOTIFICATION_RETENTION_CHUNK_SIZE):
+                aged += _delete_notifications(db, and_(
+                    Notification.id > start,
+                    Notification.id <= start + NOTIFICATION_RETENTION_CHUNK_SIZE,
+                    condition
+                ))
+
+        if NOTIFICATION_RETENTION_KEEP_PER_USER:
+            over_limit = db.query(Notification.user_id).group_by(Notification.user_id).having(
+                func.count(Notification.id) > NOTIFICATION_RETENTION_KEEP_PER_USER
+            ).all()
+            db.commit()
+            for (user_id,) in over_limit:
+                # The oldest notification the user keeps; everything before it goes
+                oldest_kept = db.query(Notification.created_at, Notification.id).filter(
+                    Notification.user_id == user_id
+                ).order_by(
+                    Notification.created_at.desc(), Notification.id.desc()
+                ).offset(NOTIFICATION_RETENTION_KEEP_PER_USER - 1).limit(1).first()
+                while oldest_kept is not None:
+                    chunk = select(Notification.id).where(
+                        Notification.user_id == user_id,
+                        tuple_(Notification.created_at, Notification.id) < tuple_(*oldest_kept)
+                    ).limit(NOTIFICATION_RETENTION_CHUNK_SIZE).subquery()
+                    deleted = _delete_notifications(db, Notification.id.in_(select(chunk.c[0])))
+                    capped += deleted
+                    if deleted < NOTIFICATION_RETENTION_CHUNK_SIZE:
+                        break
+
+        # Broadcasts with no deliveries left that won't be delivered again
+        finished = or_(
+            and_(NotificationTemplate.all_users == False, NotificationTemplate.completed_at.isnot(None)),
+            NotificationTemplate.expires_at < now,
+        )
+        if NOTIFICATION_RETENTION_READ_DAYS:
+            finished = or_(finished, and_(
+                NotificationTemplate.all_users == True,
+                NotificationTemplate.created_at < now - timedelta(days=NOTIFICATION_RETENTION_READ_DAYS)
+            ))
+        try:
+            templates = db.execute(
+                delete(NotificationTemplate).where(
+                    finished,
+                    ~exists().where(Notification.template_id == NotificationTemplate.id)
+                ).execution_options(synchronize_session=False)
+            ).rowcount or 0
+            db.commit()
+        except IntegrityError:
+            # A user was being sent one of them just now; it goes on a later run
+            db.rollback()
+
+        table_bytes = _notifications_table_bytes(db)
+    finally:
+        db.close()
+
+    metrics.increment("notifications.pruned_expired", aged)
+    metrics.increment("notifications.pruned_over_limit", capped)
+    metrics.increment("notification_templates.pruned", templates)
+    if table_bytes is not None:
+        metrics.set_gauge("notifications.table_bytes", table_bytes)
+    if aged or capped or templates:
+        print(f"Pruned {aged} expired and {capped} over-limit notifications, {templates} broadcast templates")
+    return aged + capped
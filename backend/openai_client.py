@@ -0,0 +1,58 @@
+"""
+Shared async OpenAI client for receipt scanning.
+
+One AsyncOpenAI client (and its HTTP connection pool) is reused for every
+request in the worker, and a semaphore caps how many model calls are in
+flight at once so a burst of scans queues instead of piling onto OpenAI.
+Timeouts and retries (with the SDK's exponential backoff) come from env vars.
+"""
+import asyncio
+import os
+from typing import Optional
+
+from openai import AsyncOpenAI
+
+import metrics
+
+OPENAI_BASE_URL = os.getenv("OPENAI_BASE_URL")  # e.g. a local fake server for load tests
+OPENAI_TIMEOUT_SECONDS = float(os.getenv("OPENAI_TIMEOUT_SECONDS", "60"))
+OPENAI_MAX_RETRIES = int(os.getenv("OPENAI_MAX_RETRIES", "2"))
+OPENAI_MAX_CONCURRENT_SCANS = int(os.getenv("OPENAI_MAX_CONCURRENT_SCANS", "8"))
+
+_client: Optional[AsyncOpenAI] = None
+_semaphore: Optional[asyncio.Semaphore] = None
+_loop: Optional[asyncio.AbstractEventLoop] = None
+_in_flight = 0
+
+
+def _ensure_loop_state():
+    """(Re)create the client and semaphore for the running event loop
+
+    Both are bound to the loop they are first used on; a new loop (tests,
+    benchmark runs) gets fresh instances.
+    """
+    global _client, _semaphore, _loop
+    loop = asyncio.get_running_loop()
+    if _loop is not loop:
+        _client = AsyncOpenAI(
+            api_key=os.getenv("OPENAI_API_KEY"),
+            base_url=OPENAI_BASE_URL,
+            timeout=OPENAI_TIMEOUT_SECONDS,
+            max_retries=OPENAI_MAX_RETRIES,
+        )
+        _semaphore = asyncio.Semaphore(OPENAI_MAX_CONCURRENT_SCANS)
+        _loop = loop
+
+
+async def create_chat_completion(**kwargs):
+    """Call chat.completions.create, waiting for a free slot first"""
+    global _in_flight
+    _ensure_loop_state()
+    async with _semaphore:
+        _in_flight += 1
+        metrics.set_gauge("openai.in_flight", _in_flight)
+        try:
+            return await _client.chat.completions.create(**kwargs)
+        finally:
+            _in_flight -= 1
+            metrics.set_gauge("openai.in_flight", _in_flight)
@@ -0,0 +1,168 @@
+"""
+Promo code redemption and generation.
+
+Redeeming is one short transaction that never reads-then-writes the code's
+counter:
+
+1. INSERT a promo_redemptions row (unique per user and code, ON CONFLICT DO
+   NOTHING), so a user can't redeem the same code twice, even concurrently;
+2. UPDATE promo_codes SET used_count = used_count + 1 WHERE the code is
+   active, unexpired and under max_uses ... RETURNING id, which checks the
+   limit and takes the use in one statement;
+3. switch the user's subscription to the code's plan and commit.
+
+If step 2 matches nothing the transaction is rolled back (taking the
+redemption row with it) and the code is read once more only to say why. The
+promo row is locked only between the UPDATE and the COMMIT, so a launch code
+redeemed by many users at once can't be oversubscribed and doesn't hold
+redeemers up for long.
+"""
+import secrets
+from datetime import datetime
+from typing import Optional
+
+from sqlalchemy import or_, update
+from sqlalchemy.dialects.postgresql import insert as postgresql_insert
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlalchemy.orm import Session
+
+from database import PromoCode, PromoCodeType, PromoRedemption, SubscriptionPlanType, SubscriptionStatus
+from entitlements import get_or_create_subscription, invalidate_entitlement
+import metrics
+
+# Plan each promo code type grants
+PROMO_PLANS = {
+    PromoCodeType.UNLIMITED.value: SubscriptionPlanType.FREE.value,
+}
+
+# No 0/O or 1/I/L: codes get read out and typed in by hand
+CODE_ALPHABET = "ABCDEFGHJKMNPQRSTUVWXYZ23456789"
+
+
+class PromoCodeError(Exception):
+    """Redemption refused; status_code and detail are what the client should see"""
+
+    def __init__(self, status_code: int, detail: str):
+        super().__init__(detail)
+        self.status_code = status_code
+        self.detail = detail
+
+
+def normalize_code(code: str) -> str:
+    return (code or "").strip().upper()
+
+
+def _redeemable(now: datetime):
+    return (
+        (PromoCode.is_active == True)
+        & or_(PromoCode.max_uses.is_(None), PromoCode.used_count < PromoCode.max_uses)
+        & or_(PromoCode.expires_at.is_(None), PromoCode.expires_at > now)
+    )
+
+
+def _refusal(db: Session, promo_id: int, now: datetime) -> PromoCodeError:
+    """Why the conditional UPDATE matched nothing (read after the rollback, for the message only)"""
+    promo = db.query(PromoCode).filter(PromoCode.id == promo_id).first()
+    if not promo or not promo.is_active:
+        return PromoCodeError(404, "Promo code not found or invalid")
+    if promo.expires_at and promo.expires_at <= now:
+        return PromoCodeError(400, "Promo code has expired")
+    return PromoCodeError(400, "Promo code has reached maximum uses")
+
+
+def redeem_promo_code(db: Session, user_id: int, code: str) -> str:
+    """Redeem code for the user and return the plan it granted; raises PromoCodeError"""
+    code = normalize_code(code)
+    promo = db.query(PromoCode.id, PromoCode.type).filter(
+        PromoCode.code == code,
+        PromoCode.is_active == True
+    ).first()
+    if not promo:
+        metrics.increment("promo_codes.rejected")
+        raise PromoCodeError(404, "Promo code not found or invalid")
+    plan_type = PROMO_PLANS.get(promo.type)
+    if not plan_type:
+        metrics.increment("promo_codes.rejected")
+        raise PromoCodeError(400, "Invalid promo code type")
+    # Ends the read transaction; the writes below start a short one of their own
+    db.commit()
+
+    now = datetime.utcnow()
+    dialect_insert = postgresql_insert if db.bind.dialect.name == "postgresql" else sqlite_insert
+    recorded = db.execute(
+        dialect_insert(PromoRedemption)
+        .values(user_id=user_id, promo_code_id=promo.id, redeemed_at=now)
+        .on_conflict_do_nothing(index_elements=["user_id", "promo_code_id"])
+    ).rowcount
+    if not recorded:
+        db.rollback()
+        metrics.increment("promo_codes.rejected")
+        raise PromoCodeError(400, "You have already used this promo code")
+
+    taken = db.execute(
+        update(PromoCode)
+        .where(PromoCode.id == promo.id, _redeemable(now))
+        .values(used_count=PromoCode.used_count + 1)
+        .returning(PromoCode.id)
+        .execution_options(synchronize_session=False)
+    ).scalar()
+    if taken is None:
+        db.rollback()
+        metrics.increment("promo_codes.rejected")
+        raise _refusal(db, promo.id, now)
+
+    subscription = get_or_create_subscription(db, user_id, commit=False)
+    subscription.plan_type = plan_type
+    subscription.promo_code_id = promo.id
+    subscription.status = SubscriptionStatus.ACTIVE.value
+    invalidate_entitlement(db, user_id)
+    db.commit()
+    metrics.increment("promo_codes.redeemed")
+    return plan_type
+
+
+def random_code(prefix: str = "", length: int = 8) -> str:
+    return normalize_code(prefix) + "".join(secrets.choice(CODE_ALPHABET) for _ in range(length))
+
+
+def create_promo_codes(
+    db: Session,
+    codes: list[str],
+    type: str = PromoCodeType.UNLIMITED.value,
+    max_uses: Optional[int] = None,
+    expires_at: Optional[datetime] = None
+) -> list[str]:
+    """Insert codes that don't exist yet in one statement; returns the ones created"""
+    if not codes:
+        return []
+    codes = list(dict.fromkeys(normalize_code(code) for code in codes))
+    dialect_insert = postgresql_insert if db.bind.dialect.name == "postgresql" else sqlite_insert
+    now = datetime.utcnow()
+    created = db.execute(
+        dialect_insert(PromoCode)
+        .values([
+            {"code": code, "type": type, "max_uses": max_uses, "used_count": 0,
+             "expires_at": expires_at, "is_active": True, "created_at": now}
+            for code in codes
+        ])
+        .on_conflict_do_nothing(index_elements=["code"])
+        .returning(PromoCode.code)
+    ).scalars().all()
+    db.commit()
+    return created
+
+
+def generate_promo_codes(
+    db: Session,
+    count: int,
+    prefix: str = "",
+    length: int = 8,
+    chunk_size: int = 500,
+    **settings
+) -> list[str]:
+    """Create `count` new random codes in chunks, drawing again for any that collide"""
+    created: list[str] = []
+    while len(created) < count:
+        wanted = min(chunk_size, count - len(created))
+        created.extend(create_promo_codes(db, [random_code(prefix, length) for _ in range(wanted)], **settings))
+    return created
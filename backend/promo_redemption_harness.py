@@ -0,0 +1,186 @@
+#!/usr/bin/env python3
+"""
+Redeem one limited promo code from many threads at once and check it can't
+be oversubscribed.
+
+Runs on a scratch SQLite database in a temp directory (or DATABASE_URL with
+--database-url). Creates --users users and a code with --max-uses uses, then
+every thread, each with its own session, redeems the code for a user; a
+share of the attempts (--duplicate-rate) repeat a user who already has one
+in flight or done. Afterwards it checks that:
+
+- used_count == promo_redemptions rows == successful redemptions
+  == min(max_uses, distinct users),
+- no user redeemed the code twice, and
+- exactly the redeeming users have the promo on their subscription.
+
+    python promo_redemption_harness.py --users 300 --max-uses 100 --threads 32
+    python promo_redemption_harness.py --legacy     # the old read-check-increment, for comparison
+    python promo_redemption_harness.py --database-url postgresql://localhost/expense_harness
+"""
+import argparse
+import os
+import random
+import sys
+import tempfile
+import threading
+import time
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+
+BACKEND_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, BACKEND_DIR)
+
+CODE = "HARNESS-LAUNCH"
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Concurrent promo code redemption check")
+    parser.add_argument("--users", type=int, default=300)
+    parser.add_argument("--max-uses", type=int, default=100)
+    parser.add_argument("--threads", type=int, default=32)
+    parser.add_argument("--duplicate-rate", type=float, default=0.3, help="share of extra attempts by users who already tried")
+    parser.add_argument("--legacy", action="store_true", help="redeem the old way (read, check in Python, increment)")
+    parser.add_argument("--database-url", help="run against this database instead of a scratch SQLite file")
+    parser.add_argument("--seed", type=int)
+    return parser.parse_args()
+
+
+def setup(users: int, max_uses: int) -> list[int]:
+    from database import PromoCode, SessionLocal, User, init_db
+
+    init_db()
+    db = SessionLocal()
+    try:
+        stamp = int(time.time() * 1000)
+        db.add_all([
+            User(email=f"promo-{stamp}-{index}@example.com", password_hash="!", name="Harness")
+            for index in range(users)
+        ])
+        db.query(PromoCode).filter(PromoCode.code == CODE).delete()
+        db.add(PromoCode(code=CODE, type="unlimited_access", max_uses=max_uses, used_count=0, is_active=True))
+        db.commit()
+        return [user_id for (user_id,) in db.query(User.id).filter(User.email.like(f"promo-{stamp}-%"))]
+    finally:
+        db.close()
+
+
+def legacy_redeem(db, user_id: int, code: str):
+    """What apply_promo_code did before: the limit is checked on a value read earlier"""
+    from database import PromoCode, SubscriptionPlanType, SubscriptionStatus
+    from entitlements import get_or_create_subscription
+    from promo_codes import PromoCodeError
+
+    promo = db.query(PromoCode).filter(PromoCode.code == code, PromoCode.is_active == True).first()
+    if not promo:
+        raise PromoCodeError(404, "Promo code not found or invalid")
+    if promo.max_uses and promo.used_count >= promo.max_uses:
+        raise PromoCodeError(400, "Promo code has reached maximum uses")
+    subscription = get_or_create_subscription(db, user_id)
+    subscription.plan_type = SubscriptionPlanType.FREE.value
+    subscription.promo_code_id = promo.id
+    subscription.status = SubscriptionStatus.ACTIVE.value
+    promo.used_count += 1
+    db.commit()
+
+
+def run(attempts: list[int], threads: int, legacy: bool) -> tuple[Counter, list[float]]:
+    from database import SessionLocal
+    from promo_codes import PromoCodeError, redeem_promo_code
+
+    redeem = legacy_redeem if legacy else redeem_promo_code
+    outcomes: Counter = Counter()
+    latencies: list[float] = []
+    lock = threading.Lock()
+    start = threading.Barrier(threads)
+
+    def attempt(index: int):
+        if index < threads:
+            start.wait()  # The first wave hits the code together
+        db = SessionLocal()
+        began = time.perf_counter()
+        try:
+            redeem(db, attempts[index], CODE)
+            outcome = "redeemed"
+        except PromoCodeError as e:
+            db.rollback()
+            outcome = e.detail
+        except Exception as e:
+            db.rollback()
+            outcome = f"error: {type(e).__name__}: {e}".splitlines()[0]
+        finally:
+            db.close()
+        with lock:
+            outcomes[outcome] += 1
+            latencies.append((time.perf_counter() - began) * 1000)
+
+    with ThreadPoolExecutor(max_workers=threads) as pool:
+        list(pool.map(attempt, range(len(attempts))))
+    return outcomes, latencies
+
+
+def verify(user_ids: list[int], max_uses: int, redeemed: int, legacy: bool) -> bool:
+    from sqlalchemy import func
+
+    from database import PromoCode, PromoRedemption, SessionLocal, Subscription
+
+    db = SessionLocal()
+    try:
+        promo = db.query(PromoCode).filter(PromoCode.code == CODE).one()
+        rows = db.query(PromoRedemption.user_id).filter(PromoRedemption.promo_code_id == promo.id).all()
+        duplicates = sum(count - 1 for count in Counter(user_id for (user_id,) in rows).values() if count > 1)
+        subscribed = db.query(func.count(Subscription.id)).filter(Subscription.promo_code_id == promo.id).scalar()
+        expected = min(max_uses, len(user_ids))
+
+        print(f"used_count={promo.used_count} redemption_rows={len(rows)} redeemed={redeemed} "
+              f"subscriptions_with_promo={subscribed} expected={expected} duplicate_redemptions={duplicates}")
+        if legacy:
+            # No redemption rows the old way; only the counter and the subscriptions can be compared
+            checks = {
+                "not oversubscribed": redeemed <= max_uses and subscribed <= max_uses,
+                "used_count matches subscriptions": promo.used_count == subscribed,
+            }
+        else:
+            checks = {
+                "used_count matches redemptions": promo.used_count == len(rows) == redeemed,
+                "limit reached exactly": redeemed == expected,
+                "no user redeemed twice": duplicates == 0,
+                "subscriptions match redemptions": subscribed == redeemed,
+            }
+        for name, ok in checks.items():
+            print(f"  {'ok  ' if ok else 'FAIL'} {name}")
+        return all(checks.values())
+    finally:
+        db.close()
+
+
+def main():
+    args = parse_args()
+    os.environ.setdefault("PASSWORD_HASH_CALIBRATE", "false")
+    os.environ.setdefault("SCHEDULER_ENABLED", "false")
+    if args.database_url:
+        os.environ["DATABASE_URL"] = args.database_url
+    else:
+        os.environ.pop("DATABASE_URL", None)
+        os.chdir(tempfile.mkdtemp(prefix="promo-harness-"))
+    rng = random.Random(args.seed)
+
+    user_ids = setup(args.users, args.max_uses)
+    attempts = user_ids + [rng.choice(user_ids) for _ in range(int(len(user_ids) * args.duplicate_rate))]
+    rng.shuffle(attempts)
+
+    began = time.perf_counter()
+    outcomes, latencies = run(attempts, args.threads, args.legacy)
+    elapsed = time.perf_counter() - began
+
+    latencies.sort()
+    print(f"{len(attempts)} attempts by {len(user_ids)} users on {args.threads} threads in {elapsed:.2f}s "
+          f"({len(attempts) / elapsed:.0f}/s), p50={latencies[len(latencies) // 2]:.1f}ms max={latencies[-1]:.1f}ms")
+    for outcome, count in outcomes.most_common():
+        print(f"  {count:6d}  {outcome}")
+    ok = verify(user_ids, args.max_uses, outcomes["redeemed"], args.legacy)
+    sys.exit(0 if ok else 1)
+
+
+if __name__ == "__main__":
+    main()
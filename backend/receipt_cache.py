@@ -0,0 +1,92 @@
+"""
+Content-addressed cache of receipt extractions.
+
+Re-submitting the same photo (after a failed review or a network retry)
+returns the stored extraction without calling the model or using a scan.
+Entries are keyed per user by sha256(prepared image + language): the hash is
+taken after prepare_image, so re-encoded or EXIF-rotated copies of the same
+photo share an entry. They expire after RECEIPT_CACHE_TTL_HOURS and are
+trimmed to RECEIPT_CACHE_MAX_ENTRIES.
+
+There is deliberately no near-duplicate match: receipts with different text
+can look almost the same to a perceptual hash, and serving another receipt's
+amounts is worse than a cache miss.
+"""
+import hashlib
+import json
+import os
+from datetime import datetime, timedelta
+from typing import Optional
+
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import Session
+
+from database import ReceiptCacheEntry
+import metrics
+
+RECEIPT_CACHE_TTL_HOURS = float(os.getenv("RECEIPT_CACHE_TTL_HOURS", "24"))
+RECEIPT_CACHE_MAX_ENTRIES = int(os.getenv("RECEIPT_CACHE_MAX_ENTRIES", "5000"))
+
+
+def image_cache_key(image_bytes: bytes, language: str) -> str:
+    """Content hash of the prepared image (prepare_image output) plus the extraction language"""
+    digest = hashlib.sha256(image_bytes)
+    digest.update(b"\0" + language.encode("utf-8"))
+    return digest.hexdigest()
+
+
+def _cutoff() -> datetime:
+    return datetime.utcnow() - timedelta(hours=RECEIPT_CACHE_TTL_HOURS)
+
+
+def get_cached_extraction(db: Session, user_id: int, cache_key: str) -> Optional[dict]:
+    """Return a previous extraction under this image_cache_key for this user, if still fresh"""
+    entry = db.query(ReceiptCacheEntry).filter(
+        ReceiptCacheEntry.user_id == user_id,
+        ReceiptCacheEntry.cache_key == cache_key,
+        ReceiptCacheEntry.created_at > _cutoff()
+    ).first()
+
+    if not entry:
+        metrics.increment("receipt_cache.misses")
+        return None
+
+    entry.hits += 1
+    db.commit()
+    metrics.increment("receipt_cache.hits")
+    return json.loads(entry.data)
+
+
+def store_extraction(db: Session, user_id: int, cache_key: str, language: str, data: dict):
+    """Cache an extraction under its image_cache_key, evicting expired and excess entries"""
+    data_json = json.dumps(data)
+
+    db.add(ReceiptCacheEntry(
+        user_id=user_id,
+        cache_key=cache_key,
+        language=language,
+        data=data_json
+    ))
+    try:
+        db.commit()
+    except IntegrityError:
+        # Same image was cached concurrently (or an expired entry remains)
+        db.rollback()
+        db.query(ReceiptCacheEntry).filter(
+            ReceiptCacheEntry.user_id == user_id,
+            ReceiptCacheEntry.cache_key == cache_key
+        ).update({"data": data_json, "hits": 0, "created_at": datetime.utcnow()})
+        db.commit()
+
+    # Size bound: drop expired entries, then the oldest beyond the limit
+    db.query(ReceiptCacheEntry).filter(
+        ReceiptCacheEntry.created_at <= _cutoff()
+    ).delete(synchronize_session=False)
+    first_evicted = db.query(ReceiptCacheEntry.created_at).order_by(
+        ReceiptCacheEntry.created_at.desc()
+    ).offset(RECEIPT_CACHE_MAX_ENTRIES).limit(1).scalar()
+    if first_evicted is not None:
+        db.query(ReceiptCacheEntry).filter(
+            ReceiptCacheEntry.created_at <= first_evicted
+        ).delete(synchronize_session=False)
+    db.commit()
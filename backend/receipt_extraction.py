@@ -0,0 +1,388 @@
+"""
+Receipt extraction: image preprocessing, model routing and validation of
+the returned JSON (against the models in receipt_schema).
+
+Shared by the scan endpoints and the background job workers. Nothing here
+touches quotas or the database; callers decide what a failure costs.
+"""
+import asyncio
+import base64
+import json
+import os
+import time
+from typing import Optional
+
+from pydantic import ValidationError
+
+from openai_client import create_chat_completion
+from model_telemetry import record_model_call
+from receipt_image import RECEIPT_IMAGE_PREPROCESS, InvalidImageError, preprocess_receipt_image
+from receipt_schema import (
+    CATEGORIES, ReceiptClassification, StoreReceipt, UtilityReceipt,
+    strict_json_schema, validate_receipt
+)
+import metrics
+
+RECEIPT_MODEL = "gpt-4o"  # Using gpt-4o which is more available
+RECEIPT_ROUTING_ENABLED = os.getenv("RECEIPT_ROUTING_ENABLED", "true").lower() == "true"
+RECEIPT_ROUTER_MODEL = os.getenv("RECEIPT_ROUTER_MODEL", "gpt-4o-mini")  # Cheap first pass: classify, read simple bills
+
+# Dollars per 1K (input, output) tokens; unknown models are priced as RECEIPT_MODEL
+MODEL_PRICING = {
+    "gpt-4o": (0.0025, 0.01),  # $2.50 / $10.00 per 1M
+    "gpt-4o-mini": (0.00015, 0.0006),  # $0.15 / $0.60 per 1M
+}
+
+# Language mapping for descriptions
+LANGUAGE_MAP = {
+    'en': 'English',
+    'sr': 'Serbian (Latin script, not Cyrillic)',
+    'es': 'Spanish',
+    'pt': 'Portuguese',
+    'fr': 'French',
+    'de': 'German',
+    'it': 'Italian',
+    'ar': 'Arabic'
+}
+
+# Strict response formats: the model can only answer in these shapes
+CLASSIFICATION_FORMAT = strict_json_schema(ReceiptClassification, "receipt_classification")
+STORE_FORMAT = strict_json_schema(StoreReceipt, "store_receipt")
+UTILITY_FORMAT = strict_json_schema(UtilityReceipt, "utility_receipt")
+
+
+class ReceiptExtractionError(Exception):
+    """Extraction failed; status_code and detail are what the client should see"""
+
+    def __init__(self, status_code: int, detail: str, retryable: bool = False):
+        super().__init__(detail)
+        self.status_code = status_code
+        self.detail = detail
+        self.retryable = retryable
+
+
+def _common_rules(user_language: str) -> str:
+    description_language = LANGUAGE_MAP.get(user_language, 'English')
+    
+    # Additional instruction for Serbian
+    serbian_note = ""
+    if user_language == 'sr':
+        serbian_note = " IMPORTANT: For Serbian, use Latin script (not Cyrillic). Use letters like a, b, c, d, e, etc., not Cyrillic characters."
+    
+    return f"""- merchant: Only extract if clearly visible. Do NOT guess or infer. Set to null if not visible.
+- date: YYYY-MM-DD format, null if not found.
+- description: Write in {description_language}, not English.{serbian_note}
+- Only extract information actually visible on receipt. Do NOT use your knowledge or make assumptions."""
+
+
+def _full_prompt(user_language: str) -> str:
+    return f"""Extract expense data from this receipt image. First, determine if this is a UTILITY/BILL receipt (electric, phone, internet, water, gas) or a STORE receipt (grocery, retail, etc.).
+
+For UTILITY/BILL receipts (electric, phone, internet, water, gas companies):
+- Return single entry format with receipt_type: "utility"
+- category should be "Utilities"
+- Return: {{"receipt_type": "utility", "amount": 150.00, "date": "2024-01-15", "merchant": "Electric Company", "category": "Utilities", "description": "Electric bill"}}
+
+For STORE receipts (grocery stores, retail shops, supermarkets):
+- Return itemized format with receipt_type: "store"
+- Extract each item with its price, category, and description
+- Extract tax amount if present
+- Return: {{"receipt_type": "store", "date": "2024-01-15", "merchant": "Walmart", "items": [{{"amount": 10.00, "category": "Groceries", "description": "Milk, bread"}}, {{"amount": 20.00, "category": "Household Supplies", "description": "Cleaning products"}}], "tax": 1.80, "subtotal": 30.00, "total": 31.80}}
+
+Categories available: {', '.join(CATEGORIES)}
+
+IMPORTANT RULES:
+- For store receipts: Each item's category MUST match one of the available categories exactly
+- For store receipts: Extract ONLY the tax amount from the tax field. Ignore discounts, savings, or promotional amounts - they are informational only and should NOT be included in the tax calculation. Extract tax amount if visible (can be 0 or null if no tax)
+{_common_rules(user_language)}
+
+Return ONLY valid JSON, no other text."""
+
+
+def _classification_prompt(user_language: str) -> str:
+    return f"""Is this a UTILITY/BILL receipt (electric, phone, internet, water, gas companies) or a STORE receipt (grocery stores, retail shops, supermarkets)? Set receipt_type to "utility" or "store".
+
+For a utility bill also extract amount (the amount due), date, merchant, category (usually "Utilities") and a short description. Set amount to null unless you can read it with certainty.
+For a store receipt set all other fields to null.
+
+{_common_rules(user_language)}"""
+
+
+def _store_prompt(user_language: str) -> str:
+    return f"""Extract expense data from this store receipt: each item with its price, category and description, plus tax, subtotal and total.
+
+- Each item's category MUST be one of the available categories.
+- Extract ONLY the tax amount from the tax field. Ignore discounts, savings, or promotional amounts - they are informational only and should NOT be included in the tax calculation. tax can be 0 or null if no tax is shown.
+{_common_rules(user_language)}"""
+
+
+def _utility_prompt(user_language: str) -> str:
+    return f"""Extract expense data from this utility bill (electric, phone, internet, water, gas): the amount due, date, merchant, category (usually "Utilities") and a short description.
+
+- amount: null if no amount due is visible.
+{_common_rules(user_language)}"""
+
+
+def _biller_prompt_tail(user_language: str) -> str:
+    description_language = LANGUAGE_MAP.get(user_language, 'English')
+    serbian_note = " Use Latin script, not Cyrillic." if user_language == 'sr' else ""
+    return f"""This is a utility bill. Extract the biller, the amount due and the bill date.
+- merchant: the biller's name exactly as printed on the bill, null if not visible. Do NOT guess.
+- date: YYYY-MM-DD format, null if not found.
+- description: Write in {description_language}, not English.{serbian_note}
+- amount: null if no amount due is visible.
+- category: "Utilities"."""
+
+
+# Built once at import; the date rule is applied in validation, so prompts don't change day to day
+PROMPTS = {
+    language: {
+        "full": _full_prompt(language),
+        "classify": _classification_prompt(language),
+        "store": _store_prompt(language),
+        "utility": _utility_prompt(language),
+        "biller": _biller_prompt_tail(language),
+    }
+    for language in LANGUAGE_MAP
+}
+
+
+def get_prompts(user_language: str) -> dict:
+    return PROMPTS.get(user_language, PROMPTS['en'])
+
+
+def build_prompt(user_language: str) -> str:
+    """Single-pass extraction prompt with categories and description language"""
+    return get_prompts(user_language)["full"]
+
+
+def build_biller_prompt(user_language: str) -> str:
+    """Short prompt for a bill that looks like one from a biller the user confirmed before
+
+    It does not name the expected biller: the merchant the model reads back
+    is what the caller checks the match against.
+    """
+    return get_prompts(user_language)["biller"]
+
+
+def model_call_cost(prompt_tokens: int, completion_tokens: int, model: str = RECEIPT_MODEL) -> float:
+    """Dollar cost of a model call"""
+    input_per_1k, output_per_1k = MODEL_PRICING.get(model, MODEL_PRICING[RECEIPT_MODEL])
+    return (prompt_tokens / 1000) * input_per_1k + (completion_tokens / 1000) * output_per_1k
+
+
+def validate_extraction(result: dict) -> dict:
+    """Normalize the model's JSON into the utility or store response shape
+
+    Raises pydantic.ValidationError when the JSON doesn't fit (see receipt_schema).
+    """
+    print(f"Raw extracted data from OpenAI: {result}")
+    extracted_data = validate_receipt(result)
+    print(f"Final extracted data: {extracted_data}")
+    return extracted_data
+
+
+def prepare_image(image_bytes: bytes) -> tuple[bytes, Optional[dict]]:
+    """Preprocess an image for the model; returns (jpeg_bytes, stats or None)"""
+    if not RECEIPT_IMAGE_PREPROCESS:
+        return image_bytes, None
+    try:
+        processed_bytes, preprocess_stats = preprocess_receipt_image(image_bytes)
+    except InvalidImageError as e:
+        print(f"Receipt image rejected: {e}")
+        raise ReceiptExtractionError(400, "Invalid image data")
+    metrics.increment("receipt_image.bytes_saved", preprocess_stats["bytes_saved"])
+    metrics.increment("receipt_image.image_tokens_saved", preprocess_stats["image_tokens_saved"])
+    print(
+        f"Preprocessing: {preprocess_stats['original_bytes']} -> {preprocess_stats['processed_bytes']} bytes "
+        f"(saved {preprocess_stats['bytes_saved']}), {preprocess_stats['preprocess_ms']} ms, "
+        f"est. image tokens {preprocess_stats['image_tokens_before']} -> {preprocess_stats['image_tokens_after']}"
+    )
+    return processed_bytes, preprocess_stats
+
+
+async def _call_model(
+    *,
+    model: str,
+    prompt_name: str,
+    prompt: str,
+    image_base64: str,
+    detail: Optional[str],
+    response_format: dict,
+    max_tokens: int,
+    user_id: Optional[int],
+    user_language: str,
+    image_bytes: int
+) -> dict:
+    """One model call with the image; returns the parsed JSON
+
+    Every call is reported to model_telemetry. Raises ReceiptExtractionError
+    (retryable) on API errors and unparseable answers.
+    """
+    def record_call(outcome: str, latency_ms: float, prompt_tokens: int = 0, completion_tokens: int = 0, receipt_type: Optional[str] = None):
+        record_model_call(
+            user_id=user_id,
+            model=model,
+            prompt=prompt_name,
+            language=user_language,
+            receipt_type=receipt_type,
+            image_bytes=image_bytes,
+            latency_ms=latency_ms,
+            prompt_tokens=prompt_tokens,
+            completion_tokens=completion_tokens,
+            cost_usd=round(model_call_cost(prompt_tokens, completion_tokens, model), 6),
+            outcome=outcome
+        )
+    
+    image_url = {"url": f"data:image/jpeg;base64,{image_base64}"}
+    if detail:
+        image_url["detail"] = detail
+    
+    print(f"Calling OpenAI API ({model}, {prompt_name} prompt, detail={detail or 'auto'})...")
+    model_start = time.perf_counter()
+    try:
+        response = await create_chat_completion(
+            model=model,
+            messages=[{
+                "role": "user",
+                "content": [
+                    {"type": "text", "text": prompt},
+                    {"type": "image_url", "image_url": image_url}
+                ]
+            }],
+            response_format=response_format,
+            max_tokens=max_tokens
+        )
+    except Exception as api_error:
+        model_ms = round((time.perf_counter() - model_start) * 1000, 1)
+        record_call("api_error", model_ms)
+        print(f"OpenAI API error: {str(api_error)}")
+        raise ReceiptExtractionError(500, f"OpenAI API error: {str(api_error)}", retryable=True)
+    model_ms = round((time.perf_counter() - model_start) * 1000, 1)
+    print(f"OpenAI API call successful ({model_ms} ms)")
+    
+    # Log token usage and cost
+    prompt_tokens = completion_tokens = 0
+    usage = getattr(response, 'usage', None)
+    if usage:
+        prompt_tokens = getattr(usage, 'prompt_tokens', 0) or 0
+        completion_tokens = getattr(usage, 'completion_tokens', 0) or 0
+        total_tokens = getattr(usage, 'total_tokens', 0) or 0
+        print(f"OpenAI Usage - Prompt tokens: {prompt_tokens}, Completion tokens: {completion_tokens}, Total: {total_tokens}")
+        print(f"OpenAI Cost - Total: ${model_call_cost(prompt_tokens, completion_tokens, model):.6f}")
+    else:
+        print("OpenAI Usage: No usage data available")
+    
+    # Parse response
+    try:
+        result = json.loads(response.choices[0].message.content)
+        if not isinstance(result, dict):
+            raise ValueError("expected a JSON object")
+    except (json.JSONDecodeError, TypeError, ValueError) as parse_error:
+        record_call("parse_error", model_ms, prompt_tokens, completion_tokens)
+        print(f"Failed to parse JSON: {response.choices[0].message.content}")
+        raise ReceiptExtractionError(500, f"Failed to parse OCR response: {str(parse_error)}", retryable=True)
+    
+    record_call("ok", model_ms, prompt_tokens, completion_tokens, result.get("receipt_type"))
+    return result
+
+
+async def extract_receipt(
+    image_bytes: bytes,
+    user_language: str,
+    preprocess: bool = True,
+    known_biller: bool = False,
+    user_id: Optional[int] = None
+) -> dict:
+    """Extract expense data from a receipt image
+    
+    Pass preprocess=False for bytes that already went through prepare_image.
+    With known_biller the short bill prompt is used instead of the full one;
+    the caller must check the merchant it returns before trusting the result.
+    
+    Otherwise, with RECEIPT_ROUTING_ENABLED, a low-detail pass on
+    RECEIPT_ROUTER_MODEL classifies the receipt and reads simple bills; only
+    store receipts (and bills it couldn't read) go to RECEIPT_MODEL at high
+    detail. Every model call is reported to model_telemetry (user_id is
+    recorded with it). Raises ReceiptExtractionError on failure.
+    """
+    # Rotate, crop, downscale and re-encode off the event loop before the model call
+    if preprocess:
+        image_bytes, _ = await asyncio.to_thread(prepare_image, image_bytes)
+    image_base64 = base64.b64encode(image_bytes).decode("ascii")
+    
+    print(f"Receipt scan request received, image size: {len(image_base64)} chars")
+    
+    # Check OpenAI configuration
+    openai_api_key = os.getenv("OPENAI_API_KEY")
+    if not openai_api_key:
+        print("ERROR: OPENAI_API_KEY not set")
+        raise ReceiptExtractionError(
+            500,
+            "OpenAI API key not configured. Please set OPENAI_API_KEY environment variable."
+        )
+    
+    prompts = get_prompts(user_language)
+    
+    async def call(model: str, prompt_name: str, detail: Optional[str], response_format: dict, max_tokens: int, prompt: Optional[str] = None) -> dict:
+        return await _call_model(
+            model=model,
+            prompt_name=prompt_name,
+            prompt=prompt or prompts[prompt_name],
+            image_base64=image_base64,
+            detail=detail,
+            response_format=response_format,
+            max_tokens=max_tokens,
+            user_id=user_id,
+            user_language=user_language,
+            image_bytes=len(image_bytes)
+        )
+    
+    try:
+        if known_biller:
+            result = await call(RECEIPT_MODEL, "biller", None, UTILITY_FORMAT, 150, build_biller_prompt(user_language))
+            return validate_extraction(result)
+        
+        if RECEIPT_ROUTING_ENABLED:
+            routed = await _extract_routed(call)
+            if routed is not None:
+                return routed
+        
+        result = await call(RECEIPT_MODEL, "full", None, {"type": "json_object"}, 500)
+        return validate_extraction(result)
+    except ValidationError as e:
+        print(f"Extraction did not match the receipt schema: {e}")
+        raise ReceiptExtractionError(500, "Failed to parse OCR response: unexpected receipt format", retryable=True)
+
+
+async def _extract_routed(call) -> Optional[dict]:
+    """Classify on the cheap model, escalate to RECEIPT_MODEL only when needed
+
+    Returns None when the first pass fails, so the caller can fall back to
+    the single full-prompt call.
+    """
+    try:
+        first_pass = ReceiptClassification.model_validate(
+            await call(RECEIPT_ROUTER_MODEL, "classify", "low", CLASSIFICATION_FORMAT, 150)
+        )
+    except (ReceiptExtractionError, ValidationError) as e:
+        metrics.increment("receipt_routing.first_pass_failed")
+        print(f"Receipt classification failed, using the full prompt: {e}")
+        return None
+    
+    if first_pass.receipt_type == "utility" and first_pass.amount is not None:
+        metrics.increment("receipt_routing.first_pass_only")
+        extracted_data = first_pass.as_utility().model_dump()
+        print(f"Final extracted data: {extracted_data}")
+        return extracted_data
+    
+    if first_pass.receipt_type == "store":
+        # Itemized receipts need every line legible: full model, full detail
+        metrics.increment("receipt_routing.escalated_store")
+        result = await call(RECEIPT_MODEL, "store", "high", STORE_FORMAT, 500)
+        return validate_extraction({**result, "receipt_type": "store"})
+    
+    # A bill whose amount the low-detail pass couldn't read
+    metrics.increment("receipt_routing.escalated_utility")
+    result = await call(RECEIPT_MODEL, "utility", "high", UTILITY_FORMAT, 150)
+    return validate_extraction({**result, "receipt_type": "utility"})
@@ -0,0 +1,154 @@
+"""
+Receipt image preprocessing before model calls.
+
+Phone photos arrive as multi-megabyte 12 MP JPEGs, but GPT-4o scales every
+image down to fit 2048x2048 and then to a 768 px short side before tiling it.
+Doing that here (plus EXIF rotation, border trimming, grayscale and JPEG
+re-encoding) shrinks the upload without losing anything the model would see.
+layout_fingerprint summarizes a prepared image's layout for merchant memory.
+Both are CPU-bound; call them from a worker thread.
+"""
+import io
+import math
+import os
+import time
+from typing import Optional
+
+from PIL import Image, ImageChops, ImageOps
+
+RECEIPT_IMAGE_PREPROCESS = os.getenv("RECEIPT_IMAGE_PREPROCESS", "true").lower() == "true"
+RECEIPT_IMAGE_MAX_SIDE = int(os.getenv("RECEIPT_IMAGE_MAX_SIDE", "2048"))
+RECEIPT_IMAGE_SHORT_SIDE = int(os.getenv("RECEIPT_IMAGE_SHORT_SIDE", "768"))
+RECEIPT_IMAGE_JPEG_QUALITY = int(os.getenv("RECEIPT_IMAGE_JPEG_QUALITY", "80"))
+RECEIPT_IMAGE_GRAYSCALE = os.getenv("RECEIPT_IMAGE_GRAYSCALE", "true").lower() == "true"
+
+# Pixel difference from the corner colour that counts as content when trimming borders
+BORDER_THRESHOLD = 24
+
+# Layout fingerprint: ink density over a LAYOUT_COLUMNS x LAYOUT_ROWS grid, LAYOUT_LEVELS steps per cell
+LAYOUT_COLUMNS = 16
+LAYOUT_ROWS = 24
+LAYOUT_LEVELS = 16
+
+
+class InvalidImageError(ValueError):
+    """Raised when the uploaded bytes are not a decodable image"""
+
+
+def fit_to_model_resolution(width: int, height: int) -> tuple[int, int]:
+    """Size the model would downscale a high-detail image to"""
+    # Fit inside MAX_SIDE x MAX_SIDE, then bring the short side down to SHORT_SIDE
+    scale = min(1.0, RECEIPT_IMAGE_MAX_SIDE / max(width, height))
+    scale = min(scale, RECEIPT_IMAGE_SHORT_SIDE / min(width, height))
+    return max(1, round(width * scale)), max(1, round(height * scale))
+
+
+def estimate_image_tokens(width: int, height: int) -> int:
+    """Estimated GPT-4o input tokens for a high-detail image (85 + 170 per 512 px tile)"""
+    width, height = fit_to_model_resolution(width, height)
+    tiles = math.ceil(width / 512) * math.ceil(height / 512)
+    return 85 + 170 * tiles
+
+
+def _trim_border(image: Image.Image) -> Image.Image:
+    """Crop away a uniform border (table, scanner bed) around the receipt"""
+    background = Image.new(image.mode, image.size, image.getpixel((0, 0)))
+    diff = ImageChops.difference(image, background).convert("L")
+    bbox = diff.point(lambda p: 255 if p > BORDER_THRESHOLD else 0).getbbox()
+    if not bbox:
+        return image
+    # Only crop when it removes a meaningful margin
+    cropped_area = (bbox[2] - bbox[0]) * (bbox[3] - bbox[1])
+    if cropped_area > 0.95 * image.size[0] * image.size[1]:
+        return image
+    return image.crop(bbox)
+
+
+def preprocess_receipt_image(image_bytes: bytes) -> tuple[bytes, dict]:
+    """Normalize a receipt photo for extraction.
+
+    Returns (jpeg_bytes, stats) where stats reports the size, token and
+    time deltas for this image.
+    """
+    start = time.perf_counter()
+    try:
+        image = Image.open(io.BytesIO(image_bytes))
+        original_size = image.size
+        # Let the JPEG decoder skip resolution we will throw away anyway
+        image.draft("L" if RECEIPT_IMAGE_GRAYSCALE else "RGB", (RECEIPT_IMAGE_SHORT_SIDE, RECEIPT_IMAGE_SHORT_SIDE))
+        image = ImageOps.exif_transpose(image)
+    except Exception as e:
+        raise InvalidImageError(f"Could not decode image: {e}")
+
+    image = image.convert("L" if RECEIPT_IMAGE_GRAYSCALE else "RGB")
+    image = _trim_border(image)
+
+    # A tall crop can need more 512 px tiles than the full frame did; keep the
+    # token cost at or below what the untouched photo would have used
+    tokens_before = estimate_image_tokens(*original_size)
+    target_size = fit_to_model_resolution(*image.size)
+    while estimate_image_tokens(*target_size) > tokens_before:
+        target_size = (max(1, int(target_size[0] * 0.9)), max(1, int(target_size[1] * 0.9)))
+    if target_size != image.size:
+        image = image.resize(target_size, Image.LANCZOS)
+
+    output = io.BytesIO()
+    image.save(output, "JPEG", quality=RECEIPT_IMAGE_JPEG_QUALITY, optimize=True)
+    processed_bytes = output.getvalue()
+
+    tokens_after = estimate_image_tokens(*image.size)
+    stats = {
+        "original_bytes": len(image_bytes),
+        "processed_bytes": len(processed_bytes),
+        "bytes_saved": len(image_bytes) - len(processed_bytes),
+        "original_size": list(original_size),
+        "processed_size": list(image.size),
+        "image_tokens_before": tokens_before,
+        "image_tokens_after": tokens_after,
+        "image_tokens_saved": tokens_before - tokens_after,
+        "preprocess_ms": round((time.perf_counter() - start) * 1000, 1),
+    }
+    return processed_bytes, stats
+
+
+def layout_fingerprint(image_bytes: bytes) -> Optional[str]:
+    """Where the ink sits on a document, for recognizing a biller's recurring bill
+
+    The printed area (dark pixels after autocontrast) is cropped, its aspect
+    ratio kept, and its ink density sampled on a coarse grid. Unlike a
+    difference hash of the whole image, the blank paper contributes nothing.
+    Encoded as "<aspect>:<one hex digit per cell>"; compare with layout_distance.
+    """
+    try:
+        image = Image.open(io.BytesIO(image_bytes))
+        image.draft("L", (RECEIPT_IMAGE_SHORT_SIDE, RECEIPT_IMAGE_SHORT_SIDE))
+        image = ImageOps.autocontrast(image.convert("L"), cutoff=1)
+    except Exception as e:
+        print(f"Could not compute layout fingerprint: {e}")
+        return None
+    ink = image.point(lambda p: 255 if p < 128 else 0)
+    bbox = ink.getbbox()
+    if not bbox:
+        return None
+    ink = ink.crop(bbox)
+    cells = ink.resize((LAYOUT_COLUMNS, LAYOUT_ROWS), Image.BOX).getdata()
+    density = "".join(f"{min(LAYOUT_LEVELS - 1, cell * LAYOUT_LEVELS // 256):x}" for cell in cells)
+    return f"{ink.width / ink.height:.3f}:{density}"
+
+
+def layout_distance(a: str, b: str) -> Optional[tuple[float, float]]:
+    """(mean ink density difference, relative aspect ratio difference), both 0..1
+
+    None when either fingerprint is not in layout_fingerprint's format (e.g.
+    an older hash stored before it).
+    """
+    try:
+        aspect_a, cells_a = a.split(":")
+        aspect_b, cells_b = b.split(":")
+        aspect_a, aspect_b = float(aspect_a), float(aspect_b)
+        if len(cells_a) != LAYOUT_COLUMNS * LAYOUT_ROWS or len(cells_b) != len(cells_a) or min(aspect_a, aspect_b) <= 0:
+            return None
+        density = sum(abs(int(x, 16) - int(y, 16)) for x, y in zip(cells_a, cells_b))
+    except ValueError:
+        return None
+    return density / (len(cells_a) * (LAYOUT_LEVELS - 1)), abs(aspect_a - aspect_b) / max(aspect_a, aspect_b)
@@ -0,0 +1,221 @@
+"""
+Pydantic models for the JSON the receipt model returns.
+
+They do double duty: strict_json_schema() turns them into the JSON schema
+sent as response_format (so the model can only answer in this shape, with
+categories from CATEGORIES), and model_validate() checks and normalizes the
+answer. Normalization that the schema can't express lives in validators:
+unknown categories fall back to Other/Utilities, missing or malformed dates
+become today, and store receipts get their tax reconciled against the items.
+"""
+from datetime import date as date_type, datetime
+from typing import Literal, Optional
+
+from pydantic import BaseModel, ConfigDict, field_validator, model_validator
+
+# Your app's category list
+CATEGORIES = [
+    "Groceries", "Utilities", "Transportation", "Housing", "Home Maintenance",
+    "Healthcare", "Education", "Childcare", "Entertainment", "Subscriptions",
+    "Dining Out", "Clothing", "Personal Care", "Fitness & Sports",
+    "Household Supplies", "Pet Care", "Gifts & Donations", "Travel",
+    "Loans & Debt Payments", "Bank Fees", "Insurance", "Taxes", "Other"
+]
+
+Category = Literal[tuple(CATEGORIES)]
+
+
+def _valid_category(value, fallback: str) -> str:
+    if value in CATEGORIES:
+        return value
+    if value:
+        print(f"Category '{value}' not in list, setting to '{fallback}'")
+    return fallback
+
+
+def _valid_date(value) -> str:
+    """YYYY-MM-DD as extracted, or today when missing or malformed"""
+    if value:
+        try:
+            datetime.strptime(value, "%Y-%m-%d")
+            return value
+        except (ValueError, TypeError):
+            print("Invalid date format, using today")
+    return date_type.today().isoformat()
+
+
+def _amount_or_none(value) -> Optional[float]:
+    try:
+        return float(value) if value else None
+    except (ValueError, TypeError):
+        print(f"Invalid amount: {value}")
+        return None
+
+
+class _ReceiptModel(BaseModel):
+    # Defaults go through the validators too (a missing date becomes today)
+    model_config = ConfigDict(extra="ignore", validate_default=True)
+
+
+class StoreItem(_ReceiptModel):
+    amount: float
+    category: Category = "Other"
+    description: str = ""
+
+    @field_validator("category", mode="before")
+    @classmethod
+    def _category(cls, value):
+        return _valid_category(value, "Other")
+
+    @field_validator("description", mode="before")
+    @classmethod
+    def _description(cls, value):
+        return value or ""
+
+
+class StoreReceipt(_ReceiptModel):
+    receipt_type: Literal["store"] = "store"
+    date: Optional[str] = None
+    merchant: Optional[str] = None
+    items: list[StoreItem] = []
+    tax: Optional[float] = None
+    subtotal: Optional[float] = None
+    total: Optional[float] = None
+
+    @field_validator("date", mode="before")
+    @classmethod
+    def _date(cls, value):
+        return _valid_date(value)
+
+    @field_validator("items", mode="before")
+    @classmethod
+    def _items(cls, value):
+        # Items with an unreadable price are dropped rather than failing the receipt
+        items = []
+        for item in value or []:
+            try:
+                amount = float(item.get("amount") or 0)
+            except (ValueError, TypeError, AttributeError):
+                print(f"Invalid item amount: {item}, skipping")
+                continue
+            items.append({**item, "amount": amount})
+        return items
+
+    @field_validator("tax", "subtotal", "total", mode="before")
+    @classmethod
+    def _money(cls, value):
+        return _amount_or_none(value)
+
+    @model_validator(mode="after")
+    def _reconcile_tax(self):
+        items_total = sum(item.amount for item in self.items)
+        tax = self.tax or 0
+        total = self.total or 0
+        self.subtotal = self.subtotal or items_total
+
+        # Check if American-style (tax added on top): itemsTotal !== total
+        # If they don't match, calculate correct tax from the difference
+        tax_included = abs(items_total - total) < 0.01
+        if not tax_included and total > 0 and items_total > 0:
+            tax_calculated = round(total - items_total, 2)
+            if tax_calculated > 0:
+                if abs(tax - tax_calculated) > 0.01 or tax == 0:
+                    print(f"Tax mismatch: extracted={tax}, calculated={tax_calculated}. Using calculated tax.")
+                    tax = tax_calculated
+            else:
+                tax = 0
+        else:
+            # European-style: tax included in prices
+            tax = 0
+
+        self.tax = tax
+        self.total = total
+        return self
+
+
+class UtilityReceipt(_ReceiptModel):
+    receipt_type: Literal["utility"] = "utility"
+    amount: Optional[float] = None
+    date: Optional[str] = None
+    merchant: Optional[str] = None
+    category: Category = "Utilities"
+    description: str = ""
+
+    @field_validator("amount", mode="before")
+    @classmethod
+    def _amount(cls, value):
+        return _amount_or_none(value)
+
+    @field_validator("date", mode="before")
+    @classmethod
+    def _date(cls, value):
+        return _valid_date(value)
+
+    @field_validator("category", mode="before")
+    @classmethod
+    def _category(cls, value):
+        return _valid_category(value, "Utilities")
+
+    @field_validator("description", mode="before")
+    @classmethod
+    def _description(cls, value):
+        return value or ""
+
+
+class ReceiptClassification(_ReceiptModel):
+    """First-pass answer: the receipt type, plus the whole result for a readable utility bill"""
+    receipt_type: Literal["utility", "store"]
+    amount: Optional[float] = None
+    date: Optional[str] = None
+    merchant: Optional[str] = None
+    category: Optional[Category] = None
+    description: Optional[str] = None
+
+    @field_validator("amount", mode="before")
+    @classmethod
+    def _amount(cls, value):
+        return _amount_or_none(value)
+
+    @field_validator("category", mode="before")
+    @classmethod
+    def _category(cls, value):
+        return _valid_category(value, "Utilities") if value else None
+
+    def as_utility(self) -> UtilityReceipt:
+        return UtilityReceipt.model_validate(self.model_dump(exclude={"receipt_type"}))
+
+
+def validate_receipt(result: dict) -> dict:
+    """Normalize model JSON of either receipt type into the response shape
+
+    Raises pydantic.ValidationError when it doesn't fit.
+    """
+    # Default to utility for backward compatibility
+    model = StoreReceipt if result.get("receipt_type") == "store" else UtilityReceipt
+    return model.model_validate({**result, "receipt_type": model.model_fields["receipt_type"].default}).model_dump()
+
+
+def _make_strict(schema: dict):
+    """Structured-outputs rules: every property required, no extra keys, no defaults"""
+    schema.pop("title", None)
+    schema.pop("default", None)
+    if "const" in schema:
+        schema["enum"] = [schema.pop("const")]
+    if "properties" in schema:
+        schema["additionalProperties"] = False
+        schema["required"] = list(schema["properties"])
+        for prop in schema["properties"].values():
+            _make_strict(prop)
+    if isinstance(schema.get("items"), dict):
+        _make_strict(schema["items"])
+    for variant in schema.get("anyOf", []):
+        _make_strict(variant)
+    for definition in schema.get("$defs", {}).values():
+        _make_strict(definition)
+
+
+def strict_json_schema(model: type[BaseModel], name: str) -> dict:
+    """response_format for chat completions that forces the model's shape"""
+    schema = model.model_json_schema()
+    _make_strict(schema)
+    return {"type": "json_schema", "json_schema": {"name": name, "strict": True, "schema": schema}}
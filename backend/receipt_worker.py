@@ -0,0 +1,313 @@
+"""
+Workers for asynchronous receipt scan jobs.
+
+POST /receipts/jobs stores a queued row in receipt_jobs and returns at once.
+Workers claim queued rows, run the extraction and write the result (or the
+error) back to the row, which clients fetch from GET /receipts/jobs/{id}.
+Failed attempts are retried with exponential backoff; a job that keeps
+failing is dead-lettered with status 'dead'.
+
+The table is the queue, so workers can run as a separate process:
+
+    python receipt_worker.py
+
+With RECEIPT_JOBS_IN_PROCESS=true (the default, handy locally) the same
+workers also run as asyncio tasks inside the web process and are woken as
+soon as a job is enqueued.
+"""
+import asyncio
+import json
+import os
+import socket
+import uuid
+from datetime import datetime, timedelta
+from typing import Optional
+
+from dotenv import load_dotenv
+
+# Load environment variables before modules that read them at import time
+load_dotenv()
+
+from sqlalchemy import and_, or_
+from sqlalchemy.orm import Session
+
+from database import SessionLocal, ReceiptJob, ReceiptJobStatus
+from receipt_cache import store_extraction
+from receipt_extraction import ReceiptExtractionError
+from merchant_memory import extract_with_memory, get_user_memory, remember_layout
+from scan_quota import refund_scans
+from scan_history import save_scan_result
+from model_telemetry import start_telemetry_flusher, stop_telemetry_flusher
+import metrics
+
+RECEIPT_JOB_WORKERS = int(os.getenv("RECEIPT_JOB_WORKERS", "4"))
+RECEIPT_JOB_MAX_ATTEMPTS = int(os.getenv("RECEIPT_JOB_MAX_ATTEMPTS", "3"))
+RECEIPT_JOB_RETRY_BACKOFF_SECONDS = float(os.getenv("RECEIPT_JOB_RETRY_BACKOFF_SECONDS", "5"))
+RECEIPT_JOB_POLL_INTERVAL_SECONDS = float(os.getenv("RECEIPT_JOB_POLL_INTERVAL_SECONDS", "1"))
+RECEIPT_JOB_LEASE_SECONDS = int(os.getenv("RECEIPT_JOB_LEASE_SECONDS", "300"))  # Running jobs of a dead worker are reclaimed after this
+RECEIPT_JOBS_IN_PROCESS = os.getenv("RECEIPT_JOBS_IN_PROCESS", "true").lower() == "true"
+
+TERMINAL_STATUSES = {
+    ReceiptJobStatus.SUCCEEDED.value,
+    ReceiptJobStatus.FAILED.value,
+    ReceiptJobStatus.DEAD.value,
+}
+
+_wakeup: Optional[asyncio.Event] = None
+_worker_tasks: list = []
+
+
+def notify_job_enqueued():
+    """Wake in-process workers instead of waiting for their next poll"""
+    if _wakeup is not None:
+        _wakeup.set()
+
+
+def _claimable(now: datetime):
+    """Queued jobs that are due, plus running jobs whose lease expired"""
+    return or_(
+        and_(
+            ReceiptJob.status == ReceiptJobStatus.QUEUED.value,
+            ReceiptJob.next_attempt_at <= now
+        ),
+        and_(
+            ReceiptJob.status == ReceiptJobStatus.RUNNING.value,
+            ReceiptJob.locked_at < now - timedelta(seconds=RECEIPT_JOB_LEASE_SECONDS)
+        )
+    )
+
+
+def claim_next_job(worker_id: str) -> Optional[int]:
+    """Atomically mark the oldest claimable job as running for this worker"""
+    db = SessionLocal()
+    try:
+        for _ in range(3):
+            now = datetime.utcnow()
+            candidate = db.query(ReceiptJob.id).filter(_claimable(now)).order_by(ReceiptJob.id).first()
+            if not candidate:
+                return None
+            # Conditional update: only one worker can win the same row
+            claimed = db.query(ReceiptJob).filter(
+                ReceiptJob.id == candidate.id,
+                _claimable(now)
+            ).update({
+                "status": ReceiptJobStatus.RUNNING.value,
+                "locked_by": worker_id,
+                "locked_at": now,
+                "attempts": ReceiptJob.attempts + 1
+            }, synchronize_session=False)
+            db.commit()
+            if claimed:
+                return candidate.id
+        return None
+    finally:
+        db.close()
+
+
+def _load_job(job_id: int) -> tuple[ReceiptJob, dict]:
+    """The claimed job (detached) and its user's merchant memory"""
+    db = SessionLocal()
+    try:
+        job = db.query(ReceiptJob).filter(ReceiptJob.id == job_id).first()
+        db.expunge(job)
+        return job, get_user_memory(db, job.user_id)
+    finally:
+        db.close()
+
+
+def _renew_lease(job_id: int, worker_id: str) -> bool:
+    """Push our lease forward; False once another worker has reclaimed the job"""
+    db = SessionLocal()
+    try:
+        renewed = db.query(ReceiptJob).filter(
+            ReceiptJob.id == job_id,
+            ReceiptJob.status == ReceiptJobStatus.RUNNING.value,
+            ReceiptJob.locked_by == worker_id
+        ).update({"locked_at": datetime.utcnow()}, synchronize_session=False)
+        db.commit()
+        return bool(renewed)
+    finally:
+        db.close()
+
+
+def _finish(db: Session, job_id: int, worker_id: str, values: dict) -> bool:
+    """Write the attempt's outcome only if we still hold the job (not yet committed)"""
+    finished = db.query(ReceiptJob).filter(
+        ReceiptJob.id == job_id,
+        ReceiptJob.status == ReceiptJobStatus.RUNNING.value,
+        ReceiptJob.locked_by == worker_id
+    ).update({**values, "locked_by": None}, synchronize_session=False)
+    if not finished:
+        db.rollback()
+        print(f"Receipt job {job_id}: lease lost to another worker, discarding this attempt")
+        metrics.increment("receipt_jobs.leases_lost")
+    return bool(finished)
+
+
+def _record_failure(job_id: int, worker_id: str, error: Exception):
+    """Store a failed attempt: requeue with backoff, or finish the job and refund its scan"""
+    db = SessionLocal()
+    try:
+        job = db.query(ReceiptJob).filter(ReceiptJob.id == job_id).first()
+        if isinstance(error, ReceiptExtractionError):
+            message, error_status, retryable = error.detail, error.status_code, error.retryable
+        else:
+            message, error_status, retryable = f"Error processing receipt: {str(error)}", 500, True
+        values = {"error": message[:500], "error_status": error_status}
+
+        if retryable and job.attempts < RECEIPT_JOB_MAX_ATTEMPTS:
+            delay = RECEIPT_JOB_RETRY_BACKOFF_SECONDS * 2 ** (job.attempts - 1)
+            values.update(status=ReceiptJobStatus.QUEUED.value, next_attempt_at=datetime.utcnow() + timedelta(seconds=delay))
+            if not _finish(db, job_id, worker_id, values):
+                return
+            db.commit()
+            metrics.increment("receipt_jobs.retried")
+            print(f"Receipt job {job_id} attempt {job.attempts} failed, retrying in {delay:g}s: {values['error']}")
+        else:
+            status = ReceiptJobStatus.DEAD.value if retryable else ReceiptJobStatus.FAILED.value
+            values.update(status=status, image=None, completed_at=datetime.utcnow())
+            if not _finish(db, job_id, worker_id, values):
+                return
+            db.commit()
+            metrics.increment(f"receipt_jobs.{status}")
+            print(f"Receipt job {job_id} {status} after {job.attempts} attempts: {values['error']}")
+            # The scan reserved at enqueue doesn't count
+            refund_scans(db, job.user_id, job.quota_month)
+    finally:
+        db.close()
+
+
+def _record_success(job_id: int, worker_id: str, data: dict, memory: dict, layout_hash: Optional[str]):
+    """Save the scan and the job's result, then cache it and remember the bill layout"""
+    db = SessionLocal()
+    try:
+        job = db.query(ReceiptJob).filter(ReceiptJob.id == job_id).first()
+        # The scan and the job's outcome commit together, and only if the job is still ours
+        scan_id = save_scan_result(db, job.user_id, data, commit=False)
+        if not _finish(db, job_id, worker_id, {
+            "scan_id": scan_id,
+            "status": ReceiptJobStatus.SUCCEEDED.value,
+            "result": json.dumps(data),
+            "error": None,
+            "error_status": None,
+            "image": None,
+            "completed_at": datetime.utcnow()
+        }):
+            return
+        db.commit()
+        if job.cache_key:
+            store_extraction(db, job.user_id, job.cache_key, job.language, data)
+        remember_layout(db, job.user_id, memory, data, layout_hash)
+        metrics.increment("receipt_jobs.succeeded")
+    finally:
+        db.close()
+
+
+async def _keep_lease(job_id: int, worker_id: str):
+    """Renew the lease while the job runs; returns once another worker has taken the job"""
+    while True:
+        await asyncio.sleep(RECEIPT_JOB_LEASE_SECONDS / 3)
+        if not await asyncio.to_thread(_renew_lease, job_id, worker_id):
+            return
+
+
+async def run_job(job_id: int, worker_id: str):
+    """Run one claimed job and store its outcome
+
+    In the web process these workers share the request event loop, so every
+    database step runs in a thread; only the model call is awaited here.
+    The lease is renewed while the model call runs (retries can outlast
+    RECEIPT_JOB_LEASE_SECONDS), and the outcome is only written while this
+    worker still holds the job.
+    """
+    job, memory = await asyncio.to_thread(_load_job, job_id)
+    extraction = asyncio.create_task(
+        extract_with_memory(memory, job.image, job.language, preprocess=False, user_id=job.user_id)
+    )
+    lease = asyncio.create_task(_keep_lease(job_id, worker_id))
+    try:
+        await asyncio.wait({extraction, lease}, return_when=asyncio.FIRST_COMPLETED)
+    finally:
+        lease.cancel()
+        if not extraction.done():
+            extraction.cancel()
+    if not extraction.done() or extraction.cancelled():
+        await asyncio.gather(extraction, return_exceptions=True)
+        print(f"Receipt job {job_id}: lease lost to another worker, stopped")
+        metrics.increment("receipt_jobs.leases_lost")
+        return
+    try:
+        data, layout_hash = extraction.result()
+    except Exception as e:
+        await asyncio.to_thread(_record_failure, job_id, worker_id, e)
+        return
+    await asyncio.to_thread(_record_success, job_id, worker_id, data, memory, layout_hash)
+
+
+async def worker_loop(worker_id: str):
+    """Claim and run jobs until cancelled"""
+    while True:
+        try:
+            job_id = await asyncio.to_thread(claim_next_job, worker_id)
+            if job_id:
+                await run_job(job_id, worker_id)
+                continue
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            print(f"Receipt worker {worker_id} error: {e}")
+
+        if _wakeup is not None:
+            _wakeup.clear()
+            try:
+                await asyncio.wait_for(_wakeup.wait(), RECEIPT_JOB_POLL_INTERVAL_SECONDS)
+            except asyncio.TimeoutError:
+                pass
+        else:
+            await asyncio.sleep(RECEIPT_JOB_POLL_INTERVAL_SECONDS)
+
+
+def _worker_ids(count: int) -> list[str]:
+    prefix = f"{socket.gethostname()}-{os.getpid()}-{uuid.uuid4().hex[:6]}"
+    return [f"{prefix}-{i}" for i in range(count)]
+
+
+def start_in_process_workers():
+    """Start the worker pool on the running event loop (web process)"""
+    global _wakeup
+    if not RECEIPT_JOBS_IN_PROCESS or _worker_tasks:
+        return
+    _wakeup = asyncio.Event()
+    for worker_id in _worker_ids(RECEIPT_JOB_WORKERS):
+        _worker_tasks.append(asyncio.create_task(worker_loop(worker_id)))
+    print(f"Started {RECEIPT_JOB_WORKERS} in-process receipt job workers")
+
+
+async def stop_in_process_workers():
+    """Cancel in-process workers; claimed jobs are picked up again after their lease"""
+    global _wakeup
+    for task in _worker_tasks:
+        task.cancel()
+    await asyncio.gather(*_worker_tasks, return_exceptions=True)
+    _worker_tasks.clear()
+    _wakeup = None
+
+
+async def run_worker_pool(count: int):
+    """Run a pool of workers in this process until interrupted"""
+    print(f"Starting {count} receipt job workers")
+    start_telemetry_flusher()
+    try:
+        await asyncio.gather(*(worker_loop(worker_id) for worker_id in _worker_ids(count)))
+    finally:
+        await stop_telemetry_flusher()
+
+
+if __name__ == "__main__":
+    from database import init_db
+
+    init_db()
+    try:
+        asyncio.run(run_worker_pool(RECEIPT_JOB_WORKERS))
+    except KeyboardInterrupt:
+        print("Receipt workers stopped")
@@ -0,0 +1,103 @@
+#!/usr/bin/env python3
+"""
+Re-queue Stripe webhook events for stripe_worker.
+
+    python replay_stripe_events.py evt_1Abc evt_1Def         # stored events by id
+    python replay_stripe_events.py --status dead              # everything dead-lettered
+    python replay_stripe_events.py --status failed --type invoice.payment_failed
+    python replay_stripe_events.py --since 2024-05-01 --until 2024-05-02 --status processed
+    python replay_stripe_events.py --fetch evt_1Ghi           # an event that never reached us
+    python replay_stripe_events.py --status dead --dry-run
+
+Replayed events go back to 'queued' with their attempts reset, and keep their
+place in the per-customer order. Workers in the web process pick them up on
+their next poll. --fetch pulls events from the Stripe API (needs
+STRIPE_SECRET_KEY); Stripe keeps events for 30 days.
+"""
+import argparse
+import json
+from datetime import datetime
+
+from dotenv import load_dotenv
+
+load_dotenv()
+
+from database import SessionLocal, StripeEvent, StripeEventStatus, init_db
+from stripe_gateway import retrieve_event
+from stripe_worker import store_event
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Re-queue Stripe webhook events")
+    parser.add_argument("event_ids", nargs="*", help="Stripe event ids (evt_...)")
+    parser.add_argument("--status", choices=[s.value for s in StripeEventStatus], help="only events with this status")
+    parser.add_argument("--type", help="only events of this type, e.g. customer.subscription.updated")
+    parser.add_argument("--since", help="received on or after (YYYY-MM-DD or ISO datetime)")
+    parser.add_argument("--until", help="received before (YYYY-MM-DD or ISO datetime)")
+    parser.add_argument("--fetch", nargs="+", metavar="EVENT_ID", help="retrieve these events from Stripe and queue them")
+    parser.add_argument("--dry-run", action="store_true", help="list matching events without changing them")
+    args = parser.parse_args()
+    if not (args.event_ids or args.status or args.type or args.since or args.until or args.fetch):
+        parser.error("give event ids, --fetch or at least one filter")
+    return args
+
+
+def fetch_events(db, event_ids: list, dry_run: bool):
+    for event_id in event_ids:
+        event = retrieve_event(event_id)
+        payload = json.dumps(event.to_dict())
+        if dry_run:
+            print(f"would store {event_id} ({event['type']})")
+            continue
+        stored = store_event(db, json.loads(payload), payload)
+        print(f"{event_id} ({event['type']}): {'queued' if stored else 'already stored, use its id to replay'}")
+
+
+def main():
+    args = parse_args()
+    init_db()
+    db = SessionLocal()
+    try:
+        if args.fetch:
+            fetch_events(db, args.fetch, args.dry_run)
+
+        if not (args.event_ids or args.status or args.type or args.since or args.until):
+            return
+
+        query = db.query(StripeEvent)
+        if args.event_ids:
+            query = query.filter(StripeEvent.event_id.in_(args.event_ids))
+        if args.status:
+            query = query.filter(StripeEvent.status == args.status)
+        if args.type:
+            query = query.filter(StripeEvent.type == args.type)
+        if args.since:
+            query = query.filter(StripeEvent.received_at >= datetime.fromisoformat(args.since))
+        if args.until:
+            query = query.filter(StripeEvent.received_at < datetime.fromisoformat(args.until))
+
+        events = query.order_by(StripeEvent.stripe_created, StripeEvent.id).all()
+        for event in events:
+            print(f"{event.event_id}  {event.type:<36} {event.status:<9} attempts={event.attempts}  {event.error or ''}")
+        if args.dry_run or not events:
+            print(f"{len(events)} event(s) matched" + (" (dry run)" if args.dry_run else ""))
+            return
+
+        # Running events belong to a live worker; leave them alone
+        replayed = query.filter(StripeEvent.status != StripeEventStatus.RUNNING.value).update({
+            "status": StripeEventStatus.QUEUED.value,
+            "attempts": 0,
+            "next_attempt_at": datetime.utcnow(),
+            "locked_by": None,
+            "locked_at": None,
+            "error": None,
+            "processed_at": None
+        }, synchronize_session=False)
+        db.commit()
+        print(f"Re-queued {replayed} of {len(events)} event(s)")
+    finally:
+        db.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,104 @@
+from fastapi import APIRouter, Depends, Query
+from sqlalchemy.orm import Session
+from sqlalchemy import func
+from datetime import datetime, timedelta
+from typing import Optional
+
+from database import get_db, ModelCall
+from auth import require_admin
+
+router = APIRouter(dependencies=[Depends(require_admin)])
+
+LATENCY_PERCENTILES = (50, 90, 95, 99)
+
+
+def percentile(sorted_values: list, p: float) -> Optional[float]:
+    """Nearest-rank percentile of an already sorted list"""
+    if not sorted_values:
+        return None
+    rank = max(1, round(p / 100 * len(sorted_values)))
+    return sorted_values[min(rank, len(sorted_values)) - 1]
+
+
+@router.get("/admin/model-calls/stats")
+async def get_model_call_stats(
+    hours: int = Query(24, ge=1, le=24 * 7),
+    days: int = Query(30, ge=1, le=365),
+    db: Session = Depends(get_db)
+):
+    """Model call latency percentiles over the last `hours`, cost per day and per user over the last `days`"""
+    window_start = datetime.utcnow() - timedelta(hours=hours)
+    latencies = [
+        row.latency_ms for row in db.query(ModelCall.latency_ms).filter(
+            ModelCall.created_at >= window_start
+        ).order_by(ModelCall.latency_ms)
+    ]
+
+    outcomes = dict(
+        db.query(ModelCall.outcome, func.count(ModelCall.id)).filter(
+            ModelCall.created_at >= window_start
+        ).group_by(ModelCall.outcome).all()
+    )
+
+    by_language = [
+        {
+            "language": row.language,
+            "calls": row.calls,
+            "avg_prompt_tokens": round(row.avg_prompt_tokens or 0, 1),
+            "avg_completion_tokens": round(row.avg_completion_tokens or 0, 1),
+            "avg_latency_ms": round(row.avg_latency_ms or 0, 1),
+        }
+        for row in db.query(
+            ModelCall.language,
+            func.count(ModelCall.id).label("calls"),
+            func.avg(ModelCall.prompt_tokens).label("avg_prompt_tokens"),
+            func.avg(ModelCall.completion_tokens).label("avg_completion_tokens"),
+            func.avg(ModelCall.latency_ms).label("avg_latency_ms"),
+        ).filter(
+            ModelCall.created_at >= window_start
+        ).group_by(ModelCall.language).order_by(ModelCall.language)
+    ]
+
+    cost_start = datetime.utcnow() - timedelta(days=days)
+    day = func.date(ModelCall.created_at)
+    daily_cost = [
+        {
+            "day": str(row.day),
+            "calls": row.calls,
+            "prompt_tokens": int(row.prompt_tokens or 0),
+            "completion_tokens": int(row.completion_tokens or 0),
+            "cost_usd": round(row.cost_usd or 0, 4),
+        }
+        for row in db.query(
+            day.label("day"),
+            func.count(ModelCall.id).label("calls"),
+            func.sum(ModelCall.prompt_tokens).label("prompt_tokens"),
+            func.sum(ModelCall.completion_tokens).label("completion_tokens"),
+            func.sum(ModelCall.cost_usd).label("cost_usd"),
+        ).filter(
+            ModelCall.created_at >= cost_start
+        ).group_by(day).order_by(day)
+    ]
+
+    user_cost = func.sum(ModelCall.cost_usd)
+    top_users = [
+        {"user_id": row.user_id, "calls": row.calls, "cost_usd": round(row.cost_usd or 0, 4)}
+        for row in db.query(
+            ModelCall.user_id,
+            func.count(ModelCall.id).label("calls"),
+            user_cost.label("cost_usd"),
+        ).filter(
+            ModelCall.created_at >= cost_start
+        ).group_by(ModelCall.user_id).order_by(user_cost.desc()).limit(10)
+    ]
+
+    return {
+        "window_hours": hours,
+        "calls": len(latencies),
+        "outcomes": outcomes,
+        "latency_ms": {f"p{p}": percentile(latencies, p) for p in LATENCY_PERCENTILES},
+        "by_language": by_language,
+        "cost_days": days,
+        "daily_cost": daily_cost,
+        "top_users_by_cost": top_users,
+    }
@@ -1,14 +1,15 @@
-from fastapi import APIRouter, Depends, HTTPException, status
+from fastapi import APIRouter, BackgroundTasks, Depends, HTTPException, status
 from fastapi.security import OAuth2PasswordRequestForm
 from sqlalchemy.orm import Session
 from datetime import datetime, timedelta
 import secrets
 import os
 
-from database import get_db, User, Expense as ExpenseModel
+from database import get_db, User
+from account_deletion import mark_user_deleted, purge_user_data
 from auth import (
-    get_password_hash, verify_password, create_access_token,
-    get_current_user, ACCESS_TOKEN_EXPIRE_MINUTES
+    get_password_hash, verify_password, verify_and_update_password,
+    create_access_token, get_current_user, ACCESS_TOKEN_EXPIRE_MINUTES
 )
 from email_service import send_password_reset_email
 from models import (
@@ -75,20 +76,36 @@ async def login(
     # OAuth2PasswordRequestForm uses 'username' field, but we accept either email or username
     login_identifier = form_data.username
     
-    # Try email first
-    user = db.query(User).filter(User.email == login_identifier).first()
+    # Try email first (accounts pending deletion can no longer log in)
+    user = db.query(User).filter(
+        User.email == login_identifier,
+        User.deleted_at.is_(None)
+    ).first()
     
     # If not found by email, try username
     if not user:
-        user = db.query(User).filter(User.username == login_identifier).first()
+        user = db.query(User).filter(
+            User.username == login_identifier,
+            User.deleted_at.is_(None)
+        ).first()
     
-    if not user or not verify_password(form_data.password, user.password_hash):
+    if user:
+        valid, new_hash = verify_and_update_password(form_data.password, user.password_hash)
+    else:
+        valid, new_hash = False, None
+    
+    if not valid:
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED,
             detail="Incorrect email/username or password",
             headers={"WWW-Authenticate": "Bearer"},
         )
     
+    # Transparently upgrade hashes made with an older scheme or lower cost
+    if new_hash:
+        user.password_hash = new_hash
+        db.commit()
+    
     # Create access token - ensure sub is a string
     access_token_expires = timedelta(minutes=ACCESS_TOKEN_EXPIRE_MINUTES)
     user_id_str = str(int(user.id))  # Explicitly convert to int then string
@@ -144,18 +161,18 @@ async def change_password(
 
 @router.delete("/me")
 async def delete_account(
+    background_tasks: BackgroundTasks,
     current_user: User = Depends(get_current_user),
     db: Session = Depends(get_db)
 ):
-    """Delete user account and all associated data"""
-    # Delete all expenses for this user
-    db.query(ExpenseModel).filter(ExpenseModel.user_id == current_user.id).delete()
+    """Delete user account and all associated data
     
-    # Delete the user
-    db.delete(current_user)
-    db.commit()
+    The account is disabled immediately; its data is purged in the background.
+    """
+    deletion = mark_user_deleted(db, current_user)
+    background_tasks.add_task(purge_user_data, deletion.id)
     
-    return {"message": "Account deleted successfully"}
+    return {"message": "Account deleted successfully", "deletion_id": deletion.id}
 
 
 @router.post("/check-email")
@@ -171,7 +188,10 @@ async def reset_password_request(
     db: Session = Depends(get_db)
 ):
     """Request password reset - sends email with reset token"""
-    user = db.query(User).filter(User.email == request.email).first()
+    user = db.query(User).filter(
+        User.email == request.email,
+        User.deleted_at.is_(None)
+    ).first()
     
     # Always return success (don't reveal if email exists)
     if not user:
@@ -4,6 +4,7 @@ from sqlalchemy import inspect
 import os
 
 from database import get_db, User, Expense as ExpenseModel, Income as IncomeModel
+import metrics
 
 router = APIRouter()
 
@@ -75,4 +76,7 @@ async def get_db_stats(db: Session = Depends(get_db)):
     return result
 
 
-
+@router.get("/debug/metrics")
+async def get_metrics():
+    """In-process counters and gauges for this worker"""
+    return metrics.snapshot()
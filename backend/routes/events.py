@@ -0,0 +1,92 @@
+from fastapi import APIRouter, Depends, HTTPException, Request
+from fastapi.responses import StreamingResponse
+from typing import Optional
+from datetime import timedelta
+import asyncio
+import json
+import os
+
+from database import SessionLocal, User
+from auth import create_access_token, get_current_user, get_user_for_token
+from notification_service import get_unread_count
+from notification_broadcasts import sync_broadcasts
+import event_bus
+import metrics
+
+router = APIRouter()
+
+EVENT_STREAM_HEARTBEAT_SECONDS = float(os.getenv("EVENT_STREAM_HEARTBEAT_SECONDS", "15"))
+EVENT_STREAM_MAX_PER_USER = int(os.getenv("EVENT_STREAM_MAX_PER_USER", "5"))
+EVENT_STREAM_RETRY_MS = int(os.getenv("EVENT_STREAM_RETRY_MS", "5000"))
+EVENT_STREAM_TOKEN_SECONDS = int(os.getenv("EVENT_STREAM_TOKEN_SECONDS", "60"))
+
+STREAM_TOKEN_SCOPE = "event_stream"
+
+
+def sse(event: str, data: dict) -> str:
+    return f"event: {event}\ndata: {json.dumps(data, default=str)}\n\n"
+
+
+@router.post("/events/stream-token")
+async def create_stream_token(current_user: User = Depends(get_current_user)):
+    """A token that only opens GET /events/stream, valid for EVENT_STREAM_TOKEN_SECONDS
+
+    Browsers' EventSource can't set headers, so the stream is opened with
+    ?stream_token= instead of the access token: URLs end up in proxy logs
+    and browser history, and this one is useless a minute later.
+    """
+    token = create_access_token(
+        {"sub": str(current_user.id), "scope": STREAM_TOKEN_SCOPE},
+        expires_delta=timedelta(seconds=EVENT_STREAM_TOKEN_SECONDS)
+    )
+    return {"stream_token": token, "expires_in": EVENT_STREAM_TOKEN_SECONDS}
+
+
+@router.get("/events/stream")
+async def event_stream(
+    request: Request,
+    stream_token: Optional[str] = None
+):
+    """Server-sent events for the current user: notification, unread_count, data_changed, resync
+
+    Authenticated by an Authorization header or a ?stream_token= from
+    POST /events/stream-token (only checked when the stream opens). The
+    database is only used to authenticate and for the first unread count;
+    the open stream holds no connection.
+    """
+    authorization = request.headers.get("Authorization", "")
+    db = SessionLocal()
+    try:
+        if authorization.startswith("Bearer "):
+            user_id = get_user_for_token(authorization[7:], db).id
+        else:
+            user_id = get_user_for_token(stream_token, db, scope=STREAM_TOKEN_SCOPE).id
+        if event_bus.subscriber_count(user_id) >= EVENT_STREAM_MAX_PER_USER:
+            raise HTTPException(status_code=429, detail="Too many open event streams")
+        sync_broadcasts(db, user_id)
+        initial_count = get_unread_count(db, user_id)
+    finally:
+        db.close()
+
+    async def stream():
+        with event_bus.subscribe(user_id) as queue:
+            metrics.increment("event_stream.opened")
+            yield f"retry: {EVENT_STREAM_RETRY_MS}\n\n"
+            yield sse("unread_count", {"unread_count": initial_count})
+            while True:
+                try:
+                    item = await asyncio.wait_for(queue.get(), EVENT_STREAM_HEARTBEAT_SECONDS)
+                except asyncio.TimeoutError:
+                    # Keeps proxies from closing an idle connection; a gone client fails the write
+                    yield ": keepalive\n\n"
+                    continue
+                if item is event_bus.CLOSE:
+                    break
+                event, data = item
+                yield sse(event, data)
+
+    return StreamingResponse(
+        stream(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
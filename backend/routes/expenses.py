@@ -7,6 +7,8 @@ from datetime import date, timedelta
 from database import get_db, User, Expense as ExpenseModel
 from auth import get_current_user
 from models import ExpenseIn, Expense, ExpenseBatchIn
+from merchant_memory import learn_categories
+from event_bus import publish
 
 router = APIRouter()
 
@@ -28,6 +30,7 @@ async def create_expense(
     db.add(db_expense)
     db.commit()
     db.refresh(db_expense)
+    publish(current_user.id, "data_changed", {"entity": "expense", "action": "created", "ids": [db_expense.id]})
     
     return Expense(
         id=db_expense.id,
@@ -63,6 +66,11 @@ async def create_expenses_batch(
     # Refresh all expenses
     for db_expense in created_expenses:
         db.refresh(db_expense)
+    publish(current_user.id, "data_changed", {"entity": "expense", "action": "created", "ids": [e.id for e in created_expenses]})
+    
+    # Categories confirmed on a reviewed receipt are reused for this merchant's next scans
+    if batch.merchant:
+        learn_categories(db, current_user.id, batch.merchant, batch.expenses)
     
     return [
         Expense(
@@ -207,6 +215,7 @@ async def update_expense(
     
     db.commit()
     db.refresh(db_expense)
+    publish(current_user.id, "data_changed", {"entity": "expense", "action": "updated", "ids": [db_expense.id]})
     
     return Expense(
         id=db_expense.id,
@@ -237,6 +246,7 @@ async def delete_expense(
     
     db.delete(db_expense)
     db.commit()
+    publish(current_user.id, "data_changed", {"entity": "expense", "action": "deleted", "ids": [expense_id]})
     
     return {"message": "Expense deleted successfully"}
 
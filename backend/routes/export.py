@@ -1,97 +1,122 @@
-from fastapi import APIRouter, Depends, HTTPException, Response
-from sqlalchemy.orm import Session
-from datetime import datetime
+from fastapi import APIRouter, Depends, HTTPException, Request
+from fastapi.responses import StreamingResponse
+from sqlalchemy import select
+from datetime import date, datetime
+from typing import Iterator
+import codecs
 import csv
 import io
+import os
 import traceback
+import zlib
 
-from database import get_db, User, Expense as ExpenseModel, Income as IncomeModel
+from database import SessionLocal, User, Expense as ExpenseModel, Income as IncomeModel
 from auth import get_current_user
+import metrics
 
 router = APIRouter()
 
+EXPORT_CSV_CHUNK_ROWS = int(os.getenv("EXPORT_CSV_CHUNK_ROWS", "1000"))  # Rows fetched and written per chunk
+EXPORT_CSV_GZIP = os.getenv("EXPORT_CSV_GZIP", "true").lower() == "true"  # When the client accepts it
+
+CSV_HEADER = ['Type', 'Date', 'Amount', 'Category', 'Description']
+
+
+def csv_rows(user_id: int, start: date, end: date) -> Iterator[list]:
+    """Expenses then income in the range, newest first, fetched EXPORT_CSV_CHUNK_ROWS at a time"""
+    # Its own session: the export outlives the request's dependencies
+    db = SessionLocal()
+    try:
+        for label, model in (('Expense', ExpenseModel), ('Income', IncomeModel)):
+            # Only the exported columns; yield_per streams them (a server-side cursor on Postgres)
+            rows = db.execute(
+                select(model.date, model.amount, model.category, model.description)
+                .where(model.user_id == user_id, model.date >= start, model.date <= end)
+                .order_by(model.date.desc(), model.id.desc())
+                .execution_options(yield_per=EXPORT_CSV_CHUNK_ROWS)
+            )
+            for row_date, amount, category, description in rows:
+                yield [
+                    label,
+                    row_date.isoformat() if row_date else '',
+                    amount if amount else '',
+                    category if category else '',
+                    description if description else ''
+                ]
+    finally:
+        db.close()
+
+
+def csv_chunks(rows: Iterator[list]) -> Iterator[bytes]:
+    """UTF-8 CSV with a BOM (for Excel), one chunk per EXPORT_CSV_CHUNK_ROWS rows"""
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(CSV_HEADER)
+    yield codecs.BOM_UTF8 + buffer.getvalue().encode('utf-8')
+    buffer.seek(0)
+    buffer.truncate()
+
+    pending = 0
+    for row in rows:
+        writer.writerow(row)
+        pending += 1
+        if pending == EXPORT_CSV_CHUNK_ROWS:
+            yield buffer.getvalue().encode('utf-8')
+            buffer.seek(0)
+            buffer.truncate()
+            pending = 0
+    if pending:
+        yield buffer.getvalue().encode('utf-8')
+
+
+def gzip_chunks(chunks: Iterator[bytes]) -> Iterator[bytes]:
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)  # gzip container
+    for chunk in chunks:
+        compressed = compressor.compress(chunk)
+        if compressed:
+            yield compressed
+    yield compressor.flush()
+
+
+def logged(chunks: Iterator[bytes]) -> Iterator[bytes]:
+    """Errors after the response started can't become a 500 any more; log them and cut the download"""
+    sent = 0
+    try:
+        for chunk in chunks:
+            sent += len(chunk)
+            yield chunk
+    except Exception as e:
+        metrics.increment("export.csv_errors")
+        print(f"CSV Export Error after {sent} bytes: {str(e)}")
+        print(f"Traceback: {traceback.format_exc()}")
+        raise
+    metrics.increment("export.csv_bytes", sent)
+
 
 @router.get("/export/csv")
 async def export_csv(
     start_date: str,
     end_date: str,
-    current_user: User = Depends(get_current_user),
-    db: Session = Depends(get_db)
+    request: Request,
+    current_user: User = Depends(get_current_user)
 ):
-    """Export expenses and income as CSV"""
+    """Export expenses and income as CSV, streamed (gzip-encoded when the client accepts it)"""
     try:
-        # Parse dates
         start = datetime.strptime(start_date, "%Y-%m-%d").date()
         end = datetime.strptime(end_date, "%Y-%m-%d").date()
-        
-        if start > end:
-            raise HTTPException(status_code=400, detail="Start date must be before end date")
-        
-        # Get expenses
-        expenses = db.query(ExpenseModel).filter(
-            ExpenseModel.user_id == current_user.id,
-            ExpenseModel.date >= start,
-            ExpenseModel.date <= end
-        ).order_by(ExpenseModel.date.desc()).all()
-        
-        # Get income
-        incomes = db.query(IncomeModel).filter(
-            IncomeModel.user_id == current_user.id,
-            IncomeModel.date >= start,
-            IncomeModel.date <= end
-        ).order_by(IncomeModel.date.desc()).all()
-        
-        # Create CSV in memory
-        output = io.StringIO()
-        writer = csv.writer(output)
-        
-        # Write header
-        writer.writerow(['Type', 'Date', 'Amount', 'Category', 'Description'])
-        
-        # Write expenses
-        for expense in expenses:
-            writer.writerow([
-                'Expense',
-                expense.date.isoformat() if expense.date else '',
-                expense.amount if expense.amount else '',
-                expense.category if expense.category else '',
-                expense.description if expense.description else ''
-            ])
-        
-        # Write income
-        for income in incomes:
-            writer.writerow([
-                'Income',
-                income.date.isoformat() if income.date else '',
-                income.amount if income.amount else '',
-                income.category if income.category else '',
-                income.description if income.description else ''
-            ])
-        
-        # Get CSV content
-        csv_content = output.getvalue()
-        output.close()
-        
-        # Generate filename
-        filename = f"expenses_{start_date}_to_{end_date}.csv"
-        
-        # Return CSV file (encode to bytes for proper download)
-        return Response(
-            content=csv_content.encode('utf-8-sig'),  # UTF-8 with BOM for Excel compatibility
-            media_type="text/csv; charset=utf-8",
-            headers={
-                "Content-Disposition": f'attachment; filename="{filename}"'
-            }
-        )
-        
     except ValueError as e:
         print(f"CSV Export ValueError: {str(e)}")
         raise HTTPException(status_code=400, detail=f"Invalid date format: {str(e)}")
-    except Exception as e:
-        error_trace = traceback.format_exc()
-        print(f"CSV Export Error: {str(e)}")
-        print(f"Traceback: {error_trace}")
-        raise HTTPException(status_code=500, detail=f"Error generating CSV: {str(e)}")
-
+    if start > end:
+        raise HTTPException(status_code=400, detail="Start date must be before end date")
 
+    filename = f"expenses_{start_date}_to_{end_date}.csv"
+    headers = {"Content-Disposition": f'attachment; filename="{filename}"', "Vary": "Accept-Encoding"}
+    chunks = csv_chunks(csv_rows(current_user.id, start, end))
+    if EXPORT_CSV_GZIP and "gzip" in request.headers.get("Accept-Encoding", "").lower():
+        chunks = gzip_chunks(chunks)
+        headers["Content-Encoding"] = "gzip"
+    metrics.increment("export.csv")
 
+    # A plain generator: Starlette iterates it in a worker thread, so the blocking reads don't stall the loop
+    return StreamingResponse(logged(chunks), media_type="text/csv; charset=utf-8", headers=headers)
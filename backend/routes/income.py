@@ -6,6 +6,7 @@ from datetime import date, timedelta
 from database import get_db, User, Income as IncomeModel
 from auth import get_current_user
 from models import IncomeIn, Income
+from event_bus import publish
 
 router = APIRouter()
 
@@ -27,6 +28,7 @@ async def create_income(
     db.add(db_income)
     db.commit()
     db.refresh(db_income)
+    publish(current_user.id, "data_changed", {"entity": "income", "action": "created", "ids": [db_income.id]})
     
     return Income(
         id=db_income.id,
@@ -117,6 +119,7 @@ async def update_income(
     
     db.commit()
     db.refresh(db_income)
+    publish(current_user.id, "data_changed", {"entity": "income", "action": "updated", "ids": [db_income.id]})
     
     return Income(
         id=db_income.id,
@@ -147,6 +150,7 @@ async def delete_income(
     
     db.delete(db_income)
     db.commit()
+    publish(current_user.id, "data_changed", {"entity": "income", "action": "deleted", "ids": [income_id]})
     
     return {"message": "Income deleted successfully"}
 
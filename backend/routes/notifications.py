@@ -1,34 +1,71 @@
-from fastapi import APIRouter, Depends, HTTPException
-from sqlalchemy.orm import Session
-from typing import List
+from fastapi import APIRouter, Depends, HTTPException, Query
+from sqlalchemy import tuple_
+from sqlalchemy.orm import Session, selectinload
+from typing import Optional
 from datetime import datetime
+import base64
 
 from database import get_db, User, Notification
 from auth import get_current_user
+from notification_service import get_unread_count as unread_count, mark_all_read, mark_read
+from notification_broadcasts import sync_broadcasts
 
 router = APIRouter()
 
 
+def encode_cursor(notification: Notification) -> str:
+    return base64.urlsafe_b64encode(f"{notification.created_at.isoformat()}|{notification.id}".encode()).decode()
+
+
+def decode_cursor(cursor: str) -> tuple[datetime, int]:
+    try:
+        created_at, notification_id = base64.urlsafe_b64decode(cursor.encode()).decode().split("|")
+        return datetime.fromisoformat(created_at), int(notification_id)
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+
+
+def notification_summary(n: Notification) -> dict:
+    return {
+        "id": n.id,
+        "message": n.template.message if n.template_id else n.message,
+        "type": n.type,
+        "read": n.read,
+        "created_at": n.created_at.isoformat() if n.created_at else None
+    }
+
+
 @router.get("/notifications")
 async def get_notifications(
+    limit: int = Query(20, ge=1, le=100),
+    cursor: Optional[str] = None,
+    unread: bool = False,
+    type: Optional[str] = None,
     current_user: User = Depends(get_current_user),
     db: Session = Depends(get_db)
 ):
-    """Get all notifications for current user"""
-    notifications = db.query(Notification).filter(
+    """Notifications, newest first; pass next_cursor back as cursor for the next page"""
+    sync_broadcasts(db, current_user.id)
+    query = db.query(Notification).options(selectinload(Notification.template)).filter(
         Notification.user_id == current_user.id
-    ).order_by(Notification.created_at.desc()).all()
+    )
+    if unread:
+        query = query.filter(Notification.read == False)
+    if type:
+        query = query.filter(Notification.type == type)
+    if cursor:
+        # Keyset on (created_at, id): stable while new notifications arrive, no OFFSET scan
+        query = query.filter(tuple_(Notification.created_at, Notification.id) < tuple_(*decode_cursor(cursor)))
+    notifications = query.order_by(
+        Notification.created_at.desc(), Notification.id.desc()
+    ).limit(limit + 1).all()
     
-    return [
-        {
-            "id": n.id,
-            "message": n.message,
-            "type": n.type,
-            "read": n.read,
-            "created_at": n.created_at.isoformat() if n.created_at else None
-        }
-        for n in notifications
-    ]
+    has_more = len(notifications) > limit
+    notifications = notifications[:limit]
+    return {
+        "items": [notification_summary(n) for n in notifications],
+        "next_cursor": encode_cursor(notifications[-1]) if has_more else None,
+    }
 
 
 @router.get("/notifications/unread-count")
@@ -36,13 +73,9 @@ async def get_unread_count(
     current_user: User = Depends(get_current_user),
     db: Session = Depends(get_db)
 ):
-    """Get count of unread notifications"""
-    count = db.query(Notification).filter(
-        Notification.user_id == current_user.id,
-        Notification.read == False
-    ).count()
-    
-    return {"unread_count": count}
+    """Get count of unread notifications (the user's counter row)"""
+    sync_broadcasts(db, current_user.id)
+    return {"unread_count": unread_count(db, current_user.id)}
 
 
 @router.post("/notifications/{notification_id}/read")
@@ -52,15 +85,8 @@ async def mark_notification_read(
     db: Session = Depends(get_db)
 ):
     """Mark a notification as read"""
-    notification = db.query(Notification).filter(
-        Notification.id == notification_id,
-        Notification.user_id == current_user.id
-    ).first()
-    
-    if not notification:
+    if not mark_read(db, current_user.id, notification_id):
         raise HTTPException(status_code=404, detail="Notification not found")
-    
-    notification.read = True
     db.commit()
     
     return {"message": "Notification marked as read"}
@@ -72,13 +98,11 @@ async def mark_all_notifications_read(
     db: Session = Depends(get_db)
 ):
     """Mark all notifications as read"""
-    db.query(Notification).filter(
-        Notification.user_id == current_user.id,
-        Notification.read == False
-    ).update({"read": True})
+    sync_broadcasts(db, current_user.id)
+    updated = mark_all_read(db, current_user.id)
     db.commit()
     
-    return {"message": "All notifications marked as read"}
+    return {"message": "All notifications marked as read", "updated": updated}
 
 
 
@@ -0,0 +1,128 @@
+from fastapi import APIRouter, Depends, HTTPException
+from sqlalchemy.orm import Session
+from datetime import datetime
+from typing import Optional
+import asyncio
+import json
+import time
+
+from database import get_db, SessionLocal, User, ReceiptJob, ReceiptJobStatus
+from auth import get_current_user
+from models import ReceiptScanRequest
+from receipt_cache import get_cached_extraction, image_cache_key
+from receipt_extraction import ReceiptExtractionError, prepare_image
+from receipt_worker import TERMINAL_STATUSES, notify_job_enqueued
+from routes.receipts import decode_image_base64, reserve_scan
+
+router = APIRouter()
+
+# Long-poll: GET /receipts/jobs/{id}?wait=N holds the request up to this many seconds
+MAX_LONG_POLL_SECONDS = 30
+LONG_POLL_INTERVAL_SECONDS = 0.5
+
+
+def job_response(job: ReceiptJob) -> dict:
+    """Public view of a receipt job"""
+    return {
+        "job_id": job.id,
+        "status": job.status,
+        "attempts": job.attempts,
+        "scan_id": job.scan_id,
+        "data": json.loads(job.result) if job.result else None,
+        "error": job.error,
+        "error_status": job.error_status,
+        "created_at": job.created_at.isoformat() if job.created_at else None,
+        "completed_at": job.completed_at.isoformat() if job.completed_at else None,
+    }
+
+
+@router.post("/receipts/jobs", status_code=202)
+async def create_receipt_job(
+    request: ReceiptScanRequest,
+    current_user: User = Depends(get_current_user),
+    db: Session = Depends(get_db)
+):
+    """Queue a receipt scan and return its job id immediately"""
+    image_bytes = decode_image_base64(request.image_base64)
+    user_language = request.language or 'en'
+
+    # Preprocess first: invalid images fail fast, the cache key is taken from the
+    # normalized image, and the queued row stays small
+    try:
+        processed_bytes, _ = await asyncio.to_thread(prepare_image, image_bytes)
+    except ReceiptExtractionError as e:
+        raise HTTPException(status_code=e.status_code, detail=e.detail)
+    cache_key = image_cache_key(processed_bytes, user_language)
+
+    # Same photo submitted again: the job is done before it starts
+    cached_data = get_cached_extraction(db, current_user.id, cache_key)
+    if cached_data:
+        job = ReceiptJob(
+            user_id=current_user.id,
+            status=ReceiptJobStatus.SUCCEEDED.value,
+            language=user_language,
+            result=json.dumps(cached_data),
+            completed_at=datetime.utcnow()
+        )
+        db.add(job)
+        db.commit()
+        db.refresh(job)
+        return job_response(job)
+
+    # The scan is counted now; the worker refunds it if the job fails
+    quota_month = reserve_scan(db, current_user.id)
+
+    job = ReceiptJob(
+        user_id=current_user.id,
+        status=ReceiptJobStatus.QUEUED.value,
+        language=user_language,
+        image=processed_bytes,
+        cache_key=cache_key,
+        quota_month=quota_month
+    )
+    db.add(job)
+    db.commit()
+    db.refresh(job)
+    notify_job_enqueued()
+
+    return job_response(job)
+
+
+def fetch_job(job_id: int, user_id: int) -> Optional[ReceiptJob]:
+    """One job of this user, loaded in a short-lived session and detached"""
+    db = SessionLocal()
+    try:
+        job = db.query(ReceiptJob).filter(
+            ReceiptJob.id == job_id,
+            ReceiptJob.user_id == user_id
+        ).first()
+        if job:
+            db.expunge(job)
+        return job
+    finally:
+        db.close()
+
+
+@router.get("/receipts/jobs/{job_id}")
+async def get_receipt_job(
+    job_id: int,
+    wait: float = 0,
+    current_user: User = Depends(get_current_user),
+    db: Session = Depends(get_db)
+):
+    """Get a receipt job; with ?wait=N, wait up to N seconds for it to finish"""
+    deadline = time.monotonic() + min(max(wait, 0), MAX_LONG_POLL_SECONDS)
+    user_id = current_user.id
+    # Give the request's connection back to the pool: a long poll must not hold one while it sleeps
+    db.close()
+
+    while True:
+        job = fetch_job(job_id, user_id)
+
+        if not job:
+            raise HTTPException(status_code=404, detail="Receipt job not found")
+
+        if job.status in TERMINAL_STATUSES or time.monotonic() >= deadline:
+            return job_response(job)
+
+        await asyncio.sleep(LONG_POLL_INTERVAL_SECONDS)
@@ -1,88 +1,120 @@
-from fastapi import APIRouter, Depends, HTTPException
+from fastapi import APIRouter, Depends, HTTPException, Query, Request
+from fastapi.responses import StreamingResponse
+from starlette.datastructures import UploadFile
+from starlette.formparsers import MultiPartException, MultiPartParser
 from sqlalchemy.orm import Session
-from datetime import datetime
-from typing import Optional
+from typing import AsyncIterator, Optional
 import os
+import base64
+import binascii
+import asyncio
 import json
+import anyio
 
-from database import get_db, User, Subscription, ReceiptScan, SubscriptionPlanType
+from database import get_db, SessionLocal, User, ReceiptScanResult
 from auth import get_current_user
-from models import ReceiptScanRequest
+from entitlements import get_scan_limit
+from models import ReceiptScanRequest, ReceiptBatchScanRequest
+from receipt_cache import get_cached_extraction, image_cache_key, store_extraction
+from receipt_extraction import ReceiptExtractionError, prepare_image
+from merchant_memory import extract_with_memory, get_user_memory, remember_layout
+from scan_quota import refund_scans, reserve_scans, reserve_scans_up_to
+from scan_history import get_scan_result, save_scan_result, scan_summary
 
 router = APIRouter()
 
+# Binary uploads (raw or multipart): size limit is enforced while the body streams in
+RECEIPT_UPLOAD_MAX_BYTES = int(os.getenv("RECEIPT_UPLOAD_MAX_BYTES", str(15 * 1024 * 1024)))
 
-def get_or_create_subscription(db: Session, user_id: int) -> Subscription:
-    """Get or create a subscription for the user"""
-    subscription = db.query(Subscription).filter(Subscription.user_id == user_id).first()
-    
-    if not subscription:
-        from database import SubscriptionStatus
-        subscription = Subscription(
-            user_id=user_id,
-            plan_type=SubscriptionPlanType.LIMITED.value,
-            status=SubscriptionStatus.ACTIVE.value,
-            current_period_start=datetime.utcnow(),
-            current_period_end=datetime.utcnow()
-        )
-        db.add(subscription)
-        db.commit()
-        db.refresh(subscription)
-    
-    return subscription
+RECEIPT_BATCH_MAX_IMAGES = int(os.getenv("RECEIPT_BATCH_MAX_IMAGES", "30"))
 
 
-def get_current_month_scans(db: Session, user_id: int) -> int:
-    """Get number of scans for current month"""
-    now = datetime.utcnow()
-    month_year = f"{now.year}-{now.month:02d}"
-    
-    scans = db.query(ReceiptScan).filter(
-        ReceiptScan.user_id == user_id,
-        ReceiptScan.month_year == month_year
-    ).count()
-    
-    return scans
+def scan_limit_message(limit: int) -> str:
+    return f"You have reached your monthly scan limit of {limit}. Upgrade to continue scanning."
+
 
+def reserve_scan(db: Session, user_id: int) -> str:
+    """Count one scan against the monthly quota or raise 403; returns the month for refund_scans"""
+    limit = get_scan_limit(db, user_id)
+    month = reserve_scans(db, user_id, limit)
+    if month is None:
+        raise HTTPException(status_code=403, detail=scan_limit_message(limit))
+    return month
 
-def check_scan_limit(db: Session, user_id: int) -> tuple[bool, Optional[str]]:
-    """Check if user can scan. Returns (allowed, error_message)"""
-    subscription = get_or_create_subscription(db, user_id)
+
+def decode_image_base64(image_base64: str) -> bytes:
+    """Decode a base64 image, with or without a data URL prefix"""
+    if not image_base64:
+        raise HTTPException(status_code=400, detail="No image data provided")
     
-    # Unlimited plans can always scan
-    if subscription.plan_type == SubscriptionPlanType.UNLIMITED.value:
-        return True, None
+    # Remove data URL prefix if present
+    if ',' in image_base64:
+        image_base64 = image_base64.split(',')[1]
     
-    if subscription.plan_type == SubscriptionPlanType.FREE.value:
-        return True, None  # Promo code unlimited
+    try:
+        image_bytes = base64.b64decode(image_base64)
+    except (binascii.Error, ValueError):
+        raise HTTPException(status_code=400, detail="Invalid image data")
     
-    # Get current month scans
-    scans_used = get_current_month_scans(db, user_id)
+    if not image_bytes:
+        raise HTTPException(status_code=400, detail="Invalid image data")
+    return image_bytes
+
+
+async def prepare_upload(image_bytes: bytes) -> bytes:
+    """prepare_image off the event loop; invalid images become a 400"""
+    try:
+        processed_bytes, _ = await asyncio.to_thread(prepare_image, image_bytes)
+    except ReceiptExtractionError as e:
+        raise HTTPException(status_code=e.status_code, detail=e.detail)
+    return processed_bytes
+
+
+async def scan_image_bytes(db: Session, current_user: User, image_bytes: bytes, user_language: str) -> dict:
+    """Preprocessing, cache lookup, quota reservation and extraction for one decoded image"""
+    # The cache key is taken from the prepared image, so re-encoded copies match too
+    image_bytes = await prepare_upload(image_bytes)
+    cache_key = image_cache_key(image_bytes, user_language)
     
-    # Determine limit
-    if subscription.plan_type == SubscriptionPlanType.EXTRA_30.value:
-        limit = 40  # 10 base + 30 extra
-    else:  # LIMITED
-        limit = 10
+    # Same photo submitted again: return the earlier extraction without using a scan
+    cached_data = get_cached_extraction(db, current_user.id, cache_key)
+    if cached_data:
+        print("Receipt scan served from cache")
+        return {
+            "success": True,
+            "data": cached_data,
+            "confidence": "high",
+            "cached": True
+        }
     
-    if scans_used >= limit:
-        return False, f"You have reached your monthly scan limit of {limit}. Upgrade to continue scanning."
+    # Check and count the scan in one step
+    quota_month = reserve_scan(db, current_user.id)
     
-    return True, None
-
-
-def record_scan(db: Session, user_id: int):
-    """Record a receipt scan"""
-    now = datetime.utcnow()
-    month_year = f"{now.year}-{now.month:02d}"
+    memory = get_user_memory(db, current_user.id)
+    try:
+        extracted_data, layout_hash = await extract_with_memory(memory, image_bytes, user_language, preprocess=False, user_id=current_user.id)
+    except BaseException as e:
+        # Failed (or the client went away): the scan doesn't count
+        refund_scans(db, current_user.id, quota_month)
+        if isinstance(e, ReceiptExtractionError):
+            raise HTTPException(status_code=e.status_code, detail=e.detail)
+        if isinstance(e, Exception):
+            raise HTTPException(
+                status_code=500,
+                detail=f"Error processing receipt: {str(e)}"
+            )
+        raise
     
-    scan = ReceiptScan(
-        user_id=user_id,
-        scan_date=now,
-        month_year=month_year
-    )
-    db.add(scan)
-    db.commit()
+    scan_id = save_scan_result(db, current_user.id, extracted_data)
+    store_extraction(db, current_user.id, cache_key, user_language, extracted_data)
+    remember_layout(db, current_user.id, memory, extracted_data, layout_hash)
+    
+    return {
+        "success": True,
+        "scan_id": scan_id,
+        "data": extracted_data,
+        "confidence": "high"
+    }
 
 
 @router.post("/receipts/scan")
@@ -92,285 +124,219 @@ async def scan_receipt(
     db: Session = Depends(get_db)
 ):
     """Scan receipt image using GPT-4 Turbo and extract expense data"""
-    from openai import OpenAI
-    
-    # Check scan limit
-    allowed, error_msg = check_scan_limit(db, current_user.id)
-    if not allowed:
-        raise HTTPException(status_code=403, detail=error_msg)
-    
-    # Your app's category list
-    CATEGORIES = [
-        "Groceries", "Utilities", "Transportation", "Housing", "Home Maintenance",
-        "Healthcare", "Education", "Childcare", "Entertainment", "Subscriptions",
-        "Dining Out", "Clothing", "Personal Care", "Fitness & Sports",
-        "Household Supplies", "Pet Care", "Gifts & Donations", "Travel",
-        "Loans & Debt Payments", "Bank Fees", "Insurance", "Taxes", "Other"
-    ]
-    
-    try:
-        # Get base64 from request
-        image_base64 = request.image_base64
-        if not image_base64:
-            raise HTTPException(status_code=400, detail="No image data provided")
-        
-        # Remove data URL prefix if present
-        if ',' in image_base64:
-            image_base64 = image_base64.split(',')[1]
-        
-        print(f"Receipt scan request received, image size: {len(image_base64)} chars")
-        
-        # Initialize OpenAI client
-        openai_api_key = os.getenv("OPENAI_API_KEY")
-        if not openai_api_key:
-            print("ERROR: OPENAI_API_KEY not set")
-            raise HTTPException(
-                status_code=500,
-                detail="OpenAI API key not configured. Please set OPENAI_API_KEY environment variable."
-            )
-        
-        print(f"OpenAI API key found, length: {len(openai_api_key)}")
-        client = OpenAI(api_key=openai_api_key)
-        
-        # Language mapping for descriptions
-        language_map = {
-            'en': 'English',
-            'sr': 'Serbian (Latin script, not Cyrillic)',
-            'es': 'Spanish',
-            'pt': 'Portuguese',
-            'fr': 'French',
-            'de': 'German',
-            'it': 'Italian',
-            'ar': 'Arabic'
-        }
-        user_language = request.language or 'en'
-        description_language = language_map.get(user_language, 'English')
-        
-        # Additional instruction for Serbian
-        serbian_note = ""
-        if user_language == 'sr':
-            serbian_note = " IMPORTANT: For Serbian, use Latin script (not Cyrillic). Use letters like a, b, c, d, e, etc., not Cyrillic characters."
-        
-        # Create prompt with categories
-        prompt = f"""Extract expense data from this receipt image. First, determine if this is a UTILITY/BILL receipt (electric, phone, internet, water, gas) or a STORE receipt (grocery, retail, etc.).
+    image_bytes = decode_image_base64(request.image_base64)
+    return await scan_image_bytes(db, current_user, image_bytes, request.language or 'en')
 
-For UTILITY/BILL receipts (electric, phone, internet, water, gas companies):
-- Return single entry format with receipt_type: "utility"
-- category should be "Utilities"
-- Return: {{"receipt_type": "utility", "amount": 150.00, "date": "2024-01-15", "merchant": "Electric Company", "category": "Utilities", "description": "Electric bill"}}
 
-For STORE receipts (grocery stores, retail shops, supermarkets):
-- Return itemized format with receipt_type: "store"
-- Extract each item with its price, category, and description
-- Extract tax amount if present
-- Return: {{"receipt_type": "store", "date": "2024-01-15", "merchant": "Walmart", "items": [{{"amount": 10.00, "category": "Groceries", "description": "Milk, bread"}}, {{"amount": 20.00, "category": "Household Supplies", "description": "Cleaning products"}}], "tax": 1.80, "subtotal": 30.00, "total": 31.80}}
+def check_upload_size(size: int):
+    """Reject uploads over RECEIPT_UPLOAD_MAX_BYTES"""
+    if size > RECEIPT_UPLOAD_MAX_BYTES:
+        raise HTTPException(
+            status_code=413,
+            detail=f"Image too large (max {RECEIPT_UPLOAD_MAX_BYTES // (1024 * 1024)} MB)"
+        )
 
-Categories available: {', '.join(CATEGORIES)}
 
-IMPORTANT RULES:
-- merchant: Only extract if clearly visible. Do NOT guess or infer. Set to null if not visible.
-- For store receipts: Each item's category MUST match one of the available categories exactly
-- For store receipts: Extract ONLY the tax amount from the tax field. Ignore discounts, savings, or promotional amounts - they are informational only and should NOT be included in the tax calculation. Extract tax amount if visible (can be 0 or null if no tax)
-- date: YYYY-MM-DD format (use today {datetime.now().date()} if not found)
-- description: Write in {description_language}, not English.{serbian_note}
-- Only extract information actually visible on receipt. Do NOT use your knowledge or make assumptions.
+async def limited_stream(request: Request) -> AsyncIterator[bytes]:
+    """The request body, aborted with 413 as soon as it exceeds RECEIPT_UPLOAD_MAX_BYTES"""
+    received = 0
+    async for chunk in request.stream():
+        received += len(chunk)
+        check_upload_size(received)
+        yield chunk
 
-Return ONLY valid JSON, no other text."""
 
-        # Call GPT-4 Turbo with vision
-        print("Calling OpenAI API...")
+async def read_image_upload(request: Request) -> tuple[bytes, Optional[str]]:
+    """Read an image from a raw image/* body or a multipart form field 'image'
+    
+    Returns (image_bytes, language) where language comes from the form, if sent.
+    Both kinds of body are counted as they stream in and aborted as soon as
+    they exceed the limit, with or without a Content-Length. Raw bodies are
+    returned as the buffer they were read into (no extra copy).
+    """
+    content_length = request.headers.get("content-length")
+    if content_length and content_length.isdigit():
+        check_upload_size(int(content_length))
+    
+    content_type = request.headers.get("content-type", "")
+    
+    if content_type.startswith("image/"):
+        buffer = bytearray()
+        async for chunk in limited_stream(request):
+            buffer.extend(chunk)
+        return buffer, None
+    
+    if content_type.startswith("multipart/form-data"):
+        # Parsed from the counted stream: the spooled file can't outgrow the limit either
+        parser = MultiPartParser(request.headers, limited_stream(request), max_files=1, max_fields=5)
         try:
-            response = client.chat.completions.create(
-                model="gpt-4o",  # Using gpt-4o which is more available
-                messages=[{
-                    "role": "user",
-                    "content": [
-                        {"type": "text", "text": prompt},
-                        {"type": "image_url", "image_url": {"url": f"data:image/jpeg;base64,{image_base64}"}}
-                    ]
-                }],
-                response_format={"type": "json_object"},
-                max_tokens=500
-            )
-            print("OpenAI API call successful")
-            
-            # Log token usage and cost
-            if hasattr(response, 'usage') and response.usage:
-                usage = response.usage
-                prompt_tokens = usage.prompt_tokens if hasattr(usage, 'prompt_tokens') else 0
-                completion_tokens = usage.completion_tokens if hasattr(usage, 'completion_tokens') else 0
-                total_tokens = usage.total_tokens if hasattr(usage, 'total_tokens') else 0
-                
-                # GPT-4o pricing (as of 2024): $2.50 per 1M input tokens, $10.00 per 1M output tokens
-                input_cost_per_1k = 0.0025  # $2.50 per 1M = $0.0025 per 1K
-                output_cost_per_1k = 0.01   # $10.00 per 1M = $0.01 per 1K
-                
-                input_cost = (prompt_tokens / 1000) * input_cost_per_1k
-                output_cost = (completion_tokens / 1000) * output_cost_per_1k
-                total_cost = input_cost + output_cost
-                
-                print(f"OpenAI Usage - Prompt tokens: {prompt_tokens}, Completion tokens: {completion_tokens}, Total: {total_tokens}")
-                print(f"OpenAI Cost - Input: ${input_cost:.6f}, Output: ${output_cost:.6f}, Total: ${total_cost:.6f}")
-            else:
-                print("OpenAI Usage: No usage data available")
-        except Exception as api_error:
-            print(f"OpenAI API error: {str(api_error)}")
-            raise HTTPException(
-                status_code=500,
-                detail=f"OpenAI API error: {str(api_error)}"
-            )
-        
-        # Parse response
+            form = await parser.parse()
+        except MultiPartException as e:
+            raise HTTPException(status_code=400, detail=e.message)
         try:
-            result = json.loads(response.choices[0].message.content)
-            print(f"Parsed result: {result}")
-        except json.JSONDecodeError as parse_error:
-            print(f"Failed to parse JSON: {response.choices[0].message.content}")
-            raise
-        
-        # Determine receipt type
-        receipt_type = result.get("receipt_type", "utility")  # Default to utility for backward compatibility
-        
-        print(f"Receipt type: {receipt_type}")
-        print(f"Raw extracted data from OpenAI: {result}")
+            upload = form.get("image") or form.get("file")
+            if not isinstance(upload, UploadFile):
+                raise HTTPException(status_code=400, detail="Missing 'image' file field")
+            language = form.get("language")
+            return await upload.read(), language if isinstance(language, str) else None
+        finally:
+            await form.close()
+    
+    raise HTTPException(
+        status_code=415,
+        detail="Send the image as multipart/form-data or as a raw image/* body"
+    )
+
+
+@router.post("/receipts/scan/upload")
+async def scan_receipt_upload(
+    request: Request,
+    language: Optional[str] = None,
+    current_user: User = Depends(get_current_user),
+    db: Session = Depends(get_db)
+):
+    """Scan a receipt uploaded as binary (no base64), same response as /receipts/scan"""
+    image_bytes, form_language = await read_image_upload(request)
+    if not image_bytes:
+        raise HTTPException(status_code=400, detail="No image data provided")
+    
+    return await scan_image_bytes(db, current_user, image_bytes, language or form_language or 'en')
+
+
+@router.post("/receipts/scan/batch")
+async def scan_receipt_batch(
+    request: ReceiptBatchScanRequest,
+    current_user: User = Depends(get_current_user),
+    db: Session = Depends(get_db)
+):
+    """Scan several receipts at once
+    
+    Streams NDJSON: one line per receipt ({"index", "success", "data" | "error"})
+    in completion order, then a {"done": true} summary line. Scans for the
+    whole batch are reserved in one step and refunded for failed receipts;
+    cached images don't count against the quota.
+    """
+    if not request.images_base64:
+        raise HTTPException(status_code=400, detail="No image data provided")
+    if len(request.images_base64) > RECEIPT_BATCH_MAX_IMAGES:
+        raise HTTPException(status_code=400, detail=f"At most {RECEIPT_BATCH_MAX_IMAGES} receipts per batch")
+    
+    user_id = current_user.id
+    user_language = request.language or 'en'
+    ready_lines = []  # Results known before any model call
+    pending = []  # (index, prepared image_bytes) that need extraction
+    
+    async def prepare_one(image_base64: str) -> bytes:
+        return await prepare_upload(decode_image_base64(image_base64))
+    
+    # Decoded and preprocessed together (in threads) so cache keys come from the prepared images
+    prepared = await asyncio.gather(*(prepare_one(image) for image in request.images_base64), return_exceptions=True)
+    for index, image_bytes in enumerate(prepared):
+        if isinstance(image_bytes, HTTPException):
+            ready_lines.append({"index": index, "success": False, "status": image_bytes.status_code, "error": image_bytes.detail})
+            continue
+        if isinstance(image_bytes, BaseException):
+            raise image_bytes
         
-        # Validate date format - always provide a date
-        date = result.get("date")
-        if date:
-            try:
-                datetime.strptime(date, "%Y-%m-%d")
-            except (ValueError, TypeError):
-                date = datetime.now().date().isoformat()
-                print(f"Invalid date format, using today")
+        cached_data = get_cached_extraction(db, user_id, image_cache_key(image_bytes, user_language))
+        if cached_data:
+            ready_lines.append({"index": index, "success": True, "data": cached_data, "cached": True})
         else:
-            date = datetime.now().date().isoformat()
-            print("No date extracted, using today")
-        
-        if receipt_type == "store":
-            # Handle itemized store receipt
-            items = result.get("items", [])
-            tax = result.get("tax") or 0
-            subtotal = result.get("subtotal") or 0
-            total = result.get("total") or 0
-            merchant = result.get("merchant")
+            pending.append((index, image_bytes))
+    
+    memory = get_user_memory(db, user_id)
+    
+    async def extract_one(index: int, image_bytes: bytes):
+        try:
+            extracted_data, layout_hash = await extract_with_memory(memory, image_bytes, user_language, preprocess=False, user_id=user_id)
+            return index, image_bytes, extracted_data, layout_hash, None
+        except ReceiptExtractionError as e:
+            return index, image_bytes, None, None, {"status": e.status_code, "error": e.detail}
+        except Exception as e:
+            return index, image_bytes, None, None, {"status": 500, "error": f"Error processing receipt: {str(e)}"}
+    
+    async def stream_results():
+        # Reserved here rather than before returning the response: a client that is gone
+        # before the body starts never runs this, so nothing is reserved that isn't refunded
+        tasks = []
+        granted, quota_month, scans_used = 0, None, 0
+        stream_db = SessionLocal()
+        try:
+            # One reservation for the whole batch; receipts beyond the allowance are rejected
+            limit = get_scan_limit(stream_db, user_id)
+            granted, quota_month = reserve_scans_up_to(stream_db, user_id, limit, len(pending))
+            rejected = [
+                {"index": index, "success": False, "status": 403, "error": scan_limit_message(limit)}
+                for index, _ in pending[granted:]
+            ]
+            for line in ready_lines + rejected:
+                yield json.dumps(line) + "\n"
             
-            # Validate and clean items
-            validated_items = []
-            for item in items:
-                item_amount = item.get("amount")
-                item_category = item.get("category")
-                item_description = item.get("description", "")
-                
-                # Validate amount
-                try:
-                    item_amount = float(item_amount) if item_amount else 0
-                except (ValueError, TypeError):
-                    print(f"Invalid item amount: {item_amount}, skipping")
+            # Model calls share the process-wide concurrency limit in openai_client
+            tasks = [asyncio.create_task(extract_one(index, image_bytes)) for index, image_bytes in pending[:granted]]
+            for next_done in asyncio.as_completed(tasks):
+                index, image_bytes, extracted_data, layout_hash, error = await next_done
+                if error:
+                    yield json.dumps({"index": index, "success": False, **error}) + "\n"
                     continue
                 
-                # Validate category
-                if item_category and item_category not in CATEGORIES:
-                    print(f"Category '{item_category}' not in list, setting to 'Other'")
-                    item_category = "Other"
-                
-                validated_items.append({
-                    "amount": item_amount,
-                    "category": item_category or "Other",
-                    "description": item_description
-                })
-            
-            # Calculate items total
-            items_total = sum(item["amount"] for item in validated_items)
-            
-            # Validate tax and fix if needed (for American-style receipts)
-            try:
-                tax = float(tax) if tax else 0
-                subtotal = float(subtotal) if subtotal else items_total
-                total = float(total) if total else 0
-            except (ValueError, TypeError):
-                tax = 0
-                subtotal = items_total
-                total = items_total
-            
-            # Check if American-style (tax added on top): itemsTotal !== total
-            # If they don't match, calculate correct tax from the difference
-            tax_included = abs(items_total - total) < 0.01
-            
-            if not tax_included and total > 0 and items_total > 0:
-                # American-style: tax is added on top
-                # Calculate correct tax: total - itemsTotal
-                tax_calculated = round(total - items_total, 2)
-                
-                # Use calculated tax if extracted tax is wrong or missing
-                if tax_calculated > 0:
-                    if abs(tax - tax_calculated) > 0.01:  # Tax doesn't match
-                        print(f"Tax mismatch: extracted={tax}, calculated={tax_calculated}. Using calculated tax.")
-                        tax = tax_calculated
-                    elif tax == 0:  # No tax extracted
-                        print(f"No tax extracted, using calculated tax: {tax_calculated}")
-                        tax = tax_calculated
-                else:
-                    tax = 0
-            else:
-                # European-style: tax included in prices, set tax to 0
-                tax = 0
-            
-            extracted_data = {
-                "receipt_type": "store",
-                "date": date,
-                "merchant": merchant,
-                "items": validated_items,
-                "tax": tax,
-                "subtotal": subtotal,
-                "total": total
-            }
-        else:
-            # Handle utility/bill receipt (single entry)
-            amount = result.get("amount")
-            merchant = result.get("merchant")
-            category = result.get("category", "Utilities")
-            description = result.get("description", "")
-            
-            # Validate category
-            if category and category not in CATEGORIES:
-                print(f"Category '{category}' not in list, setting to 'Utilities'")
-                category = "Utilities"
+                scans_used += 1
+                scan_id = save_scan_result(stream_db, user_id, extracted_data)
+                store_extraction(stream_db, user_id, image_cache_key(image_bytes, user_language), user_language, extracted_data)
+                remember_layout(stream_db, user_id, memory, extracted_data, layout_hash)
+                yield json.dumps({"index": index, "success": True, "scan_id": scan_id, "data": extracted_data}) + "\n"
             
-            # Validate amount
-            try:
-                amount = float(amount) if amount else None
-            except (ValueError, TypeError):
-                print(f"Invalid amount: {amount}")
-                amount = None
-            
-            extracted_data = {
-                "receipt_type": "utility",
-                "amount": amount,
-                "date": date,
-                "merchant": merchant,
-                "category": category,
-                "description": description
-            }
-        
-        print(f"Final extracted data: {extracted_data}")
-        
-        # Record the scan
-        record_scan(db, current_user.id)
-        
-        return {
-            "success": True,
-            "data": extracted_data,
-            "confidence": "high"
-        }
-        
-    except json.JSONDecodeError as e:
-        raise HTTPException(
-            status_code=500,
-            detail=f"Failed to parse OCR response: {str(e)}"
-        )
-    except Exception as e:
-        raise HTTPException(
-            status_code=500,
-            detail=f"Error processing receipt: {str(e)}"
-        )
+            yield json.dumps({"done": True, "count": len(request.images_base64), "scans_used": scans_used}) + "\n"
+        finally:
+            # Client went away mid-stream: stop paying for the remaining calls, and wait for
+            # them to end (shielded: the response's cancelled scope would cancel the wait too)
+            for task in tasks:
+                task.cancel()
+            with anyio.CancelScope(shield=True):
+                await asyncio.gather(*tasks, return_exceptions=True)
+            # Failed and unfinished receipts don't count against the quota
+            refund_scans(stream_db, user_id, quota_month, granted - scans_used)
+            stream_db.close()
+    
+    return StreamingResponse(stream_results(), media_type="application/x-ndjson")
+
+
+@router.get("/receipts/history")
+async def get_receipt_history(
+    limit: int = Query(20, ge=1, le=100),
+    before_id: Optional[int] = None,
+    current_user: User = Depends(get_current_user),
+    db: Session = Depends(get_db)
+):
+    """Saved scans, newest first; pass next_before_id back as before_id for the next page"""
+    query = db.query(ReceiptScanResult).filter(ReceiptScanResult.user_id == current_user.id)
+    if before_id is not None:
+        query = query.filter(ReceiptScanResult.scan_id < before_id)
+    results = query.order_by(ReceiptScanResult.scan_id.desc()).limit(limit + 1).all()
+    
+    has_more = len(results) > limit
+    results = results[:limit]
+    return {
+        "items": [scan_summary(result) for result in results],
+        "next_before_id": results[-1].scan_id if has_more else None,
+    }
 
+
+@router.get("/receipts/{scan_id}")
+async def get_receipt_scan(
+    scan_id: int,
+    current_user: User = Depends(get_current_user),
+    db: Session = Depends(get_db)
+):
+    """Reload a saved extraction (no model call, no scan used); same shape as /receipts/scan"""
+    result = get_scan_result(db, current_user.id, scan_id)
+    if not result:
+        raise HTTPException(status_code=404, detail="Scan not found")
+    
+    return {
+        "success": True,
+        "scan_id": result.scan_id,
+        "created_at": result.created_at.isoformat() if result.created_at else None,
+        "data": json.loads(result.data),
+        "confidence": "high"
+    }
@@ -0,0 +1,126 @@
+"""
+Saved receipt scan results.
+
+Each successful model extraction is stored as a receipt_scans row plus its
+extracted JSON in receipt_scan_results, so the app can reload a scan from
+/receipts/{id} (no model call, no quota) and list past scans at
+/receipts/history. Results older than RECEIPT_HISTORY_RETENTION_DAYS are
+pruned by a scheduled job.
+"""
+import json
+import os
+from datetime import datetime, timedelta
+from typing import Optional
+
+from sqlalchemy import func, select
+from sqlalchemy.orm import Session
+
+from database import SessionLocal, ReceiptScan, ReceiptScanResult
+import metrics
+
+RECEIPT_HISTORY_RETENTION_DAYS = int(os.getenv("RECEIPT_HISTORY_RETENTION_DAYS", "90"))
+RECEIPT_HISTORY_PRUNE_INTERVAL_SECONDS = int(os.getenv("RECEIPT_HISTORY_PRUNE_INTERVAL_SECONDS", str(6 * 3600)))
+RECEIPT_HISTORY_PRUNE_CHUNK_SIZE = int(os.getenv("RECEIPT_HISTORY_PRUNE_CHUNK_SIZE", "1000"))
+
+
+def save_scan_result(db: Session, user_id: int, data: dict, commit: bool = True) -> int:
+    """Store an extraction with its receipt_scans row; returns the scan id
+
+    With commit=False the rows are only flushed, so the caller can commit
+    them together with its own changes (or roll them back).
+    """
+    now = datetime.utcnow()
+    scan = ReceiptScan(
+        user_id=user_id,
+        scan_date=now,
+        month_year=f"{now.year}-{now.month:02d}"
+    )
+    db.add(scan)
+    db.flush()
+    db.add(ReceiptScanResult(
+        scan_id=scan.id,
+        user_id=user_id,
+        receipt_type=data.get("receipt_type"),
+        merchant=data.get("merchant"),
+        data=json.dumps(data),
+        created_at=now
+    ))
+    if commit:
+        db.commit()
+    else:
+        db.flush()
+    return scan.id
+
+
+def scan_summary(result: ReceiptScanResult) -> dict:
+    """History list entry for a saved scan"""
+    data = json.loads(result.data)
+    return {
+        "scan_id": result.scan_id,
+        "created_at": result.created_at.isoformat() if result.created_at else None,
+        "receipt_type": result.receipt_type,
+        "merchant": result.merchant,
+        "date": data.get("date"),
+        "total": data.get("total") if result.receipt_type == "store" else data.get("amount"),
+    }
+
+
+def get_scan_result(db: Session, user_id: int, scan_id: int) -> Optional[ReceiptScanResult]:
+    return db.query(ReceiptScanResult).filter(
+        ReceiptScanResult.scan_id == scan_id,
+        ReceiptScanResult.user_id == user_id
+    ).first()
+
+
+def _delete_ids(db: Session, column, ids_query) -> int:
+    """Delete one chunk of rows whose column is in ids_query"""
+    # Wrap in a derived table so the LIMIT subquery is accepted by every backend
+    chunk_ids = select(ids_query.limit(RECEIPT_HISTORY_PRUNE_CHUNK_SIZE).subquery().c[0])
+    result = db.execute(column.table.delete().where(column.in_(chunk_ids)))
+    db.commit()
+    return result.rowcount or 0
+
+
+def prune_receipt_history() -> int:
+    """Delete saved results (and their receipt_scans rows) past the retention period"""
+    cutoff = datetime.utcnow() - timedelta(days=RECEIPT_HISTORY_RETENTION_DAYS)
+    # This month's receipt_scans rows can still seed the scan quota counter
+    month_start = datetime.utcnow().replace(day=1, hour=0, minute=0, second=0, microsecond=0)
+    scans_cutoff = min(cutoff, month_start)
+
+    db = SessionLocal()
+    try:
+        results_deleted = 0
+        while True:
+            deleted = _delete_ids(
+                db,
+                ReceiptScanResult.id,
+                select(ReceiptScanResult.id).where(ReceiptScanResult.created_at < cutoff)
+            )
+            results_deleted += deleted
+            if deleted < RECEIPT_HISTORY_PRUNE_CHUNK_SIZE:
+                break
+
+        # Scan ids grow with time: find the newest expired one once, then delete by primary key
+        last_expired_id = db.query(func.max(ReceiptScan.id)).filter(ReceiptScan.scan_date < scans_cutoff).scalar()
+        scans_deleted = 0
+        while last_expired_id is not None:
+            deleted = _delete_ids(
+                db,
+                ReceiptScan.id,
+                select(ReceiptScan.id).where(
+                    ReceiptScan.id <= last_expired_id,
+                    ~ReceiptScan.id.in_(select(ReceiptScanResult.scan_id))
+                )
+            )
+            scans_deleted += deleted
+            if deleted < RECEIPT_HISTORY_PRUNE_CHUNK_SIZE:
+                break
+    finally:
+        db.close()
+
+    metrics.increment("receipt_history.results_pruned", results_deleted)
+    metrics.increment("receipt_history.scans_pruned", scans_deleted)
+    if results_deleted or scans_deleted:
+        print(f"Pruned {results_deleted} receipt scan results and {scans_deleted} receipt scans")
+    return results_deleted + scans_deleted
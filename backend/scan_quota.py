@@ -0,0 +1,113 @@
+"""
+Per-month receipt scan quota counters.
+
+scan_usage keeps one row per (user, month). A scan is reserved with a single
+conditional UPDATE ... SET used = used + n WHERE used + n <= limit RETURNING,
+so checking the limit and counting the scan happen in one statement and
+concurrent scans cannot overrun the quota. Callers refund the reservation
+when the extraction fails.
+"""
+from datetime import datetime
+from typing import Optional
+
+from sqlalchemy import func, update
+from sqlalchemy.dialects.postgresql import insert as postgresql_insert
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlalchemy.orm import Session
+
+from database import ReceiptScan, ScanUsage
+import metrics
+
+
+def current_month() -> str:
+    now = datetime.utcnow()
+    return f"{now.year}-{now.month:02d}"
+
+
+def _usage_row(user_id: int, month: str):
+    return (ScanUsage.user_id == user_id) & (ScanUsage.month == month)
+
+
+def _seed_usage_row(db: Session, user_id: int, month: str):
+    """Create the month's counter if it doesn't exist yet (INSERT ... ON CONFLICT DO NOTHING)"""
+    # Scans recorded in receipt_scans before the counter existed still count this month
+    legacy_used = db.query(func.count(ReceiptScan.id)).filter(
+        ReceiptScan.user_id == user_id,
+        ReceiptScan.month_year == month
+    ).scalar() or 0
+
+    insert = postgresql_insert if db.bind.dialect.name == "postgresql" else sqlite_insert
+    db.execute(
+        insert(ScanUsage)
+        .values(user_id=user_id, month=month, used=legacy_used, updated_at=datetime.utcnow())
+        .on_conflict_do_nothing(index_elements=["user_id", "month"])
+    )
+    db.commit()
+
+
+def reserve_scans(db: Session, user_id: int, limit: Optional[int], count: int = 1) -> Optional[str]:
+    """Count `count` scans against this month's quota if they fit under `limit`
+
+    Returns the reserved month (pass it to refund_scans on failure), or None
+    when the quota is used up. limit=None (unlimited plans) always succeeds.
+    """
+    month = current_month()
+    for _ in range(2):
+        stmt = update(ScanUsage).where(_usage_row(user_id, month)).values(
+            used=ScanUsage.used + count,
+            updated_at=datetime.utcnow()
+        )
+        if limit is not None:
+            stmt = stmt.where(ScanUsage.used + count <= limit)
+        used = db.execute(
+            stmt.returning(ScanUsage.used).execution_options(synchronize_session=False)
+        ).scalar()
+        db.commit()
+
+        if used is not None:
+            metrics.increment("scan_quota.reserved", count)
+            return month
+        if db.query(ScanUsage.id).filter(_usage_row(user_id, month)).first():
+            break  # Counter exists, so the limit was hit
+        _seed_usage_row(db, user_id, month)
+
+    metrics.increment("scan_quota.rejected")
+    return None
+
+
+def reserve_scans_up_to(db: Session, user_id: int, limit: Optional[int], wanted: int) -> tuple[int, Optional[str]]:
+    """Reserve as many of `wanted` scans as the quota allows; returns (granted, month)"""
+    while wanted > 0:
+        month = reserve_scans(db, user_id, limit, wanted)
+        if month:
+            return wanted, month
+        # Only part of the request fits (or none): retry with what is left
+        wanted = min(wanted - 1, limit - get_scans_used(db, user_id))
+    return 0, None
+
+
+def refund_scans(db: Session, user_id: int, month: Optional[str], count: int = 1):
+    """Give back scans reserved by reserve_scans (e.g. the extraction failed)"""
+    if not month or count <= 0:
+        return
+    db.execute(
+        update(ScanUsage)
+        .where(_usage_row(user_id, month), ScanUsage.used >= count)
+        .values(used=ScanUsage.used - count, updated_at=datetime.utcnow())
+        .execution_options(synchronize_session=False)
+    )
+    db.commit()
+    metrics.increment("scan_quota.refunded", count)
+
+
+def get_scans_used(db: Session, user_id: int) -> int:
+    """Scans counted against this month's quota"""
+    month = current_month()
+    used = db.query(ScanUsage.used).filter(_usage_row(user_id, month)).scalar()
+    if used is not None:
+        return used
+    # No counter yet this month: fall back to scans recorded before it existed
+    return db.query(func.count(ReceiptScan.id)).filter(
+        ReceiptScan.user_id == user_id,
+        ReceiptScan.month_year == month
+    ).scalar() or 0
@@ -0,0 +1,67 @@
+"""
+Periodic maintenance jobs.
+
+Jobs are registered with register_job and run inside the web process as
+asyncio tasks; each run happens in a worker thread so blocking database work
+doesn't stall requests. Every web worker runs its own copy, so jobs must be
+safe to run concurrently (idempotent deletes and conditional updates).
+Set SCHEDULER_ENABLED=false to run them elsewhere (e.g. a single cron host).
+"""
+import asyncio
+import os
+import random
+import time
+from typing import Callable
+
+import metrics
+
+SCHEDULER_ENABLED = os.getenv("SCHEDULER_ENABLED", "true").lower() == "true"
+
+_jobs: dict[str, tuple[float, Callable[[], object]]] = {}
+_tasks: list = []
+
+
+def register_job(name: str, interval_seconds: float, func: Callable[[], object]):
+    """Run func every interval_seconds once the scheduler starts"""
+    _jobs[name] = (interval_seconds, func)
+
+
+def run_job_now(name: str):
+    """Run a registered job once in the calling thread, recording metrics"""
+    _, func = _jobs[name]
+    start = time.perf_counter()
+    try:
+        result = func()
+    except Exception as e:
+        metrics.increment(f"scheduler.{name}.failures")
+        print(f"Scheduled job {name} failed: {e}")
+        return None
+    metrics.increment(f"scheduler.{name}.runs")
+    metrics.set_gauge(f"scheduler.{name}.last_run_ms", round((time.perf_counter() - start) * 1000, 1))
+    metrics.set_gauge(f"scheduler.{name}.last_result", result)
+    return result
+
+
+async def _job_loop(name: str, interval_seconds: float):
+    # Spread the first run so workers started together don't all run at once
+    await asyncio.sleep(random.uniform(0, min(interval_seconds, 60)))
+    while True:
+        await asyncio.to_thread(run_job_now, name)
+        await asyncio.sleep(interval_seconds)
+
+
+def start_scheduler():
+    """Start one task per registered job on the running event loop"""
+    if not SCHEDULER_ENABLED or _tasks:
+        return
+    for name, (interval_seconds, _) in _jobs.items():
+        _tasks.append(asyncio.create_task(_job_loop(name, interval_seconds)))
+    if _jobs:
+        print(f"Scheduler started: {', '.join(_jobs)}")
+
+
+async def stop_scheduler():
+    for task in _tasks:
+        task.cancel()
+    await asyncio.gather(*_tasks, return_exceptions=True)
+    _tasks.clear()
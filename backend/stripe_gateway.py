@@ -0,0 +1,318 @@
+"""
+Stripe API calls for the web process and the event workers.
+
+Every call goes through a StripeClient over httpx with an explicit timeout
+(STRIPE_TIMEOUT_SECONDS). Async routes await the SDK's *_async methods, so a
+slow Stripe never blocks the event loop; stripe_worker handlers, which
+already run in a worker thread, use the sync methods.
+
+Failures that can succeed on a second try (connection errors and timeouts,
+429s, 5xx) are retried up to STRIPE_MAX_RETRIES times with exponential
+backoff and full jitter. Creates send an idempotency key that stays the same
+across retries, so a retried create can't make a second customer or
+session. A circuit breaker counts calls that still fail after their retries:
+after STRIPE_BREAKER_FAILURES in a row it opens, and calls fail fast with
+StripeUnavailableError for STRIPE_BREAKER_RESET_SECONDS; then one trial call
+decides whether it closes again.
+
+Customer ids are cached per user in memory (they never change once saved on
+the subscription row). STRIPE_API_BASE points the client at
+fake_stripe_server.py for load tests.
+"""
+import asyncio
+import hashlib
+import logging
+import os
+import random
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from typing import Optional
+
+import stripe
+from sqlalchemy import update
+from sqlalchemy.orm import Session
+
+from database import Subscription
+from entitlements import get_or_create_subscription
+import metrics
+
+logger = logging.getLogger(__name__)
+
+STRIPE_SECRET_KEY = os.getenv("STRIPE_SECRET_KEY")
+STRIPE_API_BASE = os.getenv("STRIPE_API_BASE")  # e.g. a local fake server for load tests
+STRIPE_TIMEOUT_SECONDS = float(os.getenv("STRIPE_TIMEOUT_SECONDS", "10"))
+STRIPE_MAX_RETRIES = int(os.getenv("STRIPE_MAX_RETRIES", "2"))
+STRIPE_RETRY_BASE_DELAY_SECONDS = float(os.getenv("STRIPE_RETRY_BASE_DELAY_SECONDS", "0.5"))
+STRIPE_BREAKER_FAILURES = int(os.getenv("STRIPE_BREAKER_FAILURES", "5"))
+STRIPE_BREAKER_RESET_SECONDS = float(os.getenv("STRIPE_BREAKER_RESET_SECONDS", "30"))
+STRIPE_CUSTOMER_CACHE_MAX_USERS = int(os.getenv("STRIPE_CUSTOMER_CACHE_MAX_USERS", "10000"))
+
+
+class StripeUnavailableError(Exception):
+    """Stripe can't be reached right now (breaker open or retries used up)"""
+
+    def __init__(self, message: str, retry_after: float):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+class CircuitBreaker:
+    """Consecutive-failure breaker shared by the async and the sync call paths"""
+
+    def __init__(self, failure_threshold: int, reset_seconds: float):
+        self.failure_threshold = failure_threshold
+        self.reset_seconds = reset_seconds
+        self._lock = threading.Lock()
+        self._failures = 0
+        self._opened_at: Optional[float] = None
+        self._trial_in_flight = False
+
+    @property
+    def is_open(self) -> bool:
+        return self._opened_at is not None
+
+    def before_call(self):
+        """Raise StripeUnavailableError while open; after the reset period let one trial call through"""
+        with self._lock:
+            if self._opened_at is None:
+                return
+            remaining = self._opened_at + self.reset_seconds - time.monotonic()
+            if remaining > 0 or self._trial_in_flight:
+                metrics.increment("stripe.breaker_rejected")
+                raise StripeUnavailableError("Payment provider unavailable, please try again shortly", max(remaining, 1.0))
+            self._trial_in_flight = True
+
+    def record_success(self):
+        with self._lock:
+            if self._opened_at is not None:
+                logger.info("Stripe circuit breaker closed")
+            self._failures = 0
+            self._opened_at = None
+            self._trial_in_flight = False
+            metrics.set_gauge("stripe.breaker_open", 0)
+
+    def record_failure(self):
+        with self._lock:
+            self._failures += 1
+            self._trial_in_flight = False
+            if self._opened_at is not None or self._failures >= self.failure_threshold:
+                if self._opened_at is None:
+                    logger.warning(f"Stripe circuit breaker opened after {self._failures} failed calls")
+                    metrics.increment("stripe.breaker_opened")
+                self._opened_at = time.monotonic()
+                metrics.set_gauge("stripe.breaker_open", 1)
+
+    def release_trial(self):
+        """The trial call was abandoned (e.g. the request was cancelled) without an answer"""
+        with self._lock:
+            self._trial_in_flight = False
+
+
+breaker = CircuitBreaker(STRIPE_BREAKER_FAILURES, STRIPE_BREAKER_RESET_SECONDS)
+
+_async_client: Optional[stripe.StripeClient] = None
+_async_loop: Optional[asyncio.AbstractEventLoop] = None
+_sync_client: Optional[stripe.StripeClient] = None
+_sync_client_lock = threading.Lock()
+
+_customers: "OrderedDict[int, str]" = OrderedDict()
+_customers_lock = threading.Lock()
+
+
+def is_configured() -> bool:
+    return bool(STRIPE_SECRET_KEY)
+
+
+def _new_client(allow_sync_methods: bool) -> stripe.StripeClient:
+    return stripe.StripeClient(
+        STRIPE_SECRET_KEY,
+        base_addresses={"api": STRIPE_API_BASE} if STRIPE_API_BASE else None,
+        max_network_retries=0,  # Retries happen here, with jitter and the breaker
+        http_client=stripe.HTTPXClient(timeout=STRIPE_TIMEOUT_SECONDS, allow_sync_methods=allow_sync_methods),
+    )
+
+
+def _get_async_client() -> stripe.StripeClient:
+    """Client for the running event loop; httpx's async pool is bound to the loop it was made on"""
+    global _async_client, _async_loop
+    loop = asyncio.get_running_loop()
+    if _async_loop is not loop:
+        _async_client = _new_client(allow_sync_methods=False)
+        _async_loop = loop
+    return _async_client
+
+
+def _get_sync_client() -> stripe.StripeClient:
+    global _sync_client
+    with _sync_client_lock:
+        if _sync_client is None:
+            _sync_client = _new_client(allow_sync_methods=True)
+        return _sync_client
+
+
+def _is_retryable(error: Exception) -> bool:
+    if isinstance(error, (stripe.APIConnectionError, stripe.RateLimitError)):
+        return True
+    if error.http_status == 409:
+        return True  # Another request with the same idempotency key is still running
+    return isinstance(error, stripe.APIError) and (error.http_status or 500) >= 500
+
+
+def _backoff(attempt: int) -> float:
+    # Full jitter: concurrent callers that failed together don't retry together
+    return random.uniform(0, STRIPE_RETRY_BASE_DELAY_SECONDS * 2 ** attempt)
+
+
+def _request_options(idempotent: bool, idempotency_key: Optional[str]) -> dict:
+    if idempotency_key:
+        return {"idempotency_key": idempotency_key}
+    return {"idempotency_key": str(uuid.uuid4())} if idempotent else {}
+
+
+def _give_up(name: str, error: Exception):
+    breaker.record_failure()
+    metrics.increment("stripe.unavailable")
+    logger.error(f"Stripe {name} failed after {STRIPE_MAX_RETRIES + 1} attempts: {error}")
+    retry_after = breaker.reset_seconds if breaker.is_open else STRIPE_RETRY_BASE_DELAY_SECONDS * 2 ** STRIPE_MAX_RETRIES
+    raise StripeUnavailableError("Payment provider unavailable, please try again shortly", retry_after) from error
+
+
+async def _call_async(name: str, call, idempotent: bool = False, idempotency_key: Optional[str] = None):
+    """Run call(client, options) with retries, the breaker and one idempotency key for all attempts"""
+    breaker.before_call()
+    options = _request_options(idempotent, idempotency_key)
+    try:
+        client = _get_async_client()
+        for attempt in range(STRIPE_MAX_RETRIES + 1):
+            metrics.increment("stripe.calls")
+            try:
+                result = await call(client, options)
+            except stripe.StripeError as e:
+                if not _is_retryable(e):
+                    breaker.record_success()  # Stripe answered; the request itself was refused
+                    raise
+                if attempt == STRIPE_MAX_RETRIES:
+                    _give_up(name, e)
+                metrics.increment("stripe.retries")
+                logger.warning(f"Stripe {name} attempt {attempt + 1} failed, retrying: {e}")
+                await asyncio.sleep(_backoff(attempt))
+            else:
+                breaker.record_success()
+                return result
+    except BaseException:
+        breaker.release_trial()
+        raise
+
+
+def _call_sync(name: str, call, idempotent: bool = False, idempotency_key: Optional[str] = None):
+    """Blocking twin of _call_async, for code already running in a worker thread"""
+    breaker.before_call()
+    options = _request_options(idempotent, idempotency_key)
+    try:
+        client = _get_sync_client()
+        for attempt in range(STRIPE_MAX_RETRIES + 1):
+            metrics.increment("stripe.calls")
+            try:
+                result = call(client, options)
+            except stripe.StripeError as e:
+                if not _is_retryable(e):
+                    breaker.record_success()
+                    raise
+                if attempt == STRIPE_MAX_RETRIES:
+                    _give_up(name, e)
+                metrics.increment("stripe.retries")
+                logger.warning(f"Stripe {name} attempt {attempt + 1} failed, retrying: {e}")
+                time.sleep(_backoff(attempt))
+            else:
+                breaker.record_success()
+                return result
+    except BaseException:
+        breaker.release_trial()
+        raise
+
+
+def _cached_customer(user_id: int) -> Optional[str]:
+    with _customers_lock:
+        customer_id = _customers.get(user_id)
+        if customer_id:
+            _customers.move_to_end(user_id)
+        return customer_id
+
+
+def _remember_customer(user_id: int, customer_id: str):
+    with _customers_lock:
+        _customers[user_id] = customer_id
+        _customers.move_to_end(user_id)
+        while len(_customers) > STRIPE_CUSTOMER_CACHE_MAX_USERS:
+            _customers.popitem(last=False)
+
+
+async def get_or_create_customer_id(db: Session, user_id: int, email: str) -> str:
+    """The user's Stripe customer id: from memory, the subscription row, or a new Stripe customer"""
+    customer_id = _cached_customer(user_id)
+    if customer_id:
+        metrics.increment("stripe.customer_cache_hits")
+        return customer_id
+
+    customer_id = get_or_create_subscription(db, user_id).stripe_customer_id
+    if not customer_id:
+        # Don't hold a pooled connection while waiting on Stripe
+        db.commit()
+        customer = await _call_async(
+            "customers.create",
+            lambda client, options: client.v1.customers.create_async(
+                {"email": email, "metadata": {"user_id": str(user_id)}}, options
+            ),
+            # Same key for the same user and email: concurrent checkouts (in any
+            # process) get one customer back from Stripe instead of one each
+            idempotency_key=f"customer-{user_id}-{hashlib.sha256(email.encode()).hexdigest()[:16]}"
+        )
+        # Two checkouts at once: keep whichever customer was saved first
+        saved = db.execute(
+            update(Subscription)
+            .where(Subscription.user_id == user_id, Subscription.stripe_customer_id.is_(None))
+            .values(stripe_customer_id=customer.id)
+            .execution_options(synchronize_session=False)
+        ).rowcount
+        customer_id = customer.id if saved else db.query(Subscription.stripe_customer_id).filter(
+            Subscription.user_id == user_id
+        ).scalar()
+        db.commit()
+        if not saved:
+            logger.warning(f"Stripe customer {customer.id} for user {user_id} unused, {customer_id} was saved first")
+
+    _remember_customer(user_id, customer_id)
+    return customer_id
+
+
+async def create_checkout_session(params: dict):
+    return await _call_async(
+        "checkout.sessions.create",
+        lambda client, options: client.v1.checkout.sessions.create_async(params, options),
+        idempotent=True
+    )
+
+
+async def cancel_at_period_end(stripe_subscription_id: str):
+    return await _call_async(
+        "subscriptions.update",
+        lambda client, options: client.v1.subscriptions.update_async(
+            stripe_subscription_id, {"cancel_at_period_end": True}, options
+        )
+    )
+
+
+def retrieve_subscription(stripe_subscription_id: str):
+    return _call_sync(
+        "subscriptions.retrieve",
+        lambda client, options: client.v1.subscriptions.retrieve(stripe_subscription_id, options=options)
+    )
+
+
+def retrieve_event(event_id: str):
+    return _call_sync(
+        "events.retrieve",
+        lambda client, options: client.v1.events.retrieve(event_id, options=options)
+    )
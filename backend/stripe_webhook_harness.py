@@ -0,0 +1,428 @@
+#!/usr/bin/env python3
+"""
+Fire signed Stripe webhook events at /webhooks/stripe.
+
+By default the app runs in-process (httpx ASGI transport) on a scratch SQLite
+database in a temp directory, with customers whose subscriptions the events
+update. Each customer gets a subscription.updated -> invoice.payment_failed
+-> subscription.updated -> subscription.deleted sequence. Events are signed
+with STRIPE_WEBHOOK_SECRET exactly like Stripe does, a share of them is
+redelivered, and deliveries of different customers interleave.
+
+The run has two phases, so ack speed and processing speed are measured
+separately: first every event is posted (workers stopped), then a worker
+pool drains the queue. Afterwards it checks that every customer ended up
+cancelled with exactly one payment_failed notification and its renewed
+billing period, i.e. that redeliveries were dropped and each customer's
+events applied in order.
+
+Then it runs the subscription lifecycle sweeper on three unlimited plans
+whose stored period ended past the renewal grace: one renewed by a
+subscription.updated event (must stay unlimited with the new period), one
+whose ended period came from Stripe with no renewal (must expire), and one
+whose period Stripe never set (must be left alone).
+
+    python stripe_webhook_harness.py --customers 500 --concurrency 50 --duplicate-rate 0.2
+    python stripe_webhook_harness.py --live            # workers run while events arrive
+    python stripe_webhook_harness.py --url http://localhost:8000 --secret whsec_...  # a running server (acks only)
+"""
+import argparse
+import asyncio
+import hashlib
+import hmac
+import json
+import os
+import random
+import sys
+import tempfile
+import time
+
+BACKEND_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, BACKEND_DIR)
+
+DEFAULT_SECRET = "whsec_harness"
+
+
+def sign(payload: str, secret: str, timestamp: int) -> str:
+    """Stripe-Signature header value for a payload"""
+    signature = hmac.new(secret.encode(), f"{timestamp}.{payload}".encode(), hashlib.sha256).hexdigest()
+    return f"t={timestamp},v1={signature}"
+
+
+def percentile(sorted_values: list, p: float):
+    if not sorted_values:
+        return None
+    rank = max(1, round(p / 100 * len(sorted_values)))
+    return sorted_values[min(rank, len(sorted_values)) - 1]
+
+
+def summarize_ms(values: list) -> str:
+    values = sorted(values)
+    if not values:
+        return "n/a"
+    return (
+        f"p50={percentile(values, 50):.1f}ms p90={percentile(values, 90):.1f}ms "
+        f"p99={percentile(values, 99):.1f}ms max={values[-1]:.1f}ms"
+    )
+
+
+def customer_events(index: int, base_created: int) -> list[dict]:
+    """One customer's lifecycle, in Stripe creation order"""
+    customer_id = f"cus_harness{index}"
+    subscription_id = f"sub_harness{index}"
+    period_start = base_created - 86400
+
+    def subscription(months: int) -> dict:
+        # API version 2025-03-31.basil shape: the period is on the subscription items
+        return {
+            "id": subscription_id, "object": "subscription", "customer": customer_id,
+            "items": {"object": "list", "data": [{
+                "id": f"si_harness{index}", "object": "subscription_item",
+                "current_period_start": period_start + (months - 1) * 30 * 86400,
+                "current_period_end": period_start + months * 30 * 86400,
+            }]},
+        }
+
+    steps = [
+        ("customer.subscription.updated", {**subscription(1), "status": "active"}),
+        ("invoice.payment_failed", {"id": f"in_harness{index}", "object": "invoice", "customer": customer_id}),
+        # Renewal: the next period
+        ("customer.subscription.updated", {**subscription(2), "status": "active"}),
+        ("customer.subscription.deleted", {**subscription(2), "status": "canceled"}),
+    ]
+    return [
+        {
+            "id": f"evt_harness{index}_{step}",
+            "object": "event",
+            "created": base_created + step,
+            "type": event_type,
+            "data": {"object": obj},
+        }
+        for step, (event_type, obj) in enumerate(steps)
+    ]
+
+
+def build_deliveries(customers: int, duplicate_rate: float, rng: random.Random) -> list[dict]:
+    """All events, customers interleaved (each customer's in order), plus redeliveries"""
+    base_created = int(time.time()) - 3600
+    queues = [customer_events(index, base_created) for index in range(customers)]
+    deliveries = []
+    while queues:
+        queue = rng.choice(queues)
+        deliveries.append(queue.pop(0))
+        if not queue:
+            queues.remove(queue)
+    for event in rng.sample(deliveries, int(len(deliveries) * duplicate_rate)):
+        # Stripe redelivers some time later
+        deliveries.insert(rng.randrange(deliveries.index(event) + 1, len(deliveries) + 1), event)
+    return deliveries
+
+
+def create_customers(customers: int):
+    from datetime import datetime
+    from database import SessionLocal, Subscription, SubscriptionPlanType, SubscriptionStatus, User
+
+    db = SessionLocal()
+    try:
+        users = [User(email=f"harness{index}@example.com", password_hash="x", name=f"Harness {index}") for index in range(customers)]
+        db.add_all(users)
+        db.flush()
+        db.add_all([
+            Subscription(
+                user_id=user.id,
+                plan_type=SubscriptionPlanType.UNLIMITED.value,
+                status=SubscriptionStatus.ACTIVE.value,
+                stripe_customer_id=f"cus_harness{index}",
+                stripe_subscription_id=f"sub_harness{index}",
+                current_period_start=datetime.utcnow(),
+                current_period_end=datetime.utcnow()
+            )
+            for index, user in enumerate(users)
+        ])
+        db.commit()
+    finally:
+        db.close()
+
+
+def renewed_period_ends(deliveries: list[dict]) -> dict:
+    """{stripe_subscription_id: period end of its last customer.subscription.updated}"""
+    from datetime import datetime
+
+    ends = {}
+    for event in sorted(deliveries, key=lambda event: event["created"]):
+        if event["type"] == "customer.subscription.updated":
+            obj = event["data"]["object"]
+            ends[obj["id"]] = datetime.utcfromtimestamp(obj["items"]["data"][0]["current_period_end"])
+    return ends
+
+
+def verify(customers: int, deliveries: list[dict]) -> list[str]:
+    """Problems with the final state, if any"""
+    from sqlalchemy import func
+    from database import (
+        SessionLocal, Notification, StripeEvent, StripeEventStatus, Subscription,
+        SubscriptionPlanType, SubscriptionStatus
+    )
+
+    db = SessionLocal()
+    try:
+        problems = []
+        statuses = dict(db.query(StripeEvent.status, func.count(StripeEvent.id)).filter(
+            StripeEvent.event_id.like("evt_harness%")
+        ).group_by(StripeEvent.status).all())
+        if statuses != {StripeEventStatus.PROCESSED.value: customers * 4}:
+            problems.append(f"stripe_events by status: {statuses} (expected {customers * 4} processed)")
+        wrong_state = db.query(Subscription).filter(
+            Subscription.stripe_customer_id.like("cus_harness%"),
+            (Subscription.status != SubscriptionStatus.CANCELLED.value) |
+            (Subscription.plan_type != SubscriptionPlanType.LIMITED.value)
+        ).count()
+        if wrong_state:
+            problems.append(f"{wrong_state} subscriptions not cancelled: events applied out of order")
+        expected_ends = renewed_period_ends(deliveries)
+        wrong_period = sum(
+            1 for subscription_id, period_end in db.query(
+                Subscription.stripe_subscription_id, Subscription.current_period_end
+            ).filter(Subscription.stripe_customer_id.like("cus_harness%"))
+            if period_end != expected_ends.get(subscription_id)
+        )
+        if wrong_period:
+            problems.append(f"{wrong_period} subscriptions without the renewed billing period")
+        notifications = db.query(Notification).filter(Notification.type == "payment_failed").count()
+        if notifications != customers:
+            problems.append(f"{notifications} payment_failed notifications (expected {customers}): redeliveries applied twice")
+        return problems
+    finally:
+        db.close()
+
+
+def sweep_event(name: str, status: str, period_start: int, period_end: int) -> dict:
+    return {
+        "id": f"evt_sweep_{name}", "object": "event", "created": int(time.time()),
+        "type": "customer.subscription.updated",
+        "data": {"object": {
+            "id": f"sub_sweep_{name}", "object": "subscription", "customer": f"cus_sweep_{name}", "status": status,
+            "items": {"object": "list", "data": [{
+                "id": f"si_sweep_{name}", "object": "subscription_item",
+                "current_period_start": period_start, "current_period_end": period_end,
+            }]},
+        }},
+    }
+
+
+async def check_renewal_sweep(transport, args, rng: random.Random) -> list[str]:
+    """Sweep unlimited plans whose stored period ended; only a Stripe-set, unrenewed one may expire"""
+    from datetime import datetime
+    from database import SessionLocal, Subscription, SubscriptionPlanType, SubscriptionStatus, User
+    from subscription_lifecycle import SUBSCRIPTION_RENEWAL_GRACE_HOURS, sweep_subscriptions
+    import httpx
+
+    # Ended a day past the grace: the sweeper expires such a plan unless it was renewed
+    ended = int(time.time() - (SUBSCRIPTION_RENEWAL_GRACE_HOURS + 24) * 3600)
+    month = 30 * 86400
+    names = ("renewed", "lapsed", "local")
+    db = SessionLocal()
+    try:
+        for name in names:
+            user = User(email=f"sweep-{name}@example.com", password_hash="x", name=f"Sweep {name}")
+            db.add(user)
+            db.flush()
+            db.add(Subscription(
+                user_id=user.id,
+                plan_type=SubscriptionPlanType.UNLIMITED.value,
+                status=SubscriptionStatus.ACTIVE.value,
+                stripe_customer_id=f"cus_sweep_{name}",
+                stripe_subscription_id=f"sub_sweep_{name}",
+                # The month window checkout kept when it couldn't read Stripe's period
+                current_period_start=datetime.utcfromtimestamp(ended - month),
+                current_period_end=datetime.utcfromtimestamp(ended)
+            ))
+        db.commit()
+    finally:
+        db.close()
+
+    events = [
+        sweep_event("renewed", "active", ended, ended + month),
+        sweep_event("lapsed", "active", ended - month, ended),
+    ]
+    async with httpx.AsyncClient(transport=transport, base_url="http://harness", timeout=30) as client:
+        await fire(client, events, args.secret, 1, 0.0, rng)
+    if not await wait_for_drain(args.drain_timeout):
+        return ["sweep scenario events not processed"]
+    swept = await asyncio.to_thread(sweep_subscriptions)
+
+    expected = {
+        "renewed": (SubscriptionPlanType.UNLIMITED.value, datetime.utcfromtimestamp(ended + month)),
+        "lapsed": (SubscriptionPlanType.LIMITED.value, None),
+        "local": (SubscriptionPlanType.UNLIMITED.value, datetime.utcfromtimestamp(ended)),
+    }
+    problems = []
+    db = SessionLocal()
+    try:
+        for name in names:
+            subscription = db.query(Subscription).filter(Subscription.stripe_subscription_id == f"sub_sweep_{name}").one()
+            plan_type, period_end = expected[name]
+            if subscription.plan_type != plan_type or (period_end and subscription.current_period_end != period_end):
+                problems.append(
+                    f"sweep: {name} subscription is {subscription.plan_type} until {subscription.current_period_end} "
+                    f"(expected {plan_type}" + (f" until {period_end})" if period_end else ")")
+                )
+    finally:
+        db.close()
+    print(f"Sweep:       {swept} subscriptions changed")
+    return problems
+
+
+async def wait_for_drain(timeout: float) -> bool:
+    from database import SessionLocal, StripeEvent
+    from stripe_worker import UNFINISHED_STATUSES
+
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        db = SessionLocal()
+        try:
+            remaining = db.query(StripeEvent).filter(StripeEvent.status.in_(UNFINISHED_STATUSES)).count()
+        finally:
+            db.close()
+        if not remaining:
+            return True
+        await asyncio.sleep(0.05)
+    return False
+
+
+async def fire(client, deliveries: list[dict], secret: str, concurrency: int, bad_signature_rate: float, rng: random.Random) -> dict:
+    semaphore = asyncio.Semaphore(concurrency)
+    latencies_ms: list[float] = []
+    statuses: dict = {}
+    duplicates = 0
+    rejected = []
+
+    async def post(event: dict, attempt: int):
+        nonlocal duplicates
+        payload = json.dumps(event)
+        header = sign(payload, secret, int(time.time()))
+        if attempt == 0 and rng.random() < bad_signature_rate:
+            header = sign(payload, secret + "-wrong", int(time.time()))
+        async with semaphore:
+            start = time.perf_counter()
+            response = await client.post(
+                "/webhooks/stripe",
+                content=payload,
+                headers={"Content-Type": "application/json", "Stripe-Signature": header}
+            )
+            latencies_ms.append((time.perf_counter() - start) * 1000)
+        statuses[response.status_code] = statuses.get(response.status_code, 0) + 1
+        if response.status_code == 200 and response.json().get("duplicate"):
+            duplicates += 1
+        elif response.status_code != 200:
+            rejected.append(event)
+
+    # Deliveries start in order; up to `concurrency` of them race each other
+    started = time.perf_counter()
+    await asyncio.gather(*(post(event, 0) for event in deliveries))
+    # Stripe retries anything that wasn't acknowledged with a 2xx
+    retries, rejected = rejected, []
+    await asyncio.gather(*(post(event, 1) for event in retries))
+    return {
+        "requests": len(deliveries) + len(retries),
+        "elapsed": time.perf_counter() - started,
+        "latencies_ms": latencies_ms,
+        "statuses": statuses,
+        "duplicates": duplicates,
+    }
+
+
+def print_acks(result: dict):
+    sent = result["requests"]
+    print(f"Delivered:   {sent} requests in {result['elapsed']:.2f}s ({sent / result['elapsed']:.0f} req/s)")
+    print(f"Ack latency: {summarize_ms(result['latencies_ms'])}")
+    print(f"Responses:   {result['statuses']}  duplicates acknowledged: {result['duplicates']}")
+
+
+async def run_remote(args, deliveries: list[dict], rng: random.Random):
+    import httpx
+
+    async with httpx.AsyncClient(base_url=args.url, timeout=30) as client:
+        result = await fire(client, deliveries, args.secret, args.concurrency, args.bad_signature_rate, rng)
+    print_acks(result)
+
+
+async def run_in_process(args, deliveries: list[dict], rng: random.Random):
+    import httpx
+    from main import app
+    import stripe_worker
+
+    async with app.router.lifespan_context(app):
+        create_customers(args.customers)
+        if args.live:
+            stripe_worker.STRIPE_EVENTS_IN_PROCESS = True
+            stripe_worker.start_stripe_workers()
+
+        transport = httpx.ASGITransport(app=app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://harness", timeout=30) as client:
+            result = await fire(client, deliveries, args.secret, args.concurrency, args.bad_signature_rate, rng)
+        print_acks(result)
+
+        if not args.live:
+            stripe_worker.STRIPE_EVENTS_IN_PROCESS = True
+            stripe_worker.start_stripe_workers()
+        drain_started = time.perf_counter()
+        drained = await wait_for_drain(args.drain_timeout)
+        drain_elapsed = time.perf_counter() - drain_started
+        sweep_problems = await check_renewal_sweep(transport, args, rng) if drained else []
+        await stripe_worker.stop_stripe_workers()
+
+    events = args.customers * 4
+    if drained:
+        label = "Drained" if args.live else "Processed"
+        print(f"{label}:   {events} events in {drain_elapsed:.2f}s"
+              + ("" if args.live else f" ({events / drain_elapsed:.0f} events/s, {stripe_worker.STRIPE_EVENT_WORKERS} workers)"))
+    else:
+        print(f"Queue not drained after {args.drain_timeout:g}s")
+
+    problems = verify(args.customers, deliveries) + sweep_problems
+    print("Check:       " + ("OK (each event applied once, in order per customer; renewed plans survive the sweep)" if not problems else "FAILED"))
+    for problem in problems:
+        print(f"  - {problem}")
+    return not problems
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Signed Stripe webhook load harness")
+    parser.add_argument("--customers", type=int, default=200, help="customers, 4 events each")
+    parser.add_argument("--concurrency", type=int, default=20, help="deliveries in flight at once")
+    parser.add_argument("--duplicate-rate", type=float, default=0.1, help="share of events delivered twice")
+    parser.add_argument("--bad-signature-rate", type=float, default=0.0, help="share of deliveries with a wrong signature")
+    parser.add_argument("--live", action="store_true", help="run workers while events arrive instead of afterwards")
+    parser.add_argument("--workers", type=int, help="Stripe event workers (default STRIPE_EVENT_WORKERS)")
+    parser.add_argument("--drain-timeout", type=float, default=120)
+    parser.add_argument("--url", help="post to a running server instead of an in-process app")
+    parser.add_argument("--secret", default=DEFAULT_SECRET, help="webhook signing secret (in-process: set for the app)")
+    parser.add_argument("--seed", type=int)
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    deliveries = build_deliveries(args.customers, args.duplicate_rate, rng)
+
+    if args.url:
+        asyncio.run(run_remote(args, deliveries, rng))
+        return
+
+    # The app reads its settings at import time: scratch database, no real Stripe
+    os.environ["STRIPE_WEBHOOK_SECRET"] = args.secret
+    os.environ["STRIPE_EVENTS_IN_PROCESS"] = "false"  # Started by the harness
+    os.environ.setdefault("PASSWORD_HASH_CALIBRATE", "false")
+    os.environ.setdefault("SCHEDULER_ENABLED", "false")
+    if args.workers:
+        os.environ["STRIPE_EVENT_WORKERS"] = str(args.workers)
+    os.environ.pop("DATABASE_URL", None)
+    os.environ.pop("STRIPE_SECRET_KEY", None)
+    os.chdir(tempfile.mkdtemp(prefix="stripe-harness-"))
+    print(f"Database: {os.getcwd()}/expenses.db")
+
+    ok = asyncio.run(run_in_process(args, deliveries, rng))
+    sys.exit(0 if ok else 1)
+
+
+if __name__ == "__main__":
+    main()
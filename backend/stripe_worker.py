@@ -0,0 +1,416 @@
+"""
+Queued processing of Stripe webhook events.
+
+POST /webhooks/stripe only verifies the signature, stores the event in
+stripe_events and acknowledges; the unique event id drops Stripe's
+redeliveries. Workers apply stored events to subscriptions: one customer's
+events strictly in Stripe's `created` order, different customers in
+parallel. A handler and its event's status change commit together, so an
+event is applied exactly once. Handlers make blocking database and Stripe
+API calls and run in a thread. Failed events are retried with exponential
+backoff and dead-lettered with status 'dead' after
+STRIPE_EVENT_MAX_ATTEMPTS; replay_stripe_events.py re-queues them.
+
+Like receipt_worker, the workers run inside the web process by default
+(STRIPE_EVENTS_IN_PROCESS=true) or as a separate process:
+
+    python stripe_worker.py
+"""
+import asyncio
+import json
+import logging
+import os
+import random
+import socket
+import uuid
+from datetime import datetime, timedelta
+from typing import Optional
+
+from dotenv import load_dotenv
+
+# Load environment variables before modules that read them at import time
+load_dotenv()
+
+from sqlalchemy import and_, exists, or_
+from sqlalchemy.dialects.postgresql import insert as postgresql_insert
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlalchemy.orm import Session, aliased
+
+from database import (
+    SessionLocal, StripeEvent, StripeEventStatus, User, Subscription,
+    SubscriptionPlanType, SubscriptionStatus
+)
+from entitlements import get_or_create_subscription, invalidate_entitlement
+from notification_service import notify
+from stripe_gateway import StripeUnavailableError, retrieve_subscription
+from subscription_lifecycle import month_start, next_month_start
+import metrics
+
+logger = logging.getLogger(__name__)
+
+STRIPE_EVENT_WORKERS = int(os.getenv("STRIPE_EVENT_WORKERS", "2"))
+STRIPE_EVENT_MAX_ATTEMPTS = int(os.getenv("STRIPE_EVENT_MAX_ATTEMPTS", "8"))
+STRIPE_EVENT_RETRY_BACKOFF_SECONDS = float(os.getenv("STRIPE_EVENT_RETRY_BACKOFF_SECONDS", "5"))
+STRIPE_EVENT_POLL_INTERVAL_SECONDS = float(os.getenv("STRIPE_EVENT_POLL_INTERVAL_SECONDS", "1"))
+STRIPE_EVENT_LEASE_SECONDS = int(os.getenv("STRIPE_EVENT_LEASE_SECONDS", "300"))  # Running events of a dead worker are reclaimed after this
+STRIPE_EVENTS_IN_PROCESS = os.getenv("STRIPE_EVENTS_IN_PROCESS", "true").lower() == "true"
+
+UNFINISHED_STATUSES = (StripeEventStatus.QUEUED.value, StripeEventStatus.RUNNING.value)
+
+_wakeup: Optional[asyncio.Event] = None
+_worker_tasks: list = []
+
+
+class PermanentEventError(Exception):
+    """The event can never be applied (e.g. unknown user); it is not retried"""
+
+
+def customer_key(event: dict) -> str:
+    """Ordering key: the Stripe customer, else our user id, else the event itself"""
+    obj = event.get("data", {}).get("object", {})
+    if obj.get("object") == "customer" and obj.get("id"):
+        return obj["id"]
+    if obj.get("customer"):
+        return obj["customer"]
+    user_id = (obj.get("metadata") or {}).get("user_id")
+    if user_id:
+        return f"user:{user_id}"
+    return event["id"]
+
+
+def store_event(db: Session, event: dict, payload: str) -> bool:
+    """Queue a verified event; returns False if it was already stored (a redelivery)"""
+    insert = postgresql_insert if db.bind.dialect.name == "postgresql" else sqlite_insert
+    result = db.execute(
+        insert(StripeEvent)
+        .values(
+            event_id=event["id"],
+            type=event["type"],
+            customer_key=customer_key(event),
+            stripe_created=int(event.get("created") or 0),
+            payload=payload,
+            status=StripeEventStatus.QUEUED.value,
+            attempts=0,
+            next_attempt_at=datetime.utcnow(),
+            received_at=datetime.utcnow()
+        )
+        .on_conflict_do_nothing(index_elements=["event_id"])
+    )
+    db.commit()
+    is_new = bool(result.rowcount)
+    metrics.increment("stripe_events.received" if is_new else "stripe_events.duplicates")
+    return is_new
+
+
+def notify_event_received():
+    """Wake in-process workers instead of waiting for their next poll"""
+    if _wakeup is not None:
+        _wakeup.set()
+
+
+def subscription_period(subscription: dict) -> Optional[tuple[datetime, datetime]]:
+    """(start, end) of a Stripe subscription's current billing period, as UTC
+
+    Since API version 2025-03-31.basil (stripe-python 12+) the period is on
+    each subscription item rather than the subscription; events stored
+    before that still carry it at the top level.
+    """
+    items = (subscription.get("items") or {}).get("data") or []
+    source = items[0] if items and items[0].get("current_period_end") else subscription
+    start, end = source.get("current_period_start"), source.get("current_period_end")
+    if not start or not end:
+        return None
+    return datetime.utcfromtimestamp(start), datetime.utcfromtimestamp(end)
+
+
+# Event handlers: apply one event with the caller's session and don't commit
+# (the caller commits together with the event's status).
+
+def _checkout_completed(db: Session, event: dict):
+    session = event["data"]["object"]
+    user_id = int(session["metadata"]["user_id"])
+    plan_type = session["metadata"]["plan_type"]
+
+    logger.info(f"Processing checkout.session.completed: user_id={user_id}, plan_type={plan_type}")
+
+    user = db.query(User).filter(User.id == user_id).first()
+    if not user:
+        raise PermanentEventError(f"User not found: user_id={user_id}")
+
+    # Ask Stripe first: no rows are written (or locked) while waiting on the network
+    period = None
+    stripe_subscription_id = session.get("subscription") if plan_type == "unlimited" else None
+    if stripe_subscription_id:
+        try:
+            period = subscription_period(retrieve_subscription(stripe_subscription_id).to_dict())
+            if period:
+                logger.info(f"Retrieved subscription details: period_start={period[0]}, period_end={period[1]}")
+            else:
+                logger.warning(f"Stripe subscription {stripe_subscription_id} has no current period")
+        except StripeUnavailableError:
+            # Transient: retry the whole event later
+            raise
+        except Exception as e:
+            logger.error(f"Error retrieving Stripe subscription {stripe_subscription_id}: {e}")
+
+    subscription = get_or_create_subscription(db, user_id, commit=False)
+    invalidate_entitlement(db, user_id)
+    logger.info(f"Current subscription before update: plan_type={subscription.plan_type}, status={subscription.status}")
+
+    if plan_type == "extra_30":
+        # Add 30 scans to current month; subscription_lifecycle resets the plan when it ends
+        now = datetime.utcnow()
+        subscription.plan_type = SubscriptionPlanType.EXTRA_30.value
+        subscription.status = SubscriptionStatus.ACTIVE.value
+        subscription.current_period_start = month_start(now)
+        subscription.current_period_end = next_month_start(now)
+        logger.info("Updated subscription to EXTRA_30")
+    elif plan_type == "unlimited":
+        subscription.plan_type = SubscriptionPlanType.UNLIMITED.value
+        subscription.status = SubscriptionStatus.ACTIVE.value
+        subscription.stripe_subscription_id = stripe_subscription_id
+        logger.info(f"Updated subscription to UNLIMITED, stripe_subscription_id={stripe_subscription_id}")
+
+        if period:
+            subscription.current_period_start, subscription.current_period_end = period
+            subscription.period_synced_at = datetime.utcnow()
+        elif not stripe_subscription_id:
+            logger.warning("No subscription ID in checkout session")
+
+
+def _subscription_updated(db: Session, event: dict):
+    subscription_obj = event["data"]["object"]
+    subscription = db.query(Subscription).filter(
+        Subscription.stripe_subscription_id == subscription_obj["id"]
+    ).first()
+
+    if subscription:
+        invalidate_entitlement(db, subscription.user_id)
+        if subscription_obj["status"] == "active":
+            if subscription.plan_type == SubscriptionPlanType.LIMITED.value:
+                # Renewal arrived after subscription_lifecycle expired the plan
+                subscription.plan_type = SubscriptionPlanType.UNLIMITED.value
+            subscription.status = SubscriptionStatus.ACTIVE.value
+            period = subscription_period(subscription_obj)
+            if period:
+                subscription.current_period_start, subscription.current_period_end = period
+                subscription.period_synced_at = datetime.utcnow()
+            else:
+                logger.warning(f"customer.subscription.updated for {subscription_obj['id']} has no current period")
+        elif subscription_obj["status"] == "canceled":
+            subscription.status = SubscriptionStatus.CANCELLED.value
+
+
+def _subscription_deleted(db: Session, event: dict):
+    subscription_obj = event["data"]["object"]
+    subscription = db.query(Subscription).filter(
+        Subscription.stripe_subscription_id == subscription_obj["id"]
+    ).first()
+
+    if subscription:
+        invalidate_entitlement(db, subscription.user_id)
+        subscription.status = SubscriptionStatus.CANCELLED.value
+        subscription.plan_type = SubscriptionPlanType.LIMITED.value
+
+
+def _payment_failed(db: Session, event: dict):
+    invoice = event["data"]["object"]
+    customer_id = invoice.get("customer")
+
+    # Find user by Stripe customer ID
+    subscription = db.query(Subscription).filter(
+        Subscription.stripe_customer_id == customer_id
+    ).first()
+
+    if subscription:
+        user = db.query(User).filter(User.id == subscription.user_id).first()
+        if user:
+            # Dated by the event, so a late retry or replay says when it actually failed
+            failed_at = datetime.utcfromtimestamp(event.get("created") or datetime.utcnow().timestamp())
+            notify(
+                db, user.id, "payment_failed",
+                f"Your payment failed on {failed_at.strftime('%B %d, %Y')}. Please update your payment method to continue your subscription."
+            )
+
+            # Update subscription status to indicate payment issue
+            subscription.status = SubscriptionStatus.ACTIVE.value  # Keep active but notify user
+            logger.info(f"Created payment_failed notification for user {user.id}")
+
+
+EVENT_HANDLERS = {
+    "checkout.session.completed": _checkout_completed,
+    "customer.subscription.updated": _subscription_updated,
+    "customer.subscription.deleted": _subscription_deleted,
+    "invoice.payment_failed": _payment_failed,
+}
+
+
+# An earlier event of the same customer is still queued or running.
+# Built once: a fresh alias per query would defeat SQLAlchemy's statement cache.
+_earlier = aliased(StripeEvent, name="earlier_event")
+_blocked = exists().where(
+    _earlier.customer_key == StripeEvent.customer_key,
+    _earlier.status.in_(UNFINISHED_STATUSES),
+    or_(
+        _earlier.stripe_created < StripeEvent.stripe_created,
+        and_(_earlier.stripe_created == StripeEvent.stripe_created, _earlier.id < StripeEvent.id)
+    )
+)
+
+
+def _claimable(now: datetime):
+    """Due queued events and expired running ones, with no earlier unfinished event of the same customer"""
+    return and_(
+        or_(
+            and_(
+                StripeEvent.status == StripeEventStatus.QUEUED.value,
+                StripeEvent.next_attempt_at <= now
+            ),
+            and_(
+                StripeEvent.status == StripeEventStatus.RUNNING.value,
+                StripeEvent.locked_at < now - timedelta(seconds=STRIPE_EVENT_LEASE_SECONDS)
+            )
+        ),
+        ~_blocked
+    )
+
+
+def claim_next_event(worker_id: str) -> Optional[int]:
+    """Atomically mark the oldest claimable event as running for this worker"""
+    db = SessionLocal()
+    try:
+        # Losing every race means other workers made progress: look again
+        while True:
+            now = datetime.utcnow()
+            # Per-customer order is enforced by _claimable, so workers can spread
+            # over the oldest few candidates instead of all fighting for the first
+            candidates = [row.id for row in db.query(StripeEvent.id).filter(_claimable(now)).order_by(
+                StripeEvent.stripe_created, StripeEvent.id
+            ).limit(STRIPE_EVENT_WORKERS * 2)]
+            if not candidates:
+                return None
+            random.shuffle(candidates)
+            for candidate_id in candidates:
+                # Conditional update: only one worker can win the same row
+                claimed = db.query(StripeEvent).filter(
+                    StripeEvent.id == candidate_id,
+                    _claimable(now)
+                ).update({
+                    "status": StripeEventStatus.RUNNING.value,
+                    "locked_by": worker_id,
+                    "locked_at": now,
+                    "attempts": StripeEvent.attempts + 1
+                }, synchronize_session=False)
+                db.commit()
+                if claimed:
+                    return candidate_id
+    finally:
+        db.close()
+
+
+def process_event(event_row_id: int):
+    """Apply one claimed event and store its outcome (blocking; run in a thread)"""
+    db = SessionLocal()
+    try:
+        row = db.query(StripeEvent).filter(StripeEvent.id == event_row_id).first()
+        event = json.loads(row.payload)
+        handler = EVENT_HANDLERS.get(row.type)
+        try:
+            if handler:
+                handler(db, event)
+        except Exception as e:
+            db.rollback()
+            row = db.query(StripeEvent).filter(StripeEvent.id == event_row_id).first()
+            retryable = not isinstance(e, PermanentEventError)
+            row.error = f"{type(e).__name__}: {e}"[:500]
+            row.locked_by = None
+
+            if retryable and row.attempts < STRIPE_EVENT_MAX_ATTEMPTS:
+                delay = STRIPE_EVENT_RETRY_BACKOFF_SECONDS * 2 ** (row.attempts - 1)
+                row.status = StripeEventStatus.QUEUED.value
+                row.next_attempt_at = datetime.utcnow() + timedelta(seconds=delay)
+                metrics.increment("stripe_events.retried")
+                logger.warning(f"Stripe event {row.event_id} ({row.type}) attempt {row.attempts} failed, retrying in {delay:g}s: {row.error}")
+            else:
+                row.status = StripeEventStatus.DEAD.value if retryable else StripeEventStatus.FAILED.value
+                row.processed_at = datetime.utcnow()
+                metrics.increment(f"stripe_events.{row.status}")
+                logger.error(f"Stripe event {row.event_id} ({row.type}) {row.status} after {row.attempts} attempts: {row.error}")
+            db.commit()
+            return
+
+        now = datetime.utcnow()
+        row.status = StripeEventStatus.PROCESSED.value
+        row.error = None
+        row.locked_by = None
+        row.processed_at = now
+        db.commit()
+        metrics.increment("stripe_events.processed")
+        metrics.set_gauge("stripe_events.last_lag_ms", round((now - row.received_at).total_seconds() * 1000, 1))
+    finally:
+        db.close()
+
+
+async def worker_loop(worker_id: str):
+    """Claim and apply events until cancelled"""
+    while True:
+        try:
+            event_row_id = await asyncio.to_thread(claim_next_event, worker_id)
+            if event_row_id:
+                await asyncio.to_thread(process_event, event_row_id)
+                continue
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.error(f"Stripe event worker {worker_id} error: {e}")
+
+        if _wakeup is not None:
+            _wakeup.clear()
+            try:
+                await asyncio.wait_for(_wakeup.wait(), STRIPE_EVENT_POLL_INTERVAL_SECONDS)
+            except asyncio.TimeoutError:
+                pass
+        else:
+            await asyncio.sleep(STRIPE_EVENT_POLL_INTERVAL_SECONDS)
+
+
+def _worker_ids(count: int) -> list[str]:
+    prefix = f"stripe-{socket.gethostname()}-{os.getpid()}-{uuid.uuid4().hex[:6]}"
+    return [f"{prefix}-{i}" for i in range(count)]
+
+
+def start_stripe_workers():
+    """Start the worker pool on the running event loop (web process)"""
+    global _wakeup
+    if not STRIPE_EVENTS_IN_PROCESS or _worker_tasks:
+        return
+    _wakeup = asyncio.Event()
+    for worker_id in _worker_ids(STRIPE_EVENT_WORKERS):
+        _worker_tasks.append(asyncio.create_task(worker_loop(worker_id)))
+    print(f"Started {STRIPE_EVENT_WORKERS} in-process Stripe event workers")
+
+
+async def stop_stripe_workers():
+    """Cancel in-process workers; claimed events are picked up again after their lease"""
+    global _wakeup
+    for task in _worker_tasks:
+        task.cancel()
+    await asyncio.gather(*_worker_tasks, return_exceptions=True)
+    _worker_tasks.clear()
+    _wakeup = None
+
+
+async def run_worker_pool(count: int):
+    """Run a pool of workers in this process until interrupted"""
+    print(f"Starting {count} Stripe event workers")
+    await asyncio.gather(*(worker_loop(worker_id) for worker_id in _worker_ids(count)))
+
+
+if __name__ == "__main__":
+    from database import init_db
+
+    init_db()
+    try:
+        asyncio.run(run_worker_pool(STRIPE_EVENT_WORKERS))
+    except KeyboardInterrupt:
+        print("Stripe event workers stopped")
@@ -0,0 +1,152 @@
+"""
+Subscription lifecycle sweeper.
+
+Stripe webhooks keep UNLIMITED subscriptions current, but nothing else ends
+a plan: a lost customer.subscription.deleted left a user unlimited for good,
+and EXTRA_30 add-ons were never reset. sweep_subscriptions() runs on the
+scheduler and, in batches of SUBSCRIPTION_SWEEP_BATCH_SIZE:
+
+- moves EXTRA_30 add-ons bought before this month back to the free plan, and
+- expires UNLIMITED subscriptions that were cancelled and whose period has
+  ended, or that are still "active" SUBSCRIPTION_RENEWAL_GRACE_HOURS after
+  the period end without a renewal webhook. Only periods Stripe set
+  (period_synced_at, from checkout or a subscription.updated event) count:
+  a period we filled in ourselves says nothing about when Stripe bills,
+  and expiring on it would downgrade paying users,
+
+notifying the affected users with one bulk INSERT per batch. Each batch is a
+conditional UPDATE ... RETURNING that re-checks the expiry condition, so the
+copies running in every web worker never downgrade or notify a user twice.
+A late renewal webhook (customer.subscription.updated, active) restores the
+plan. Request-path checks (entitlements) stay plain reads.
+"""
+import os
+from datetime import datetime, timedelta
+
+from sqlalchemy import and_, or_, update
+from sqlalchemy.orm import Session
+
+from database import SessionLocal, Subscription, SubscriptionPlanType, SubscriptionStatus
+from entitlements import BASE_SCAN_LIMIT, get_plan_display_name, invalidate_entitlement
+from notification_service import notify_many
+import metrics
+
+SUBSCRIPTION_SWEEP_INTERVAL_SECONDS = float(os.getenv("SUBSCRIPTION_SWEEP_INTERVAL_SECONDS", "600"))
+SUBSCRIPTION_SWEEP_BATCH_SIZE = int(os.getenv("SUBSCRIPTION_SWEEP_BATCH_SIZE", "500"))
+SUBSCRIPTION_RENEWAL_GRACE_HOURS = float(os.getenv("SUBSCRIPTION_RENEWAL_GRACE_HOURS", "72"))
+
+
+def month_start(now: datetime) -> datetime:
+    return now.replace(day=1, hour=0, minute=0, second=0, microsecond=0)
+
+
+def next_month_start(now: datetime) -> datetime:
+    return (month_start(now) + timedelta(days=32)).replace(day=1)
+
+
+def _ended_add_on(now: datetime):
+    # updated_at guards add-ons bought this month on rows whose period predates the purchase
+    return and_(
+        Subscription.plan_type == SubscriptionPlanType.EXTRA_30.value,
+        or_(Subscription.current_period_end.is_(None), Subscription.current_period_end <= now),
+        or_(Subscription.updated_at.is_(None), Subscription.updated_at < month_start(now))
+    )
+
+
+def _ended_unlimited(now: datetime):
+    return and_(
+        Subscription.plan_type == SubscriptionPlanType.UNLIMITED.value,
+        Subscription.stripe_subscription_id.isnot(None),
+        Subscription.period_synced_at.isnot(None),
+        Subscription.current_period_end.isnot(None),
+        or_(
+            and_(
+                Subscription.status == SubscriptionStatus.CANCELLED.value,
+                Subscription.current_period_end <= now
+            ),
+            and_(
+                Subscription.status == SubscriptionStatus.ACTIVE.value,
+                Subscription.current_period_end <= now - timedelta(hours=SUBSCRIPTION_RENEWAL_GRACE_HOURS)
+            )
+        )
+    )
+
+
+def _free_plan(now: datetime, status: str) -> dict:
+    return {
+        "plan_type": SubscriptionPlanType.LIMITED.value,
+        "status": status,
+        "current_period_start": month_start(now),
+        "current_period_end": next_month_start(now),
+        "period_synced_at": None,
+        "updated_at": now,
+    }
+
+
+def _add_on_message(row) -> str:
+    return f"Your {get_plan_display_name(SubscriptionPlanType.EXTRA_30.value)} pack has ended. You're back on the Free Plan with {BASE_SCAN_LIMIT} scans a month."
+
+
+def _unlimited_message(row) -> str:
+    return (
+        f"Your {get_plan_display_name(SubscriptionPlanType.UNLIMITED.value)} plan ended on "
+        f"{row.current_period_end.strftime('%B %d, %Y')}. You're now on the Free Plan with {BASE_SCAN_LIMIT} scans a month."
+    )
+
+
+def _sweep(db: Session, condition, new_values, notification_type: str, message) -> int:
+    """Apply new_values to every subscription matching condition, one batch per transaction"""
+    changed_total = 0
+    while True:
+        now = datetime.utcnow()
+        rows = db.query(
+            Subscription.id, Subscription.user_id, Subscription.current_period_end
+        ).filter(condition(now)).order_by(Subscription.id).limit(SUBSCRIPTION_SWEEP_BATCH_SIZE).all()
+        if not rows:
+            break
+
+        # Re-check the condition in the UPDATE: another worker may have swept some of these already
+        changed = set(db.execute(
+            update(Subscription)
+            .where(Subscription.id.in_([row.id for row in rows]), condition(now))
+            .values(**new_values(now))
+            .returning(Subscription.id)
+            .execution_options(synchronize_session=False)
+        ).scalars())
+        swept = [row for row in rows if row.id in changed]
+        notify_many(db, [
+            {"user_id": row.user_id, "type": notification_type, "message": message(row)}
+            for row in swept
+        ])
+        for row in swept:
+            invalidate_entitlement(db, row.user_id)
+        db.commit()
+
+        changed_total += len(swept)
+        if len(rows) < SUBSCRIPTION_SWEEP_BATCH_SIZE:
+            break
+    return changed_total
+
+
+def sweep_subscriptions() -> int:
+    """Reset ended add-ons and expire ended unlimited plans; returns the number of subscriptions changed"""
+    db = SessionLocal()
+    try:
+        add_ons_reset = _sweep(
+            db, _ended_add_on,
+            lambda now: _free_plan(now, SubscriptionStatus.ACTIVE.value),
+            "extra_scans_ended", _add_on_message
+        )
+        expired = _sweep(
+            db, _ended_unlimited,
+            lambda now: _free_plan(now, SubscriptionStatus.EXPIRED.value),
+            "subscription_expired", _unlimited_message
+        )
+    finally:
+        db.close()
+
+    metrics.increment("subscriptions.add_ons_reset", add_ons_reset)
+    metrics.increment("subscriptions.expired", expired)
+    if add_ons_reset or expired:
+        print(f"Subscription sweep: reset {add_ons_reset} add-ons, expired {expired} subscriptions")
+    return add_ons_reset + expired
@@ -220,14 +220,14 @@ export async function createExpense(data) {
   }
 }
 
-export async function createExpensesBatch(expenses) {
+export async function createExpensesBatch(expenses, merchant = null) {
   console.log('createExpensesBatch: Sending data:', JSON.stringify(expenses));
   const response = await authenticatedFetch(`${BASE_URL}/expenses/batch`, {
     method: "POST",
     headers: {
       "Content-Type": "application/json",
     },
-    body: JSON.stringify({ expenses }),
+    body: JSON.stringify({ expenses, merchant }),
   });
   try {
     const result = await response.json();
@@ -396,6 +396,28 @@ export async function scanReceipt(imageBase64, language = 'en') {
   return await response.json();
 }
 
+export async function getReceiptScan(scanId) {
+  const response = await authenticatedFetch(`${BASE_URL}/receipts/${scanId}`);
+  if (!response.ok) {
+    const error = await response.json().catch(() => ({ detail: 'Failed to load scan' }));
+    throw new Error(error.detail || 'Failed to load scan');
+  }
+  return await response.json();
+}
+
+export async function getReceiptHistory(beforeId = null, limit = 20) {
+  const params = new URLSearchParams({ limit: String(limit) });
+  if (beforeId) {
+    params.append('before_id', String(beforeId));
+  }
+  const response = await authenticatedFetch(`${BASE_URL}/receipts/history?${params.toString()}`);
+  if (!response.ok) {
+    const error = await response.json().catch(() => ({ detail: 'Failed to load scan history' }));
+    throw new Error(error.detail || 'Failed to load scan history');
+  }
+  return await response.json();
+}
+
 // Export functions
 // Subscription API functions
 export async function getSubscriptionStatus() {
@@ -457,12 +479,36 @@ export async function cancelSubscription() {
   return await response.json();
 }
 
-export async function getNotifications() {
-  const response = await authenticatedFetch(`${BASE_URL}/notifications`);
+export async function getNotifications({ cursor = null, limit = 20, unreadOnly = false, type = null } = {}) {
+  const params = new URLSearchParams({ limit: String(limit) });
+  if (cursor) {
+    params.append('cursor', cursor);
+  }
+  if (unreadOnly) {
+    params.append('unread', 'true');
+  }
+  if (type) {
+    params.append('type', type);
+  }
+  const response = await authenticatedFetch(`${BASE_URL}/notifications?${params.toString()}`);
+  if (!response.ok) {
+    const error = await response.json().catch(() => ({ detail: 'Failed to load notifications' }));
+    throw new Error(error.detail || 'Failed to load notifications');
+  }
   const data = await response.json();
   return normalizeBooleans(data);
 }
 
+// URL for the live event stream. EventSource can't send headers, so the URL carries a
+// stream-only token that expires within a minute: get a new URL for every connection
+export async function getEventStreamUrl() {
+  const token = await getAuthToken();
+  if (!token) return null;
+  const response = await authenticatedFetch(`${BASE_URL}/events/stream-token`, { method: 'POST' });
+  const data = await response.json();
+  return `${BASE_URL}/events/stream?stream_token=${encodeURIComponent(data.stream_token)}`;
+}
+
 export async function getUnreadNotificationCount() {
   const response = await authenticatedFetch(`${BASE_URL}/notifications/unread-count`);
   const data = await response.json();
@@ -10,6 +10,7 @@ import { useCurrency } from '../src/CurrencyProvider';
 import { useLanguage } from '../src/LanguageProvider';
 import { useAuth } from '../src/AuthContext';
 import MultiBarChart from '../src/MultiBarChart';
+import { subscribeToEvents } from '../src/eventStream';
 import { colors } from '../src/colors';
 
 // Map English category names to translation keys
@@ -88,6 +89,24 @@ export default function DashboardScreen({ navigation }) {
     }, [isAuthenticated, authLoading])
   );
 
+  // Expenses or income changed (here or on another device): refetch while the dashboard is shown
+  useEffect(() => {
+    if (!isFocused || !isAuthenticated) return undefined;
+    let timer = null;
+    const refresh = () => {
+      clearTimeout(timer);
+      timer = setTimeout(loadData, 500);
+    };
+    const unsubscribers = [
+      subscribeToEvents('data_changed', refresh),
+      subscribeToEvents('resync', refresh),
+    ];
+    return () => {
+      clearTimeout(timer);
+      unsubscribers.forEach((unsubscribe) => unsubscribe());
+    };
+  }, [isFocused, isAuthenticated]);
+
   const loadData = async () => {
     try {
       setLoading(true);
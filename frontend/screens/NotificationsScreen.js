@@ -1,18 +1,23 @@
 import React, { useState, useEffect } from 'react';
 import { View, Text, StyleSheet, ScrollView, TouchableOpacity, ActivityIndicator, Platform } from 'react-native';
 import { useFocusEffect } from '@react-navigation/native';
-import { getNotifications, markNotificationRead, markAllNotificationsRead } from '../api';
+import { getNotifications, getUnreadNotificationCount, markNotificationRead, markAllNotificationsRead } from '../api';
 import { colors } from '../src/colors';
 
 export default function NotificationsScreen({ navigation }) {
   const [notifications, setNotifications] = useState([]);
+  const [nextCursor, setNextCursor] = useState(null);
+  const [unreadCount, setUnreadCount] = useState(0);
   const [loading, setLoading] = useState(true);
+  const [loadingMore, setLoadingMore] = useState(false);
 
   const loadNotifications = async () => {
     try {
       setLoading(true);
-      const data = await getNotifications();
-      setNotifications(data);
+      const [page, unread] = await Promise.all([getNotifications(), getUnreadNotificationCount()]);
+      setNotifications(page.items);
+      setNextCursor(page.next_cursor);
+      setUnreadCount(unread.unread_count);
     } catch (error) {
       console.error('Error loading notifications:', error);
     } finally {
@@ -20,6 +25,20 @@ export default function NotificationsScreen({ navigation }) {
     }
   };
 
+  const loadMore = async () => {
+    if (!nextCursor || loadingMore) return;
+    try {
+      setLoadingMore(true);
+      const page = await getNotifications({ cursor: nextCursor });
+      setNotifications((current) => [...current, ...page.items]);
+      setNextCursor(page.next_cursor);
+    } catch (error) {
+      console.error('Error loading more notifications:', error);
+    } finally {
+      setLoadingMore(false);
+    }
+  };
+
   useFocusEffect(
     React.useCallback(() => {
       loadNotifications();
@@ -29,7 +48,8 @@ export default function NotificationsScreen({ navigation }) {
   const handleMarkAsRead = async (notificationId) => {
     try {
       await markNotificationRead(notificationId);
-      await loadNotifications();
+      setNotifications((current) => current.map(n => (n.id === notificationId ? { ...n, read: true } : n)));
+      setUnreadCount((count) => Math.max(0, count - 1));
     } catch (error) {
       console.error('Error marking notification as read:', error);
     }
@@ -38,7 +58,8 @@ export default function NotificationsScreen({ navigation }) {
   const handleMarkAllAsRead = async () => {
     try {
       await markAllNotificationsRead();
-      await loadNotifications();
+      setNotifications((current) => current.map(n => ({ ...n, read: true })));
+      setUnreadCount(0);
     } catch (error) {
       console.error('Error marking all as read:', error);
     }
@@ -60,8 +81,6 @@ export default function NotificationsScreen({ navigation }) {
     }
   };
 
-  const unreadCount = notifications.filter(n => !n.read).length;
-
   return (
     <ScrollView style={styles.container}>
       <View style={styles.content}>
@@ -113,6 +132,19 @@ export default function NotificationsScreen({ navigation }) {
                     )}
                   </TouchableOpacity>
                 ))}
+                {nextCursor && (
+                  <TouchableOpacity
+                    style={styles.loadMoreButton}
+                    onPress={loadMore}
+                    disabled={loadingMore}
+                  >
+                    {loadingMore ? (
+                      <ActivityIndicator size="small" color={colors.primary} />
+                    ) : (
+                      <Text style={styles.loadMoreButtonText}>Load more</Text>
+                    )}
+                  </TouchableOpacity>
+                )}
               </>
             )}
           </>
@@ -167,6 +199,19 @@ const styles = StyleSheet.create({
     fontSize: 16,
     fontWeight: '600',
   },
+  loadMoreButton: {
+    padding: 12,
+    borderRadius: 8,
+    alignItems: 'center',
+    borderWidth: 1,
+    borderColor: colors.primary,
+    marginBottom: 16,
+  },
+  loadMoreButtonText: {
+    color: colors.primary,
+    fontSize: 16,
+    fontWeight: '600',
+  },
   notificationCard: {
     backgroundColor: colors.surface,
     padding: 16,
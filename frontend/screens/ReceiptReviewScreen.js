@@ -2,12 +2,12 @@ import React, { useState, useEffect } from 'react';
 import { View, Text, StyleSheet, TouchableOpacity, TextInput, ScrollView, ActivityIndicator, Alert, Platform, Image, Modal } from 'react-native';
 import { useLanguage } from '../src/LanguageProvider';
 import { colors } from '../src/colors';
-import { scanReceipt, createExpense, createExpensesBatch, getSubscriptionUsage } from '../api';
+import { scanReceipt, getReceiptScan, createExpensesBatch, getSubscriptionUsage } from '../api';
 import { CATEGORY_KEY_TO_NAME, CATEGORY_NAME_TO_KEY } from './AddExpenseScreen';
 
 export default function ReceiptReviewScreen({ navigation, route }) {
   const { t, language } = useLanguage();
-  const { imageUri, imageBase64 } = route.params || {};
+  const { imageUri, imageBase64, scanId } = route.params || {};
   
   const [loading, setLoading] = useState(false);
   const [saving, setSaving] = useState(false);
@@ -37,7 +37,7 @@ export default function ReceiptReviewScreen({ navigation, route }) {
   });
 
   useEffect(() => {
-    if (imageBase64) {
+    if (imageBase64 || scanId) {
       processReceipt();
     }
     loadSubscriptionUsage();
@@ -64,8 +64,12 @@ export default function ReceiptReviewScreen({ navigation, route }) {
     try {
       setLoading(true);
       console.log('Starting receipt scan...');
-      const result = await scanReceipt(imageBase64, language);
+      // A saved scan reloads without another model call or quota unit
+      const result = scanId ? await getReceiptScan(scanId) : await scanReceipt(imageBase64, language);
       console.log('Receipt scan result:', JSON.stringify(result, null, 2));
+      if (result.scan_id && result.scan_id !== scanId) {
+        navigation.setParams({ scanId: result.scan_id });
+      }
       
       if (result.success && result.data) {
         const data = result.data;
@@ -262,12 +266,13 @@ export default function ReceiptReviewScreen({ navigation, route }) {
       setSaving(true);
       setMessage({ type: null, text: '' });
       
-      await createExpense({
+      // Saved through the batch endpoint so the backend learns this biller's category
+      await createExpensesBatch([{
         amount: parseFloat(utilityFormData.amount),
         date: utilityFormData.date,
         category: utilityFormData.category ? CATEGORY_KEY_TO_NAME[utilityFormData.category] : null,
         description: utilityFormData.description || utilityFormData.merchant || null,
-      });
+      }], utilityFormData.merchant || null);
       
       setMessage({ type: 'success', text: 'Expense created successfully' });
       
@@ -327,7 +332,7 @@ export default function ReceiptReviewScreen({ navigation, route }) {
         description: group.descriptions.length > 0 ? group.descriptions.join(', ') : null,
       }));
       
-      await createExpensesBatch(expenses);
+      await createExpensesBatch(expenses, storeData.merchant || null);
       
       setMessage({ type: 'success', text: `${expenses.length} expense${expenses.length > 1 ? 's' : ''} created successfully` });
       
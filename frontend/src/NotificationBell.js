@@ -2,6 +2,7 @@ import React, { useState, useEffect } from 'react';
 import { TouchableOpacity, View, Text, StyleSheet, Platform } from 'react-native';
 import { useNavigation } from '@react-navigation/native';
 import { getUnreadNotificationCount } from '../api';
+import { isEventStreamSupported, subscribeToEvents } from './eventStream';
 import { colors } from './colors';
 
 export default function NotificationBell() {
@@ -9,8 +10,19 @@ export default function NotificationBell() {
   const [unreadCount, setUnreadCount] = useState(0);
 
   useEffect(() => {
+    if (isEventStreamSupported()) {
+      // Live updates: the stream sends the current count when it opens
+      const unsubscribers = [
+        subscribeToEvents('unread_count', (data) => setUnreadCount(data.unread_count || 0)),
+        subscribeToEvents('notification', (data) => setUnreadCount(
+          (count) => (data.unread_count !== undefined ? data.unread_count : count + 1)
+        )),
+        subscribeToEvents('resync', loadUnreadCount),
+      ];
+      return () => unsubscribers.forEach((unsubscribe) => unsubscribe());
+    }
     loadUnreadCount();
-    // Refresh every 30 seconds
+    // No EventSource (native apps): refresh every 30 seconds
     const interval = setInterval(loadUnreadCount, 30000);
     return () => clearInterval(interval);
   }, []);
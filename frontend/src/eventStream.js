@@ -0,0 +1,83 @@
+import { getEventStreamUrl } from '../api';
+
+// One EventSource per app, shared by every component that listens. Only
+// available where EventSource exists (web); elsewhere components keep polling.
+const listeners = {};
+let source = null;
+let opening = false;
+let reopenTimer = null;
+
+// The stream URL's token expires quickly, so the browser's own reconnect
+// (same URL) would be refused; reconnect with a fresh URL after this delay
+const RECONNECT_DELAY_MS = 5000;
+
+export function isEventStreamSupported() {
+  return typeof EventSource !== 'undefined';
+}
+
+function listenerCount() {
+  return Object.values(listeners).reduce((total, handlers) => total + handlers.size, 0);
+}
+
+function dispatch(eventName, event) {
+  let data = {};
+  try {
+    data = JSON.parse(event.data);
+  } catch {
+    // Keep the empty payload
+  }
+  (listeners[eventName] || new Set()).forEach((handler) => handler(data));
+}
+
+async function open() {
+  if (source || opening) return;
+  opening = true;
+  try {
+    const url = await getEventStreamUrl();
+    if (!url || listenerCount() === 0) return;
+    source = new EventSource(url);
+    ['notification', 'unread_count', 'data_changed', 'resync'].forEach((eventName) => {
+      source.addEventListener(eventName, (event) => dispatch(eventName, event));
+    });
+    source.onerror = () => {
+      close();
+      scheduleReopen();
+    };
+  } catch (error) {
+    console.error('Error opening event stream:', error);
+    scheduleReopen();
+  } finally {
+    opening = false;
+  }
+}
+
+function scheduleReopen() {
+  if (reopenTimer || listenerCount() === 0) return;
+  reopenTimer = setTimeout(() => {
+    reopenTimer = null;
+    if (listenerCount() > 0) open();
+  }, RECONNECT_DELAY_MS);
+}
+
+function close() {
+  if (source) {
+    source.close();
+    source = null;
+  }
+}
+
+// Calls handler(data) for each eventName event; returns the unsubscribe function
+export function subscribeToEvents(eventName, handler) {
+  if (!isEventStreamSupported()) return () => {};
+  if (!listeners[eventName]) listeners[eventName] = new Set();
+  listeners[eventName].add(handler);
+  open();
+  return () => {
+    listeners[eventName].delete(handler);
+    if (listenerCount() === 0) {
+      close();
+      clearTimeout(reopenTimer);
+      reopenTimer = null;
+    }
+  };
+}